@@ -1,30 +1,22 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Function
-import torchvision.transforms as transforms
 from ClassifierModels import Resnet18
 from AttentionUnetModel import AttentionUnet2D
-import matplotlib.pyplot as plt
+from Activations import relu1
 
 
-class Relu1(Function):
-    """
-    clipped ReLU: min(1,max(0,x))
-    """
-    @staticmethod
-    def forward(ctx, input):
-        ctx.save_for_backward(input)
-        # print("fwd:", input[0])
-        return input.clamp(min=0, max=1)
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
 
-    @staticmethod
-    def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
-        grad_input = grad_output.clone()
-        grad_input[input < 0] *= 0.0
-        grad_input[input > 1] *= 0.0
 
-        return grad_input
+def normalize_latent(encoder_output):
+    """
+    Broadcast the latent image to 3 channels and normalize it with the ImageNet statistics, for the whole batch
+    at once and on the device of the encoder output (CPU or GPU).
+    """
+    mean = encoder_output.new_tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+    std = encoder_output.new_tensor(IMAGENET_STD).view(1, 3, 1, 1)
+    return (encoder_output.expand(-1, 3, -1, -1) - mean) / std
 
 
 class BasicAutoEncoder(nn.Module):
@@ -36,28 +28,29 @@ class BasicAutoEncoder(nn.Module):
     def __init__(self):
         super(BasicAutoEncoder, self).__init__()
 
+        # any input size HxW divisible by 4 (896x896 -> 224x224 latent with the default input size)
         self.encoder = nn.Sequential(
-            # 1x896x896
+            # 1xHxW
             nn.Conv2d(in_channels=1, out_channels=32, kernel_size=5, stride=4, padding=2),
             nn.ELU(),
-            # 1X224X224
+            # 1xH/4xW/4
             nn.Conv2d(in_channels=32, out_channels=1, kernel_size=1, stride=1, padding=0),
-            # 1x224x224
+            # 1xH/4xW/4
         )
 
         self.decoder = nn.Sequential(
-            # 1x224x224
+            # 1xH/4xW/4
             nn.Conv2d(in_channels=1, out_channels=16, kernel_size=3, stride=1, padding=1),
             nn.PixelShuffle(4),
-            # 1x896x896
+            # 1xHxW
         )
 
     def forward(self, x):
         encoder_output = self.encoder(x)
-        encoder_output = Relu1.apply(encoder_output)
+        encoder_output = relu1(encoder_output, inplace=True)
 
         decoder_output = self.decoder(encoder_output)
-        decoder_output = Relu1.apply(decoder_output)
+        decoder_output = relu1(decoder_output, inplace=True)
 
         return encoder_output, decoder_output
 
@@ -74,21 +67,21 @@ class ImprovedAutoEncoder(nn.Module):
         super(ImprovedAutoEncoder, self).__init__()
 
         self.encoder = nn.Sequential(
-            # 1x896x896
+            # 1xHxW
             nn.Conv2d(in_channels=1, out_channels=32, kernel_size=5, stride=2, padding=2),
             nn.ELU(),
             nn.Conv2d(in_channels=32, out_channels=16, kernel_size=5, stride=2, padding=2),
             nn.ELU(),
-            # 1X224X224
+            # 1xH/4xW/4
             nn.Conv2d(in_channels=16, out_channels=3, kernel_size=1, stride=1, padding=0),
-            # 1x224x224
+            # 1xH/4xW/4
         )
 
         self.decoder = nn.Sequential(
-            # 1x224x224
+            # 1xH/4xW/4
             nn.Conv2d(in_channels=3, out_channels=16, kernel_size=3, stride=1, padding=1),
             nn.PixelShuffle(4),
-            # 1x896x896
+            # 1xHxW
         )
 
     def forward(self, x):
@@ -101,7 +94,69 @@ class ImprovedAutoEncoder(nn.Module):
         return encoder_output, decoder_output
 
 
-class AE_Resnet18(nn.Module):
+# ---- training stages of the combined models
+STAGE_AUTO_ENCODER = 'auto_encoder'  # only the auto-encoder is trained (reconstruction loss), no classifier pass
+STAGE_FROZEN_ENCODER = 'frozen_encoder'  # the auto-encoder is frozen and runs under no_grad, the classifier is trained
+STAGE_JOINT = 'joint'  # both are trained (the combined loss)
+TRAINING_STAGES = [STAGE_AUTO_ENCODER, STAGE_FROZEN_ENCODER, STAGE_JOINT]
+
+
+class AutoEncoderClassifier(nn.Module):
+    """
+    Base of the combined models: an auto-encoder whose latent image is classified by self.classifier.
+    The training stage selects which parts run and keep gradients (see set_stage).
+    """
+    def __init__(self):
+        super(AutoEncoderClassifier, self).__init__()
+        self.stage = STAGE_JOINT
+
+    def set_stage(self, stage):
+        """
+        Select the training stage: freezes (requires_grad=False and eval mode) the parts that are not trained.
+        """
+        if stage not in TRAINING_STAGES:
+            raise ValueError('unknown training stage ' + str(stage) + ', select from: ' + ', '.join(TRAINING_STAGES))
+        self.stage = stage
+        for param in self.auto_encoder.parameters():
+            param.requires_grad = stage != STAGE_FROZEN_ENCODER
+        for param in self.classifier.parameters():
+            param.requires_grad = stage != STAGE_AUTO_ENCODER
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super(AutoEncoderClassifier, self).train(mode)
+        # frozen parts keep their batch norm statistics
+        if self.stage == STAGE_FROZEN_ENCODER:
+            self.auto_encoder.eval()
+        elif self.stage == STAGE_AUTO_ENCODER:
+            self.classifier.eval()
+        return self
+
+    def latent(self, encoder_output):
+        return normalize_latent(encoder_output)  # broadcasting 1 channel to 3 channels
+
+    def forward(self, x):
+        """
+        :return decoder output, classifier logits (None in the auto-encoder stage)
+        """
+        if self.stage == STAGE_FROZEN_ENCODER:
+            # no activations of the auto-encoder are stored for backward
+            with torch.no_grad():
+                encoder_output, decoder_output = self.auto_encoder(x)
+        else:
+            encoder_output, decoder_output = self.auto_encoder(x)
+
+        if self.stage == STAGE_AUTO_ENCODER:
+            return decoder_output, None
+
+        latent_x = self.latent(encoder_output)
+
+        logits_classifier_output = self.classifier(latent_x)
+
+        return decoder_output, logits_classifier_output
+
+
+class AE_Resnet18(AutoEncoderClassifier):
     """
     Basic auto-encoder combined with ResNet18 as a classifier,
     as stated in: "Jointly Learning Convolutional Representations to Compress Radiological
@@ -112,27 +167,11 @@ class AE_Resnet18(nn.Module):
         super(AE_Resnet18, self).__init__()
 
         self.num_classes = num_classes
-        self.normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         self.auto_encoder = BasicAutoEncoder()
         self.classifier = Resnet18(num_classes=self.num_classes, is_trained=is_backbone_trained)
 
-    def forward(self, x):
-
-        encoder_output, decoder_output = self.auto_encoder(x)
 
-        bs, c, h, w = encoder_output.shape
-        latent_x = torch.Tensor(bs, 3, h, w).cuda()
-
-        for img_no in range(bs):
-            latent_x[img_no] = encoder_output[img_no]
-            latent_x[img_no] = self.normalize(latent_x[img_no])  # broadcasting 1 channel to 3 channels
-
-        logits_classifier_output = self.classifier(latent_x)
-
-        return decoder_output, logits_classifier_output
-
-
-class IMPROVED_AE_Resnet18(nn.Module):
+class IMPROVED_AE_Resnet18(AutoEncoderClassifier):
     """
     Improved auto-encoder combined with ResNet18 as a classifier.
     """
@@ -140,27 +179,11 @@ class IMPROVED_AE_Resnet18(nn.Module):
         super(IMPROVED_AE_Resnet18, self).__init__()
 
         self.num_classes = num_classes
-        self.normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         self.auto_encoder = ImprovedAutoEncoder()
         self.classifier = Resnet18(num_classes=self.num_classes, is_trained=is_backbone_trained)
 
-    def forward(self, x):
-
-        encoder_output, decoder_output = self.auto_encoder(x)
-
-        bs, c, h, w = encoder_output.shape
-        latent_x = torch.Tensor(bs, 3, h, w).cuda()
-
-        for img_no in range(bs):
-            latent_x[img_no] = encoder_output[img_no]
-            latent_x[img_no] = self.normalize(latent_x[img_no])  # broadcasting 1 channel to 3 channels
-
-        logits_classifier_output = self.classifier(latent_x)
-
-        return decoder_output, logits_classifier_output
 
-
-class AttentionUnetResnet18(nn.Module):
+class AttentionUnetResnet18(AutoEncoderClassifier):
     """
     Attention U-Net as an auto-encoder combined with ResNet18 as a classifier.
     """
@@ -169,23 +192,8 @@ class AttentionUnetResnet18(nn.Module):
         super(AttentionUnetResnet18, self).__init__()
 
         self.num_classes = num_classes
-        self.normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         self.auto_encoder = AttentionUnet2D()
         self.classifier = Resnet18(num_classes=self.num_classes, is_trained=is_backbone_trained)
 
-    def forward(self, x):
-
-        encoder_output, decoder_output = self.auto_encoder(x)
-        encoder_output = torch.sigmoid(encoder_output)
-
-        bs, c, h, w = encoder_output.shape
-        latent_x = torch.Tensor(bs, 3, h, w).cuda()
-
-        for img_no in range(bs):
-            latent_x[img_no] = encoder_output[img_no]
-            latent_x[img_no] = self.normalize(latent_x[img_no])  # broadcasting 1 channel to 3 channels
-
-        logits_classifier_output = self.classifier(latent_x)
-
-        return decoder_output, logits_classifier_output
-
+    def latent(self, encoder_output):
+        return normalize_latent(torch.sigmoid(encoder_output))
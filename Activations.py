@@ -0,0 +1,109 @@
+"""
+Clipped ReLU (min(1, max(0, x))) of the auto-encoders, with a memory-lean backward:
+only a bool mask of the clipped elements is saved (1 byte per element instead of the float input), and the gradient
+is computed with a single masked_fill. With inplace=True the forward clamps its input in place (no new output buffer).
+
+Forward / gradcheck assertions (check_relu1) and peak memory of the auto-encoders that use it:
+    python Activations.py
+"""
+import threading
+import time
+
+import torch
+from torch.autograd import Function
+
+
+class Relu1(Function):
+    """
+    clipped ReLU: min(1,max(0,x))
+    """
+    @staticmethod
+    def forward(ctx, input, inplace=False):
+        # the gradient is 0 where the input was clipped (x < 0 or x > 1)
+        clipped = (input < 0) | (input > 1)
+        if inplace:
+            ctx.mark_dirty(input)
+            output = input.clamp_(min=0, max=1)
+        else:
+            output = input.clamp(min=0, max=1)
+        ctx.save_for_backward(clipped)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        clipped, = ctx.saved_tensors
+        return grad_output.masked_fill(clipped, 0), None
+
+
+def relu1(input, inplace=False):
+    return Relu1.apply(input, inplace)
+
+
+def check_relu1():
+    """
+    Assert that relu1 matches clamp and that its backward passes gradcheck (double precision, also in place).
+    """
+    # away from the non-differentiable points 0 and 1
+    x = torch.rand(4, 1, 8, 8, dtype=torch.double) * 3 - 1
+    x[(x - 0).abs() < 1e-3] = 0.5
+    x[(x - 1).abs() < 1e-3] = 0.5
+    x.requires_grad_()
+    assert torch.equal(relu1(x).detach(), x.detach().clamp(0, 1)), 'relu1 forward does not match clamp'
+    assert torch.autograd.gradcheck(lambda t: relu1(t), (x,)), 'relu1 gradcheck failed'
+    assert torch.autograd.gradcheck(lambda t: relu1(t * 1, inplace=True), (x,)), 'relu1 (inplace) gradcheck failed'
+
+
+def measure_peak_memory_mb(device, step):
+    """
+    :return peak memory (MB) of step(): the peak allocated CUDA memory, on the CPU the peak resident memory of the
+            process above its resident memory before the step (sampled with psutil)
+    """
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+        step()
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    import psutil
+    process = psutil.Process()
+    baseline = process.memory_info().rss
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.005):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        step()
+    finally:
+        done.set()
+        sampler.join()
+    return (max(peak[0], process.memory_info().rss) - baseline) / 2 ** 20
+
+
+if __name__ == '__main__':
+    check_relu1()
+    print('relu1 forward and gradcheck: OK')
+
+    # ---- peak memory and step time of the auto-encoders that use it
+    from Config import BASIC_AE, AE_RESNET18
+    from AEClassifierModels import BasicAutoEncoder, AE_Resnet18
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    for name, model in [(BASIC_AE, BasicAutoEncoder()), (AE_RESNET18, AE_Resnet18(14, False))]:
+        model = model.to(device)
+        x = torch.rand(4, 1, 896, 896, device=device)
+
+        def step():
+            outputs = model(x)
+            loss = sum(output.float().mean() for output in outputs)
+            loss.backward()
+
+        s = time.time()
+        peak_mb = measure_peak_memory_mb(device, step)
+        print('{}: peak memory {:.0f} MB, forward+backward {:.3f} sec (batch 4, 896x896)'.format(
+            name, peak_mb, time.time() - s))
+        del model, x
@@ -0,0 +1,185 @@
+"""
+Out-of-process validation: the trainer hands a snapshot of the weights to an evaluator process (with its own model,
+DataLoader and threads) and continues training, the validation results are fed back to the scheduler and the
+best-checkpoint logic when they arrive (one epoch late, or after a bounded wait).
+"""
+import atexit
+import copy
+import os
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing
+
+# seconds between the checks that the evaluator process is alive while a result is waited for
+POLL_INTERVAL = 1.0
+
+
+def validation_worker(settings, request_queue, result_queue):
+    """
+    Evaluator process: validate every received snapshot, until None is received.
+    """
+    try:
+        from ModelTrainer import ModelTrainer
+        from DataLoaderFactory import DataLoaderFactory
+        data_loader_factory = DataLoaderFactory(settings['num_workers'])
+        torch.set_num_threads(settings['num_threads'])
+        # the weights come from the snapshots, no need to load the pre-trained backbone
+        trainer = ModelTrainer(settings['device'], settings['architecture_type'], settings['num_of_input_channels'],
+                               False, settings['num_classes'], settings['balanced_classifier_loss'],
+                               settings['run_parameters'])
+        data_loaders = {}
+        parent_pid = os.getppid()
+        while True:
+            try:
+                request = request_queue.get(timeout=10)
+            except queue.Empty:
+                if os.getppid() != parent_pid:  # the trainer is gone
+                    break
+                continue
+            if request is None:
+                break
+            epoch_id, state_dict, stage, trans_resize_size, trans_crop_size = request
+            trainer.model.load_state_dict(state_dict)
+            trainer.set_stage(stage)
+            key = (trans_resize_size, trans_crop_size)
+            if key not in data_loaders:
+                _, transform_sequence = trainer.get_transforms(trans_resize_size, trans_crop_size, None)
+                dataset = trainer.build_dataset(settings['path_img_dir'], settings['path_file_validation'],
+                                                transform_sequence, use_image_cache=False)
+                data_loaders[key] = data_loader_factory.create(dataset, settings['batch_size'], shuffle=False)
+            trainer.num_sample_per_label_val = data_loaders[key].dataset.num_sample_per_label
+            s = time.time()
+            loss_validation, loss_validation_tensor, auroc_mean = trainer.epoch_validation(data_loaders[key])
+            result_queue.put((epoch_id, (loss_validation, float(loss_validation_tensor), auroc_mean,
+                                         time.time() - s)))
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
+
+
+class AsyncValidator:
+    # ---- trainer - the ModelTrainer whose model is validated
+    # ---- num_threads, num_workers - torch threads and DataLoader workers of the evaluator process
+    def __init__(self, trainer, path_img_dir, path_file_validation, batch_size, num_threads=1, num_workers=1):
+        self.trainer = trainer
+        settings = {'device': trainer.device,
+                    'architecture_type': trainer.architecture_type,
+                    'num_of_input_channels': trainer.num_of_input_channels,
+                    'num_classes': trainer.num_classes,
+                    'balanced_classifier_loss': trainer.b_balanced_classifier_loss,
+                    'run_parameters': trainer.run_parameters,
+                    'path_img_dir': path_img_dir,
+                    'path_file_validation': path_file_validation,
+                    'batch_size': batch_size,
+                    'num_threads': num_threads,
+                    'num_workers': num_workers}
+        # spawn: the evaluator must not inherit the CUDA context (or the DataLoader workers) of the trainer
+        # not a daemon process: it starts its own DataLoader workers, it is stopped by close (also at exit)
+        context = torch.multiprocessing.get_context('spawn')
+        self.request_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.process = context.Process(target=validation_worker,
+                                       args=(settings, self.request_queue, self.result_queue))
+        self.process.start()
+        atexit.register(self.close)
+        self.pending = {}
+        self.ready = {}
+
+    def submit(self, epoch_id, trans_resize_size, trans_crop_size, optimizer=None, **epoch_info):
+        """
+        Snapshot the current weights and queue their validation.
+        :param optimizer - if not None, its state is snapshotted with the weights (returned as optimizer_state, the
+                           checkpoints of the validated weights are saved with it)
+        :param epoch_info - kept with the snapshot and returned with the result (e.g. the train loss)
+        """
+        state_dict = snapshot_state_dict(self.trainer.model.state_dict())
+        self.pending[epoch_id] = dict(epoch_info, state_dict=state_dict)
+        if optimizer is not None:
+            self.pending[epoch_id]['optimizer_state'] = snapshot_optimizer_state(optimizer)
+        self.request_queue.put((epoch_id, state_dict, self.trainer.stage, trans_resize_size, trans_crop_size))
+
+    def receive(self, timeout):
+        """
+        Receive one result. :return False if no result arrived within the timeout (None - until a result arrives)
+        Raises RuntimeError if the evaluator process died without a result (e.g. killed out of memory).
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        while True:
+            poll_timeout = POLL_INTERVAL if end_time is None else max(0, min(POLL_INTERVAL, end_time - time.time()))
+            try:
+                epoch_id, result = self.result_queue.get(timeout=poll_timeout)
+                break
+            except queue.Empty:
+                pass
+            if not self.process.is_alive():
+                # a result put just before the exit may still be in the pipe
+                try:
+                    epoch_id, result = self.result_queue.get(timeout=POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    raise RuntimeError('validation process exited (exit code {}) without a result'.format(
+                        self.process.exitcode))
+            if end_time is not None and time.time() >= end_time:
+                return False
+        if epoch_id is None:
+            raise RuntimeError('validation process failed:\n' + result)
+        self.ready[epoch_id] = result
+        return True
+
+    def get_results(self, wait_for=(), timeout=None):
+        """
+        :param wait_for - epochs whose results are waited for (at most timeout seconds, None - no limit)
+        :return list of (epoch id, (validation loss, loss value, AUROC mean, validation time), epoch info) of all
+                the received results, ordered by epoch
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        while any(epoch_id in self.pending and epoch_id not in self.ready for epoch_id in wait_for):
+            remaining = None if end_time is None else end_time - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            if not self.receive(remaining):
+                break
+        # collect the results that already arrived, without waiting
+        while len(self.pending) > len(self.ready) and self.receive(0):
+            pass
+        results = []
+        for epoch_id in sorted(self.ready):
+            results.append((epoch_id, self.ready.pop(epoch_id), self.pending.pop(epoch_id)))
+        return results
+
+    def get_all_results(self):
+        return self.get_results(wait_for=list(self.pending))
+
+    def close(self):
+        # a closed validator (and its trainer) is not kept alive until the exit (a sweep creates one per run)
+        atexit.unregister(self.close)
+        if not self.process.is_alive():
+            return
+        self.request_queue.put(None)
+        self.process.join(timeout=60)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def snapshot_state_dict(state_dict):
+    """
+    :return a CPU copy of the state dict (training continues to update the model tensors)
+    """
+    snapshot = type(state_dict)()
+    for key, value in state_dict.items():
+        snapshot[key] = value.detach().to('cpu', copy=True)
+    return snapshot
+
+
+def snapshot_optimizer_state(optimizer):
+    """
+    :return a CPU copy of the optimizer state dict (the moments of the snapshot weights)
+    """
+    state_dict = optimizer.state_dict()
+    state = {}
+    for key, param_state in state_dict['state'].items():
+        state[key] = {name: value.detach().to('cpu', copy=True) if torch.is_tensor(value) else copy.deepcopy(value)
+                      for name, value in param_state.items()}
+    return {'state': state, 'param_groups': copy.deepcopy(state_dict['param_groups'])}
@@ -2,25 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
-from torch.autograd import Function
-
-class Relu1(Function):
-
-    @staticmethod
-    def forward(ctx, input):
-        ctx.save_for_backward(input)
-        # print("fwd:", input[0])
-        return input.clamp(min=0, max=1)
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
-        grad_input = grad_output.clone()
-        grad_input[input < 0] *= 0.0
-        grad_input[input > 1] *= 0.0
-
-        return grad_input
-
 
 
 def weights_init_normal(m):
@@ -322,19 +303,19 @@ class AttentionUnet2D(nn.Module):
         filters = [int(x / self.feature_scale) for x in filters]
 
         # downsampling
-        # from 896x896xin -> 448x448x32/scale
+        # from HxWxin -> H/2xW/2x32/scale (default input size: 896x896 -> 448x448)
         self.conv1 = unetConv2(self.in_channels, filters[0], self.is_batchnorm)
         self.maxpool1 = nn.MaxPool2d(kernel_size=2)
 
-        # from 448x448x32/scale -> 224x224x64/scale
+        # from H/2xW/2x32/scale -> H/4xW/4x64/scale
         self.conv2 = unetConv2(filters[0], filters[1], self.is_batchnorm)
         self.maxpool2 = nn.MaxPool2d(kernel_size=2)
 
-        # 224x224x64/scale -> 224x224x128/scale
+        # H/4xW/4x64/scale -> H/4xW/4x128/scale
         self.in_center = unetConv2(filters[1], filters[2], self.is_batchnorm)
-        # 224x224x128/scale -> 224x224xin
+        # H/4xW/4x128/scale -> H/4xW/4xin
         self.center = nn.Sequential(nn.Conv2d(filters[2], in_channels, 3, 1, 1))
-        # 224x224xin -> 224x224x128/scale
+        # H/4xW/4xin -> H/4xW/4x128/scale
         self.out_center = unetConv2(in_channels, filters[2], self.is_batchnorm)
 
 
@@ -358,11 +339,11 @@ class AttentionUnet2D(nn.Module):
                 init_weights(m, init_type='kaiming')
 
     def forward(self, inputs):
-        # from 896x896 -> 448x448
+        # from HxW -> H/2xW/2
         conv1 = self.conv1(inputs)
         maxpool1 = self.maxpool1(conv1)
 
-        # from 448x448 -> 224x224
+        # from H/2xW/2 -> H/4xW/4
         conv2 = self.conv2(maxpool1)
         maxpool2 = self.maxpool2(conv2)
 
@@ -372,11 +353,11 @@ class AttentionUnet2D(nn.Module):
         out_center = self.out_center(center)
 
 
-        # attention upsample - from 224x224 to 448x448
+        # attention upsample - from H/4xW/4 to H/2xW/2
         atten_conv2, _ = self.attention2(conv2, out_center)
         up2 = self.up_concat2(atten_conv2, out_center)  # upsample center and concatenate with atten_conv2
 
-        # attention upsample - from 448x448 to 896x896
+        # attention upsample - from H/2xW/2 to HxW
         atten_conv1, _ = self.attention1(conv1, up2)
         up1 = self.up_concat1(atten_conv1, up2)  # upsample up2 and concatenate with atten_conv1
 
@@ -0,0 +1,96 @@
+"""
+uint8 input pipeline: the workers emit uint8 image tensors, the batch crosses the worker IPC and the host->device copy
+as uint8 (1 byte per pixel, and a single channel for the grayscale images), and the float conversion, the channel
+expansion and the normalization run on the compute device.
+
+- ToUint8Tensor replaces transforms.ToTensor at the end of the augmentations
+- the workers collate the batch into shared memory (default collate), the main process copies it into the next slot
+  of a reusable pinned ring buffer and transfers it with a single non-blocking copy (instead of the DataLoader
+  pin_memory thread, that allocates a new pinned batch every time)
+- DeviceNormalize converts the transferred batch to float on the device
+"""
+import numpy as np
+import torch
+
+
+class ToUint8Tensor(object):
+    """
+    Convert a PIL image to a uint8 CxHxW tensor (no scaling, same layout as transforms.ToTensor).
+    """
+    def __call__(self, pic):
+        image = np.array(pic, dtype=np.uint8, copy=True)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        return torch.from_numpy(image).permute(2, 0, 1).contiguous()
+
+
+class DeviceNormalize(object):
+    """
+    uint8 batch (on the device) -> float batch in [0, 1], expanded to num_output_chs channels and normalized.
+    :param normalization_vec - (mean, std) per channel, None - no normalization
+    """
+    def __init__(self, num_output_chs=1, normalization_vec=None):
+        self.num_output_chs = num_output_chs
+        self.normalization_vec = normalization_vec
+        self.mean = None
+        self.std = None
+
+    def __call__(self, batch):
+        batch = batch.float().div_(255)
+        if batch.shape[1] != self.num_output_chs:
+            batch = batch.expand(-1, self.num_output_chs, -1, -1)
+        if self.normalization_vec is not None:
+            if self.mean is None or self.mean.device != batch.device:
+                self.mean = torch.tensor(self.normalization_vec[0], device=batch.device).view(1, -1, 1, 1)
+                self.std = torch.tensor(self.normalization_vec[1], device=batch.device).view(1, -1, 1, 1)
+            batch = (batch - self.mean) / self.std
+        return batch
+
+
+class PinnedRingBuffer(object):
+    """
+    Reusable pinned host buffers for the host->device copy of the input batches.
+    A slot is reused only after the copy from it has finished (CUDA event), so num_slots batches can be in flight.
+    """
+    def __init__(self, num_slots=3):
+        self.num_slots = num_slots
+        self.slots = [None] * num_slots
+        self.events = [None] * num_slots
+        self.next_slot = 0
+        self.transferred_bytes = 0
+        self.num_batches = 0
+        self.dtype = None
+
+    def to_device(self, batch, device):
+        self.transferred_bytes += batch.element_size() * batch.nelement()
+        self.num_batches += 1
+        self.dtype = batch.dtype
+        if device.type != 'cuda':
+            return batch.to(device)
+
+        slot_id = self.next_slot
+        self.next_slot = (self.next_slot + 1) % self.num_slots
+        if self.events[slot_id] is not None:
+            self.events[slot_id].synchronize()
+        slot = self.slots[slot_id]
+        if slot is None or slot.dtype != batch.dtype or slot.nelement() < batch.nelement():
+            slot = torch.empty(batch.nelement(), dtype=batch.dtype).pin_memory()
+            self.slots[slot_id] = slot
+        pinned_batch = slot[:batch.nelement()].view(batch.shape)
+        pinned_batch.copy_(batch)
+        device_batch = pinned_batch.to(device, non_blocking=True)
+        self.events[slot_id] = torch.cuda.Event()
+        self.events[slot_id].record()
+        return device_batch
+
+    def get_stats(self):
+        """
+        :return mean size (MB) and dtype (None - no batch) of the transferred input batches since the last reset
+        """
+        mb_per_batch = self.transferred_bytes / self.num_batches / 2 ** 20 if self.num_batches > 0 else 0
+        return {'batches': self.num_batches, 'mb_per_batch': mb_per_batch, 'dtype': self.dtype}
+
+    def reset_stats(self):
+        self.transferred_bytes = 0
+        self.num_batches = 0
+        self.dtype = None
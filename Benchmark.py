@@ -0,0 +1,347 @@
+"""
+Benchmark suite for the classifier, auto-encoder and combined architectures.
+
+For every architecture and input size it measures:
+- number of parameters (total / trainable)
+- forward + backward (train step) throughput
+- inference latency at batch sizes 1, 8 and 32
+- peak memory (CUDA allocator peak on GPU, peak RSS of an isolated process on CPU)
+- DataLoader throughput and epoch boundary stall (first batch wait of the second epoch) with the training
+  augmentations of the architecture, on a small real split (*_small_for_check.txt) when the images exist, otherwise
+  on synthetic PNG files
+
+The results are written as a JSON report. Two reports can be compared with --compare to catch regressions:
+    python Benchmark.py --output bench_before.json
+    python Benchmark.py --output bench_after.json --compare bench_before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from Config import RESNET18, BASIC_AE, IMPROVED_AE, ATTENTION_AE, AE_RESNET18, IMPROVED_AE_RESNET18, \
+    ATTENTION_AE_RESNET18, NUM_CLASSES, PATH_IMG_DIR, DEFAULT_INPUT_SIZE
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ALL_ARCH = [RESNET18, BASIC_AE, IMPROVED_AE, ATTENTION_AE, AE_RESNET18, IMPROVED_AE_RESNET18, ATTENTION_AE_RESNET18]
+
+LATENCY_BATCH_SIZES = [1, 8, 32]
+PATH_FILE_BENCHMARK = os.path.join('.', 'Dataset_files', 'train_only_15_small_for_check.txt')
+REPORT_VERSION = 1
+
+# metrics checked by --compare, and whether higher is better
+COMPARED_METRICS = {'train_images_per_sec': True,
+                    'loader_images_per_sec': True,
+                    'loader_epoch_boundary_stall_sec': False,
+                    'peak_memory_mb': False,
+                    'loader_ipc_mb_per_batch': False,
+                    'num_parameters': False}
+
+
+def num_input_channels(architecture_type):
+    return 3 if architecture_type == RESNET18 else 1
+
+
+def peak_memory_mb(device):
+    import torch
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def timed_runs(func, warmup, iterations, device):
+    import torch
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(iterations):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        s = time.perf_counter()
+        func()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - s)
+    return np.array(times)
+
+
+def build_model_trainer(architecture_type, device):
+    from ModelTrainer import ModelTrainer
+    model_trainer = ModelTrainer(device, architecture_type, num_input_channels(architecture_type),
+                                 is_backbone_trained=False, num_classes=NUM_CLASSES, balanced_classifier_loss=False)
+    return model_trainer
+
+
+def benchmark_model(architecture_type, input_size, train_batch_size, warmup, iterations, device_name, seed):
+    """
+    Measure parameters, train step throughput, inference latency and peak memory of one architecture.
+    """
+    import torch
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    device = torch.device(device_name)
+    if device.type == 'cuda':
+        # reset_peak_memory_stats is not in torch 1.5
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+
+    model_trainer = build_model_trainer(architecture_type, device)
+    model = model_trainer.model
+    result = {'architecture': architecture_type,
+              'input_size': input_size,
+              'num_parameters': int(sum(p.numel() for p in model.parameters())),
+              'num_trainable_parameters': int(sum(p.numel() for p in model.parameters() if p.requires_grad))}
+
+    num_chs = num_input_channels(architecture_type)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    # ---- forward + backward + optimizer step
+    input_img = torch.rand(train_batch_size, num_chs, input_size, input_size)
+    target_label = (torch.rand(train_batch_size, NUM_CLASSES) > 0.8).float()
+    model.train()
+
+    def train_step():
+        loss_value, _, _ = model_trainer.run_batch(input_img, target_label, train=True)
+        optimizer.zero_grad()
+        loss_value.backward()
+        optimizer.step()
+
+    times = timed_runs(train_step, warmup, iterations, device)
+    result['train_batch_size'] = train_batch_size
+    result['train_step_ms'] = float(np.median(times) * 1000)
+    result['train_images_per_sec'] = float(train_batch_size / np.median(times))
+
+    # ---- inference latency
+    model.eval()
+    latency = {}
+    with torch.no_grad():
+        for batch_size in LATENCY_BATCH_SIZES:
+            input_img = torch.rand(batch_size, num_chs, input_size, input_size).to(device)
+            times = timed_runs(lambda: model(input_img), warmup, iterations, device)
+            latency[str(batch_size)] = {'batch_ms': float(np.median(times) * 1000),
+                                        'batch_ms_p90': float(np.percentile(times, 90) * 1000),
+                                        'image_ms': float(np.median(times) * 1000 / batch_size)}
+    result['inference_latency'] = latency
+    result['peak_memory_mb'] = peak_memory_mb(device)
+    return result
+
+
+def make_synthetic_images(path_dataset_file, path_img_dir, num_images, image_size=1024, seed=0):
+    """
+    Write random grayscale PNG files for the first num_images entries of a dataset file.
+    """
+    rng = np.random.RandomState(seed)
+    with open(path_dataset_file, 'r') as file_descriptor:
+        names = [line.split()[0] for line in file_descriptor if line.strip()][:num_images]
+    for name in names:
+        path = os.path.join(path_img_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.fromarray(rng.randint(0, 256, (image_size, image_size), dtype=np.uint8)).save(path)
+    return names
+
+
+def benchmark_data_loader(architecture_type, input_size, path_img_dir, path_dataset_file, batch_size, num_workers,
+                          num_batches, persistent_workers=True, uint8_transfer=True):
+    """
+    Measure the DataLoader throughput (images/sec) with the training augmentations of the architecture.
+    """
+    from torch.utils.data import Subset
+    from DataLoaderFactory import DataLoaderFactory
+    from DatasetGenerator import DatasetGenerator
+    from ModelTrainer import data_augmentations, get_input_settings
+
+    resize_size, crop_size, rotation_angle, _ = get_input_settings(architecture_type, input_size)
+    normalization_vec = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]) if architecture_type == RESNET18 else None
+    transform_sequence = data_augmentations(resize_size, crop_size, normalization_vec, rotation_angle,
+                                            num_output_chs=num_input_channels(architecture_type),
+                                            uint8_output=uint8_transfer)
+    with open(path_dataset_file, 'r') as file_descriptor:
+        num_labels = len(file_descriptor.readline().split()) - 1  # the *_15 files also have a "No Finding" label
+    dataset = DatasetGenerator(pathImageDirectory=path_img_dir, pathDatasetFile=path_dataset_file,
+                               transform=transform_sequence, num_img_chs=num_input_channels(architecture_type),
+                               num_labels=num_labels)
+    dataset = Subset(dataset, range(min(len(dataset), batch_size * num_batches)))
+    if len(dataset) == 0:
+        raise ValueError('no images to load from ' + path_dataset_file + ' (num_batches ' + str(num_batches) + ')')
+    data_loader = DataLoaderFactory(num_workers, persistent_workers=persistent_workers).create(dataset, batch_size,
+                                                                                              shuffle=False)
+
+    # two epochs: the first batch wait of the second epoch is the epoch boundary stall
+    first_batch_times = []
+    epoch_times = []
+    num_images = 0
+    for epoch_id in range(2):
+        s = time.perf_counter()
+        for batch_id, (input_img, _) in enumerate(data_loader):
+            if batch_id == 0:
+                first_batch_times.append(time.perf_counter() - s)
+            num_images += input_img.shape[0]
+        epoch_times.append(time.perf_counter() - s)
+    total_time = sum(epoch_times)
+    return {'loader_batch_size': batch_size,
+            'loader_num_workers': num_workers,
+            'loader_persistent_workers': persistent_workers,
+            'loader_uint8_transfer': uint8_transfer,
+            'loader_num_images': num_images,
+            'loader_first_batch_sec': first_batch_times[0],
+            'loader_epoch_boundary_stall_sec': first_batch_times[1],
+            'loader_images_per_sec': num_images / total_time if total_time > 0 else None,
+            'loader_bytes_per_image': int(np.prod(input_img.shape[1:]) * input_img.element_size()),
+            'loader_ipc_mb_per_batch': input_img.nelement() * input_img.element_size() / 2 ** 20}
+
+
+def run_isolated(func, *args):
+    """
+    Run func(*args) in a fresh process so the peak memory of every case is measured separately.
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def environment_info():
+    import torch
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'time': time.strftime('%d%m%Y-%H%M%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'num_threads': torch.get_num_threads(),
+            'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None}
+
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Print the cases whose metrics got worse than the baseline by more than tolerance (relative).
+    :return number of regressions found
+    """
+    baseline_cases = {(c['architecture'], c['input_size']): c for c in baseline['cases']}
+    num_regressions = 0
+    for case in report['cases']:
+        key = (case['architecture'], case['input_size'])
+        if key not in baseline_cases:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            new_value = case.get(metric)
+            old_value = baseline_cases[key].get(metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                num_regressions += 1
+                print('REGRESSION', key[0], key[1], metric, old_value, '->', new_value,
+                      '({:+.1f}%)'.format(100 * change))
+    print('compared to baseline commit', baseline['environment'].get('commit'), ':', num_regressions, 'regressions')
+    return num_regressions
+
+
+def run_benchmarks(args):
+    import torch
+    torch.set_num_threads(args.threads)
+    device_name = 'cuda:0' if torch.cuda.is_available() and not args.cpu else 'cpu'
+
+    path_img_dir = args.img_dir
+    synthetic_dir = None
+    with open(args.dataset_file, 'r') as file_descriptor:
+        first_image = file_descriptor.readline().split()[0]
+    if args.synthetic or not os.path.exists(os.path.join(path_img_dir, first_image)):
+        synthetic_dir = tempfile.mkdtemp(prefix='bench_images_')
+        make_synthetic_images(args.dataset_file, synthetic_dir, args.loader_batch_size * args.loader_batches)
+        path_img_dir = synthetic_dir
+
+    cases = []
+    try:
+        for architecture_type in args.archs:
+            input_sizes = args.input_sizes or [DEFAULT_INPUT_SIZE[architecture_type]]
+            for input_size in input_sizes:
+                print('benchmarking', architecture_type, 'input size', input_size)
+                model_args = (architecture_type, input_size, args.train_batch_size, args.warmup, args.iterations,
+                              device_name, args.seed)
+                if args.no_isolation:
+                    case = benchmark_model(*model_args)
+                else:
+                    case = run_isolated(benchmark_model, *model_args)
+                if args.loader_batches > 0:
+                    case.update(benchmark_data_loader(architecture_type, input_size, path_img_dir,
+                                                      args.dataset_file, args.loader_batch_size,
+                                                      args.num_workers, args.loader_batches,
+                                                      not args.no_persistent_workers,
+                                                      not args.float_transfer))
+                print(json.dumps(case))
+                cases.append(case)
+    finally:
+        if synthetic_dir is not None:
+            shutil.rmtree(synthetic_dir, ignore_errors=True)
+
+    return {'version': REPORT_VERSION,
+            'environment': environment_info(),
+            'settings': {'device': device_name, 'seed': args.seed, 'warmup': args.warmup,
+                         'iterations': args.iterations, 'train_batch_size': args.train_batch_size,
+                         'synthetic_images': synthetic_dir is not None, 'dataset_file': args.dataset_file},
+            'cases': cases}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AE_Classifier architectures')
+    parser.add_argument('--archs', nargs='+', default=ALL_ARCH, choices=ALL_ARCH)
+    parser.add_argument('--input-sizes', nargs='+', type=int, default=None,
+                        help='input sizes to benchmark (default: the training size of each architecture)')
+    parser.add_argument('--train-batch-size', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cpu', action='store_true', help='benchmark on CPU even if CUDA is available')
+    parser.add_argument('--no-isolation', action='store_true',
+                        help='run all cases in this process (peak memory is then cumulative)')
+    parser.add_argument('--img-dir', default=PATH_IMG_DIR)
+    parser.add_argument('--dataset-file', default=PATH_FILE_BENCHMARK)
+    parser.add_argument('--synthetic', action='store_true', help='always use synthetic images for the loader')
+    parser.add_argument('--loader-batch-size', type=int, default=8)
+    parser.add_argument('--loader-batches', type=int, default=4, help='0 to skip the DataLoader benchmark')
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--no-persistent-workers', action='store_true',
+                        help='re-create the DataLoader workers every epoch')
+    parser.add_argument('--float-transfer', action='store_true',
+                        help='loader workers emit float tensors (ToTensor) instead of uint8')
+    parser.add_argument('--output', default='benchmark_report.json')
+    parser.add_argument('--compare', default=None, help='baseline report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    with open(args.output, 'w') as file_descriptor:
+        json.dump(report, file_descriptor, indent=2, sort_keys=True)
+    print('report saved to', args.output)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as file_descriptor:
+            baseline = json.load(file_descriptor)
+        if compare_reports(report, baseline, args.tolerance) > 0:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Confidence-based cascade: every study is scored by a cheap model (e.g. RES-NET-18 at 224), and only the studies the
+cheap model is not confident about are escalated to the expensive model (e.g. ATTENTION-AE-RES-NET-18 at 896).
+
+The confidence thresholds are calibrated per class on the validation split: the cheap prediction of a class is
+confident if its probability is below the low threshold (at most miss_rate of the validation positives of the class
+are below it) or above the high threshold (at most miss_rate of the validation negatives are above it). A study is
+accepted when the predictions of all the classes are confident, otherwise the prediction of the expensive model is
+used. The escalated studies are read and decoded again at the input size of the expensive model, the accepted
+studies are only decoded at the (reduced) size of the cheap model.
+"""
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+from Config import *
+from CheckpointEvaluator import LoadedCheckpoint
+from ModelTrainer import get_pin_memory_args, get_data_loader_factory
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def calibrate_thresholds(probabilities, labels, miss_rate=0.01):
+    """
+    :param probabilities, labels - N x C cheap model probabilities and 0/1 labels of the validation split
+    :return per-class low and high thresholds (C arrays); a class without positives (negatives) in the split gets a
+            low (high) threshold that is never confident
+    """
+    num_classes = labels.shape[1]
+    low = np.zeros(num_classes)
+    high = np.ones(num_classes)
+    for class_idx in range(num_classes):
+        positives = probabilities[labels[:, class_idx] > 0, class_idx]
+        negatives = probabilities[labels[:, class_idx] == 0, class_idx]
+        if len(positives) > 0:
+            low[class_idx] = np.quantile(positives, miss_rate)
+        if len(negatives) > 0:
+            high[class_idx] = np.quantile(negatives, 1 - miss_rate)
+    return low, high
+
+
+class CascadePredictor:
+    # ---- path_cheap_checkpoint, path_full_checkpoint - checkpoints of the cheap and the expensive model, of any
+    # ---- architecture (read from the checkpoints)
+    # ---- miss_rate - fraction of the validation positives (negatives) of a class allowed in the confident
+    # ---- negative (positive) range of the cheap model
+    def __init__(self, device, path_cheap_checkpoint, path_full_checkpoint, miss_rate=0.01,
+                 balanced_classifier_loss=False, cheap_input_size=None, full_input_size=None):
+        self.device = device
+        self.miss_rate = miss_rate
+        self.cheap = LoadedCheckpoint(device, path_cheap_checkpoint, balanced_classifier_loss, cheap_input_size)
+        self.full = LoadedCheckpoint(device, path_full_checkpoint, balanced_classifier_loss, full_input_size)
+        for checkpoint in [self.cheap, self.full]:
+            if not checkpoint.trainer.has_classifier_output():
+                raise ValueError(checkpoint.architecture_type + ' has no classifier output')
+        self.low_thresholds = None
+        self.high_thresholds = None
+
+    def predict(self, checkpoint, path_img_dir, path_file, batch_size, indices=None):
+        """
+        :param indices - images of the split to predict, None - all of them
+        :return N x C probabilities, N x C labels (numpy arrays) and the model time (transfer + forward, sec)
+        """
+        dataset = checkpoint.trainer.build_dataset(path_img_dir, path_file, checkpoint.transform,
+                                                   use_image_cache=False)
+        if indices is not None:
+            dataset = Subset(dataset, indices)
+        probabilities = [np.zeros((0, NUM_CLASSES), dtype=np.float32)]
+        labels = [np.zeros((0, NUM_CLASSES), dtype=np.float32)]
+        if len(dataset) == 0:
+            return probabilities[0], labels[0], 0.0
+        data_loader = get_data_loader_factory().create(dataset, batch_size, shuffle=False, persistent_workers=False,
+                                                       **get_pin_memory_args())
+        model_time = 0
+        with torch.no_grad():
+            for input_img, target_label in data_loader:
+                synchronize(self.device)
+                s = time.time()
+                varOutput = checkpoint.trainer.model(checkpoint.trainer.input_to_device(input_img))
+                batch_probabilities = checkpoint.trainer.get_class_probabilities(varOutput).cpu()
+                model_time += time.time() - s
+                probabilities.append(batch_probabilities.numpy())
+                labels.append(target_label.numpy())
+        return np.concatenate(probabilities), np.concatenate(labels), model_time
+
+    def calibrate(self, path_img_dir, path_file_validation, batch_size):
+        probabilities, labels, _ = self.predict(self.cheap, path_img_dir, path_file_validation, batch_size)
+        self.low_thresholds, self.high_thresholds = calibrate_thresholds(probabilities, labels, self.miss_rate)
+        print('cascade thresholds (', len(labels), ' validation images, miss rate ', self.miss_rate, '):')
+        print('  low: ' + ' '.join('{:.3f}'.format(value) for value in self.low_thresholds))
+        print('  high: ' + ' '.join('{:.3f}'.format(value) for value in self.high_thresholds))
+        return self.low_thresholds, self.high_thresholds
+
+    def is_confident(self, probabilities):
+        """
+        :return for every study: True if the cheap predictions of all the classes are confident
+        """
+        if self.low_thresholds is None:
+            raise RuntimeError('the cascade is not calibrated, call calibrate first')
+        confident = (probabilities < self.low_thresholds) | (probabilities > self.high_thresholds)
+        return confident.all(1)
+
+    def compute_auroc_mean(self, labels, probabilities):
+        """
+        :return mean AUROC, with the scores used by ModelTrainer (mean of the class probabilities)
+        """
+        auroc = self.full.trainer.compute_AUROC(torch.from_numpy(labels), torch.from_numpy(probabilities.mean(1)))
+        return np.array(auroc).mean()
+
+    def evaluate(self, path_img_dir, path_file_test, cheap_batch_size, full_batch_size, compare_full=True):
+        """
+        Run the cascade on the test split.
+        :param compare_full - also run the expensive model on all the studies (AUROC and latency of the full model)
+        :return dict of the results: fraction escalated, AUROC mean of the cascade / cheap / full model and the
+                mean model time per study (ms) of the cascade / full model
+        """
+        s = time.time()
+        cheap_probabilities, labels, cheap_time = self.predict(self.cheap, path_img_dir, path_file_test,
+                                                               cheap_batch_size)
+        escalated = np.nonzero(~self.is_confident(cheap_probabilities))[0]
+        escalated_probabilities, _, escalated_time = self.predict(self.full, path_img_dir, path_file_test,
+                                                                  full_batch_size, escalated)
+        cascade_probabilities = cheap_probabilities.copy()
+        cascade_probabilities[escalated] = escalated_probabilities
+        num_studies = len(labels)
+        results = {'num_studies': num_studies,
+                   'fraction_escalated': len(escalated) / max(num_studies, 1),
+                   'auroc_mean_cascade': self.compute_auroc_mean(labels, cascade_probabilities),
+                   'auroc_mean_cheap': self.compute_auroc_mean(labels, cheap_probabilities),
+                   'ms_per_study_cascade': 1000 * (cheap_time + escalated_time) / max(num_studies, 1),
+                   'wall_time_cascade': time.time() - s}
+        if compare_full:
+            full_probabilities, _, full_time = self.predict(self.full, path_img_dir, path_file_test, full_batch_size)
+            results['auroc_mean_full'] = self.compute_auroc_mean(labels, full_probabilities)
+            results['ms_per_study_full'] = 1000 * full_time / max(num_studies, 1)
+
+        print('cascade {} -> {}: {} studies, {:.1%} escalated'.format(
+            self.cheap.architecture_type, self.full.architecture_type, num_studies, results['fraction_escalated']))
+        print('  AUROC mean: cascade {:.4f}, cheap model {:.4f}{}'.format(
+            results['auroc_mean_cascade'], results['auroc_mean_cheap'],
+            ', full model {:.4f}'.format(results['auroc_mean_full']) if compare_full else ''))
+        print('  model time per study: cascade {:.2f} ms{}'.format(
+            results['ms_per_study_cascade'],
+            ', full model {:.2f} ms'.format(results['ms_per_study_full']) if compare_full else ''))
+        return results
@@ -0,0 +1,265 @@
+"""
+Structured channel pruning: whole convolution channels are removed from the model (the convolution weights and the
+batch norm parameters are sliced), the result is a smaller dense model (not masked weights), so the latency drops on
+CPU too.
+
+Pruned channel groups (the channels that are produced and consumed inside a block, the shapes of the block inputs and
+outputs do not change):
+- ResNet18 (the classifier of all the architectures) - the channels between conv1 and conv2 of every BasicBlock
+- ImprovedAutoEncoder - the two hidden encoder convolutions
+- AttentionUnet2D - the channels between the convolutions of every unetConv2 and the intermediate channels
+  (theta / phi -> psi) of the attention gates
+The channels are ranked by the batch norm scale (|gamma|) when the group has a batch norm, otherwise by the L1 norm of
+the filters. After pruning the model is fine-tuned for a few epochs (ModelTrainer.epoch_train).
+
+A pruned checkpoint is marked with 'pruned': True; ModelTrainer shrinks its model to the shapes of the saved weights
+before loading them (shrink_to_state_dict).
+
+Latency / AUROC table of several sparsity levels:
+    python ChannelPruning.py --checkpoint m-RES-NET-18-<timestamp>.pth.tar --sparsity 0.25 0.5 0.75
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision.models.resnet import BasicBlock
+
+from AEClassifierModels import ImprovedAutoEncoder
+from AttentionUnetModel import unetConv2, _GridAttentionBlockND
+from CheckpointIndex import build_metadata, write_metadata
+
+
+class ChannelGroup:
+    """
+    Channels produced by the output modules (convolutions and their batch norm) and consumed by the input modules.
+    :param name - qualified name of the first output module (its weights in a state dict give the channel count)
+    """
+    def __init__(self, name, output_modules, input_modules):
+        self.name = name
+        self.output_modules = output_modules
+        self.input_modules = input_modules
+
+    def num_channels(self):
+        return self.output_modules[0].weight.shape[0]
+
+    def importance(self):
+        """
+        :return importance of every channel: |gamma| of the batch norm, or the (normalized) L1 norm of the filters
+        """
+        batch_norms = [module for module in self.output_modules if isinstance(module, nn.BatchNorm2d)]
+        if len(batch_norms) > 0:
+            return batch_norms[0].weight.detach().abs()
+        importance = 0
+        for module in self.output_modules:
+            filter_norms = module.weight.detach().abs().view(module.weight.shape[0], -1).sum(1)
+            importance = importance + filter_norms / filter_norms.mean().clamp(min=1e-12)
+        return importance
+
+    def prune(self, keep):
+        """
+        Keep only the channels keep (sorted indices), in place.
+        """
+        for module in self.output_modules:
+            select_output_channels(module, keep)
+        for module in self.input_modules:
+            select_input_channels(module, keep)
+
+
+def slice_parameter(parameter, dim, keep):
+    return nn.Parameter(parameter.detach().index_select(dim, keep).clone(), requires_grad=parameter.requires_grad)
+
+
+def select_output_channels(module, keep):
+    if isinstance(module, nn.Conv2d):
+        module.weight = slice_parameter(module.weight, 0, keep)
+        if module.bias is not None:
+            module.bias = slice_parameter(module.bias, 0, keep)
+        module.out_channels = len(keep)
+    elif isinstance(module, nn.BatchNorm2d):
+        module.weight = slice_parameter(module.weight, 0, keep)
+        module.bias = slice_parameter(module.bias, 0, keep)
+        module.running_mean = module.running_mean.index_select(0, keep).clone()
+        module.running_var = module.running_var.index_select(0, keep).clone()
+        module.num_features = len(keep)
+    else:
+        raise ValueError('can not prune the output channels of ' + type(module).__name__)
+
+
+def select_input_channels(module, keep):
+    if isinstance(module, nn.Conv2d) and module.groups == 1:
+        module.weight = slice_parameter(module.weight, 1, keep)
+        module.in_channels = len(keep)
+    else:
+        raise ValueError('can not prune the input channels of ' + type(module).__name__)
+
+
+def get_channel_groups(model):
+    """
+    :return the prunable channel groups of the model (any model that contains the supported blocks)
+    """
+    groups = []
+    for name, module in model.named_modules():
+        prefix = name + '.' if name else ''
+        if isinstance(module, BasicBlock):
+            groups.append(ChannelGroup(prefix + 'conv1', [module.conv1, module.bn1], [module.conv2]))
+        elif isinstance(module, ImprovedAutoEncoder):
+            groups.append(ChannelGroup(prefix + 'encoder.0', [module.encoder[0]], [module.encoder[2]]))
+            groups.append(ChannelGroup(prefix + 'encoder.2', [module.encoder[2]], [module.encoder[4]]))
+        elif isinstance(module, unetConv2):
+            for i in range(1, module.n):
+                conv = getattr(module, 'conv%d' % i)
+                next_conv = getattr(module, 'conv%d' % (i + 1))
+                output_modules = [layer for layer in conv if isinstance(layer, (nn.Conv2d, nn.BatchNorm2d))]
+                groups.append(ChannelGroup(prefix + 'conv%d.0' % i, output_modules, [next_conv[0]]))
+        elif isinstance(module, _GridAttentionBlockND) and module.dimension == 2:
+            groups.append(ChannelGroup(prefix + 'theta', [module.theta, module.phi], [module.psi]))
+    return groups
+
+
+def prune_model(model, sparsity):
+    """
+    Remove the sparsity fraction of the least important channels of every group (at least one channel is kept).
+    :return number of removed channels
+    """
+    num_removed = 0
+    for group in get_channel_groups(model):
+        num_channels = group.num_channels()
+        num_keep = max(1, int(round(num_channels * (1 - sparsity))))
+        if num_keep == num_channels:
+            continue
+        keep = torch.argsort(group.importance(), descending=True)[:num_keep].sort()[0]
+        group.prune(keep.to(group.output_modules[0].weight.device))
+        num_removed += num_channels - num_keep
+    return num_removed
+
+
+def shrink_to_state_dict(model, state_dict):
+    """
+    Shrink the channel groups of an unpruned model to the shapes of the (pruned) state dict, before loading it.
+    """
+    for group in get_channel_groups(model):
+        key = group.name + '.weight'
+        if key in state_dict and state_dict[key].shape[0] < group.num_channels():
+            group.prune(torch.arange(state_dict[key].shape[0], device=group.output_modules[0].weight.device))
+
+
+def count_parameters(model):
+    return int(sum(parameter.numel() for parameter in model.parameters()))
+
+
+def cpu_latency_ms(model, num_chs, input_size, batch_size=1, iterations=10):
+    """
+    :return median CPU latency (ms) of a forward of a copy of the model
+    """
+    from Benchmark import timed_runs
+    model = copy.deepcopy(model).to('cpu').eval()
+    x = torch.rand(batch_size, num_chs, input_size, input_size)
+    with torch.no_grad():
+        times = timed_runs(lambda: model(x), 1, iterations, torch.device('cpu'))
+    return 1000 * float(np.median(times))
+
+
+def pareto_front(rows):
+    """
+    :return for every row: True if no other row has both a lower latency and a higher score
+    """
+    return [not any(other['latency_ms'] < row['latency_ms'] and other['score'] > row['score']
+                    for other in rows) for row in rows]
+
+
+def prune_and_evaluate(path_checkpoint, sparsities, path_img_dir, path_file_train, path_file_validation, batch_size,
+                       finetune_epochs=1, input_size=None, balanced_classifier_loss=True, save=True):
+    """
+    Prune the checkpoint at every sparsity level (always from the original weights), fine-tune, and print the
+    latency / AUROC table (the Pareto optimal rows are marked).
+    :return list of dicts: sparsity, num_parameters, latency_ms (CPU, batch 1), auroc_mean (None for the
+            auto-encoders), loss_validation, score (AUROC mean, or minus the validation loss of the auto-encoders)
+            and the path of the pruned checkpoint
+    """
+    from Config import AE_ARCH
+    from CheckpointEvaluator import LoadedCheckpoint
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    checkpoint = LoadedCheckpoint(device, path_checkpoint, balanced_classifier_loss, input_size)
+    trainer = checkpoint.trainer
+    if checkpoint.architecture_type in AE_ARCH:
+        print('the auto-encoders have no AUROC, the table shows the validation loss')
+    original_model = copy.deepcopy(trainer.model)
+    rotation_angle = None
+    data_loader_train, data_loader_validation = trainer.get_data_loaders(
+        path_img_dir, path_file_train, path_file_validation, batch_size, checkpoint.trans_resize_size,
+        checkpoint.trans_crop_size, rotation_angle)
+    num_chs = trainer.num_of_input_channels
+
+    rows = []
+    for sparsity in [0] + [sparsity for sparsity in sparsities if sparsity > 0]:
+        trainer.model = copy.deepcopy(original_model)
+        num_removed = prune_model(trainer.model, sparsity)
+        if sparsity > 0:
+            optimizer = trainer.build_optimizer()
+            for epoch_id in range(finetune_epochs):
+                s = time.time()
+                trainer.epoch_train(epoch_id, data_loader_train, optimizer)
+                print('fine-tune epoch time: ', time.time() - s)
+        loss_validation, _, auroc_mean = trainer.epoch_validation(data_loader_validation)
+        row = {'sparsity': sparsity,
+               'removed_channels': num_removed,
+               'num_parameters': count_parameters(trainer.model),
+               'latency_ms': cpu_latency_ms(trainer.model, num_chs, checkpoint.trans_crop_size),
+               'auroc_mean': float(auroc_mean) if checkpoint.architecture_type not in AE_ARCH else None,
+               'loss_validation': loss_validation,
+               'path': None}
+        row['score'] = row['auroc_mean'] if row['auroc_mean'] is not None else -loss_validation
+        if save and sparsity > 0:
+            row['path'] = checkpoint.name + '-pruned-' + str(sparsity) + '.pth.tar'
+            torch.save({'model_type': checkpoint.architecture_type,
+                        'epoch': checkpoint.epoch,
+                        'state_dict': trainer.model.state_dict(),
+                        'best_loss': loss_validation,
+                        'optimizer': optimizer.state_dict(),
+                        'loss_train_list': [],
+                        'loss_validation_list': [],
+                        'run_parameters': trainer.run_parameters,
+                        'pruned': True,
+                        'sparsity': sparsity},
+                       row['path'])
+            write_metadata(row['path'], build_metadata(
+                checkpoint.architecture_type, checkpoint.epoch, optimizer, trainer.run_parameters, loss_validation,
+                loss_validation, row['auroc_mean'], [], [], input_size=checkpoint.trans_crop_size, pruned=True,
+                sparsity=sparsity, num_parameters=row['num_parameters'], latency_ms=row['latency_ms']))
+        rows.append(row)
+
+    is_pareto = pareto_front(rows)
+    score_name = 'AUROC' if checkpoint.architecture_type not in AE_ARCH else '-val loss'
+    print('\n{} channel pruning ({}x{}, CPU latency at batch 1):'.format(
+        checkpoint.architecture_type, checkpoint.trans_crop_size, checkpoint.trans_crop_size))
+    print('{:>8s} {:>10s} {:>12s} {:>10s} {:>10s} {:>10s}  pareto'.format(
+        'sparsity', 'channels-', 'parameters', 'ms', score_name, 'val loss'))
+    for row, pareto in zip(rows, is_pareto):
+        print('{:8.2f} {:10d} {:12d} {:10.1f} {:10.4f} {:10.4f}  {}'.format(
+            row['sparsity'], row['removed_channels'], row['num_parameters'], row['latency_ms'], row['score'],
+            row['loss_validation'], '*' if pareto else ''))
+    return rows
+
+
+def main():
+    from Config import PATH_IMG_DIR, PATH_FILE_TRAIN, PATH_FILE_VALIDATION
+    parser = argparse.ArgumentParser(description='Structured channel pruning: latency / AUROC table')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--sparsity', nargs='+', type=float, default=[0.25, 0.5, 0.75])
+    parser.add_argument('--finetune-epochs', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--input-size', type=int, default=None, help='crop size, default size of the architecture')
+    parser.add_argument('--img-dir', default=PATH_IMG_DIR)
+    parser.add_argument('--train-file', default=PATH_FILE_TRAIN)
+    parser.add_argument('--validation-file', default=PATH_FILE_VALIDATION)
+    parser.add_argument('--no-save', action='store_true', help='do not save the pruned checkpoints')
+    args = parser.parse_args()
+    prune_and_evaluate(args.checkpoint, args.sparsity, args.img_dir, args.train_file, args.validation_file,
+                       args.batch_size, args.finetune_epochs, args.input_size, save=not args.no_save)
+
+
+if __name__ == '__main__':
+    main()
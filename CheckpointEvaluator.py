@@ -0,0 +1,165 @@
+"""
+Evaluation of several checkpoints in one pass over the test split.
+
+The checkpoints are loaded together (one model each) and grouped by their input transform (resize and crop size, and
+with float transfer also the channels and the normalization). A single dataset decodes every test image once and
+applies the transform of each group (DatasetGenerator.MultiTransform), every batch is transferred to the device once
+per group and fed to all the models of the group. The per-model, per-class AUROC is printed in a single table.
+
+All the models are kept on the device during the pass: the number of checkpoints evaluated together is limited by the
+device memory (evaluate them in several calls otherwise).
+"""
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+
+from Config import *
+from DatasetGenerator import DatasetGenerator, MultiTransform
+from ModelTrainer import ModelTrainer, parameters, get_input_settings, load_model_weights, get_pin_memory_args, \
+    get_data_loader_factory
+
+
+def get_checkpoint_name(path_checkpoint):
+    """
+    :return file name of the checkpoint without the directory and the .pth.tar extension
+    """
+    name = path_checkpoint.replace('\\', '/').split('/')[-1]
+    return name[:name.find('.pth')] if '.pth' in name else name
+
+
+class LoadedCheckpoint:
+    # ---- path_checkpoint - checkpoint saved by ModelTrainer.train, its architecture is read from the checkpoint
+    # ---- input_size - crop size of the input image, None for the default size of the architecture
+    def __init__(self, device, path_checkpoint, balanced_classifier_loss=False, input_size=None):
+        self.path = path_checkpoint
+        self.name = get_checkpoint_name(path_checkpoint)
+        modelCheckpoint = torch.load(path_checkpoint, map_location=device)
+        self.architecture_type = modelCheckpoint['model_type']
+        self.epoch = modelCheckpoint.get('epoch', 0)
+        run_parameters = modelCheckpoint.get('run_parameters', parameters())
+        param_group = modelCheckpoint['optimizer']['param_groups'][0] if 'optimizer' in modelCheckpoint else {}
+        self.weight_decay = param_group.get('weight_decay', run_parameters.weight_decay)
+        self.lr = param_group.get('lr', run_parameters.lr)
+        self.trans_resize_size, self.trans_crop_size, _, num_of_input_channels = get_input_settings(
+            self.architecture_type, input_size)
+        # the weights come from the checkpoint, no need to load the pre-trained backbone
+        self.trainer = ModelTrainer(device, self.architecture_type, num_of_input_channels, False, NUM_CLASSES,
+                                    balanced_classifier_loss, run_parameters)
+        load_model_weights(self.trainer.model, modelCheckpoint)
+        self.trainer.model.eval()
+        # the checkpoint (and its optimizer state) is not kept: the best one is copied by path
+        del modelCheckpoint
+        _, self.transform = self.trainer.get_transforms(self.trans_resize_size, self.trans_crop_size, None)
+
+    def get_group_key(self):
+        """
+        :return key of the models that share the input batches: the uint8 batches are converted (expanded and
+                normalized) on the device by each model, the float batches are already normalized for the model
+        """
+        if UINT8_TRANSFER:
+            return self.trans_resize_size, self.trans_crop_size
+        return (self.trans_resize_size, self.trans_crop_size, self.trainer.num_of_input_channels,
+                self.architecture_type == RESNET18)
+
+    def to_model_input(self, device_batch):
+        if self.trainer.device_transform is None:
+            return device_batch
+        return self.trainer.device_transform(device_batch)
+
+
+def group_checkpoints(checkpoints):
+    """
+    :return OrderedDict: group key -> the checkpoints with that input transform
+    """
+    groups = OrderedDict()
+    for checkpoint in checkpoints:
+        groups.setdefault(checkpoint.get_group_key(), []).append(checkpoint)
+    return groups
+
+
+def print_auroc_table(results, num_images):
+    print('\nTest AUROC ({} images), per class:'.format(num_images))
+    name_width = max([len(result['name']) for result in results] + [10])
+    print('{:{}s} {:>8s} {:>8s} '.format('checkpoint', name_width, 'loss', 'mean') +
+          ' '.join('{:>6s}'.format('c' + str(class_idx)) for class_idx in range(NUM_CLASSES)))
+    for result in results:
+        if result['auroc'] is None:
+            print('{:{}s} {:8.4f} {:>8s}'.format(result['name'], name_width, result['loss'], 'n/a'))
+            continue
+        print('{:{}s} {:8.4f} {:8.4f} '.format(result['name'], name_width, result['loss'], result['auroc_mean']) +
+              ' '.join('   n/a' if auroc < 0 else '{:6.3f}'.format(auroc) for auroc in result['auroc']))
+
+
+def evaluate_checkpoints(device, path_checkpoints, path_img_dir, path_file_test, batch_size,
+                         balanced_classifier_loss=False, input_size=None):
+    """
+    Evaluate all the checkpoints on the test split, decoding the images once.
+    :return list (in the order of path_checkpoints) of dicts: path, name, architecture_type, epoch, weight_decay, lr,
+            loss, auroc_mean and auroc (per-class list, -1 for classes with a single label value; None for the
+            auto-encoders)
+    """
+    cudnn.benchmark = True
+    checkpoints = [LoadedCheckpoint(device, path_checkpoint, balanced_classifier_loss, input_size)
+                   for path_checkpoint in path_checkpoints]
+    groups = group_checkpoints(checkpoints)
+    print('evaluating {} checkpoints in {} input groups'.format(len(checkpoints), len(groups)))
+
+    # the images are decoded at the largest size any of the groups needs (single channel, see DatasetGenerator)
+    transform = MultiTransform([group[0].transform for group in groups.values()])
+    dataset_test = DatasetGenerator(pathImageDirectory=path_img_dir, pathDatasetFile=path_file_test,
+                                    transform=transform, num_img_chs=1,
+                                    pathPyramidDirectory=PATH_PYRAMID_DIR, pyramid_levels=PYRAMID_LEVELS,
+                                    image_decoder=IMAGE_DECODER, reduced_decode=REDUCED_DECODE)
+    data_loader_test = get_data_loader_factory().create(dataset_test, batch_size, shuffle=False,
+                                                        persistent_workers=False, **get_pin_memory_args())
+
+    losses = {checkpoint.path: 0 for checkpoint in checkpoints}
+    predictions = {checkpoint.path: [] for checkpoint in checkpoints}
+    for checkpoint in checkpoints:
+        checkpoint.trainer.num_sample_per_label_val = dataset_test.num_sample_per_label
+    out_gt = []
+    num_batches = 0
+    s = time.time()
+    with torch.no_grad():
+        for batch_id, (group_inputs, target_label) in enumerate(data_loader_test):
+            if np.mod(batch_id, 10) == 0:
+                print('.', end="", flush=True)
+            target_label = target_label.to(device, non_blocking=True)
+            out_gt.append(target_label)
+            for input_img, group in zip(group_inputs, groups.values()):
+                # one host->device transfer per group, shared by its models
+                if UINT8_TRANSFER:
+                    device_batch = group[0].trainer.input_transfer.to_device(input_img, device)
+                else:
+                    device_batch = input_img.to(device)
+                for checkpoint in group:
+                    varInput = checkpoint.to_model_input(device_batch)
+                    varOutput = checkpoint.trainer.model(varInput)
+                    _, display_loss = checkpoint.trainer.loss(varOutput, target_label, varInput)
+                    losses[checkpoint.path] += display_loss
+                    if checkpoint.trainer.has_classifier_output():
+                        predictions[checkpoint.path].append(checkpoint.trainer.get_predictions(varOutput))
+            num_batches += 1
+    print('\ntest pass: {:.1f} sec, {} images'.format(time.time() - s, len(dataset_test)))
+
+    out_gt = torch.cat(out_gt, 0) if len(out_gt) > 0 else torch.FloatTensor()
+    results = []
+    for checkpoint in checkpoints:
+        result = {'path': checkpoint.path,
+                  'name': checkpoint.name,
+                  'architecture_type': checkpoint.architecture_type,
+                  'epoch': checkpoint.epoch,
+                  'weight_decay': checkpoint.weight_decay,
+                  'lr': checkpoint.lr,
+                  'loss': losses[checkpoint.path] / max(num_batches, 1),
+                  'auroc_mean': None,
+                  'auroc': None}
+        if checkpoint.trainer.has_classifier_output() and num_batches > 0:
+            result['auroc'] = checkpoint.trainer.compute_AUROC(out_gt, torch.cat(predictions[checkpoint.path], 0))
+            result['auroc_mean'] = np.array(result['auroc']).mean()
+        results.append(result)
+    print_auroc_table(results, len(dataset_test))
+    return results
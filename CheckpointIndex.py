@@ -0,0 +1,151 @@
+"""
+Checkpoint metadata index: every checkpoint saved by ModelTrainer.train (and ChannelPruning) gets a sidecar JSON file
+(<checkpoint>.json) with the architecture, run parameters, epoch, learning rate, weight decay, losses and validation
+AUROC; Runs.run_train adds the test results. The checkpoints of a directory can be listed and selected (e.g. the best
+validation AUROC) by reading the small JSON files only, without deserializing the weights and the optimizer state.
+
+A sidecar is ignored if the checkpoint file was modified after it was written (e.g. overwritten by another run).
+The validation metrics of a checkpoint validated on the validation subsample only (full_validation False) are not
+ranked with the full split values, and the _last checkpoints of the runs are ranked only when asked (include_last).
+    python CheckpointIndex.py --dir <checkpoints directory> --metric auroc_mean --top 5
+"""
+import argparse
+import json
+import os
+import time
+
+METADATA_SUFFIX = '.json'
+CHECKPOINT_SUFFIX = '.pth.tar'
+LAST_SUFFIX = '_last' + CHECKPOINT_SUFFIX
+# ---- metadata fields measured on the validation split (a subsample estimate when full_validation is False)
+VALIDATION_METRICS = ['auroc_mean', 'loss_validation']
+
+
+def get_metadata_path(path_checkpoint):
+    return path_checkpoint + METADATA_SUFFIX
+
+
+def build_metadata(architecture_type, epoch, optimizer, run_parameters, best_loss, loss_validation, auroc_mean,
+                   loss_train_list, loss_validation_list, full_validation=True, **extra):
+    """
+    :param loss_validation, auroc_mean - validation loss and AUROC mean of the saved weights (None if not validated
+                                         yet, the AUROC is None for the auto-encoders)
+    :param full_validation - False if they were measured on the validation subsample (run parameter
+                             validation_subsample)
+    :param extra - additional fields (e.g. the input size, the launch timestamp)
+    :return metadata dict of a checkpoint (JSON serializable)
+    """
+    param_group = optimizer.param_groups[0]
+    metadata = {'model_type': architecture_type,
+                'epoch': epoch,
+                'lr': param_group['lr'],
+                'weight_decay': param_group['weight_decay'],
+                'run_parameters': vars(run_parameters) if run_parameters is not None else None,
+                'best_loss': float(best_loss),
+                'loss_validation': None if loss_validation is None else float(loss_validation),
+                'auroc_mean': None if auroc_mean is None else float(auroc_mean),
+                'loss_train_list': [float(loss) for loss in loss_train_list],
+                'loss_validation_list': [float(loss) for loss in loss_validation_list],
+                'full_validation': full_validation,
+                'saved': time.strftime('%Y-%m-%d %H:%M:%S')}
+    metadata.update(extra)
+    return metadata
+
+
+def write_metadata(path_checkpoint, metadata):
+    """
+    Write the sidecar of a saved checkpoint (written to a temporary file and renamed).
+    """
+    metadata = dict(metadata, checkpoint_mtime=os.path.getmtime(path_checkpoint))
+    path_metadata = get_metadata_path(path_checkpoint)
+    path_tmp = path_metadata + '.tmp'
+    with open(path_tmp, 'w') as file_descriptor:
+        # the run parameters may hold values that are not JSON types (e.g. tuples are written as lists)
+        json.dump(metadata, file_descriptor, indent=1, default=str)
+    os.replace(path_tmp, path_metadata)
+
+
+def read_metadata(path_checkpoint):
+    """
+    :return metadata dict of the checkpoint (with its path), None if there is no up to date sidecar
+    """
+    path_metadata = get_metadata_path(path_checkpoint)
+    if not os.path.exists(path_metadata) or not os.path.exists(path_checkpoint):
+        return None
+    with open(path_metadata, 'r') as file_descriptor:
+        metadata = json.load(file_descriptor)
+    if metadata.get('checkpoint_mtime') != os.path.getmtime(path_checkpoint):
+        return None
+    metadata['path'] = path_checkpoint
+    return metadata
+
+
+def update_metadata(path_checkpoint, **fields):
+    """
+    Add fields (e.g. the test results) to the sidecar of the checkpoint, if it has one.
+    """
+    metadata = read_metadata(path_checkpoint)
+    if metadata is None:
+        return
+    metadata.pop('path')
+    metadata.update(fields)
+    write_metadata(path_checkpoint, metadata)
+
+
+def find_checkpoints(directory='.', architecture_type=None):
+    """
+    :return metadata of the checkpoints of the directory that have an up to date sidecar
+    """
+    checkpoints = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(CHECKPOINT_SUFFIX + METADATA_SUFFIX):
+            continue
+        metadata = read_metadata(os.path.join(directory, name[:-len(METADATA_SUFFIX)]))
+        if metadata is not None and (architecture_type is None or metadata['model_type'] == architecture_type):
+            checkpoints.append(metadata)
+    return checkpoints
+
+
+def best_checkpoints(directory='.', metric='auroc_mean', top=1, maximize=True, architecture_type=None,
+                     include_last=False):
+    """
+    :param metric - metadata field, e.g. auroc_mean (validation), test_auroc_mean, loss_validation
+    :param include_last - also rank the _last checkpoints of the runs (by default only their best checkpoints)
+    :return metadata of the top checkpoints by the metric (the checkpoints without the metric, and for the validation
+            metrics the checkpoints validated on the subsample only, are skipped)
+    """
+    checkpoints = [metadata for metadata in find_checkpoints(directory, architecture_type)
+                   if metadata.get(metric) is not None and (include_last or not metadata['path'].endswith(LAST_SUFFIX))
+                   and (metric not in VALIDATION_METRICS or metadata.get('full_validation', True))]
+    return sorted(checkpoints, key=lambda metadata: metadata[metric], reverse=maximize)[:top]
+
+
+def add_arguments(parser):
+    parser.add_argument('--dir', default='.')
+    parser.add_argument('--metric', default='auroc_mean')
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--minimize', action='store_true', help='lower is better (e.g. loss_validation)')
+    parser.add_argument('--architecture', default=None)
+    parser.add_argument('--include-last', action='store_true', help='also rank the _last checkpoints of the runs')
+
+
+def run(args):
+    s = time.time()
+    checkpoints = best_checkpoints(args.dir, args.metric, args.top, not args.minimize, args.architecture,
+                                   args.include_last)
+    print('{} checkpoints selected in {:.1f} ms'.format(len(checkpoints), 1000 * (time.time() - s)))
+    for metadata in checkpoints:
+        print('{} {} epoch {} lr {} weight decay {} {} {:.4f}'.format(
+            metadata['path'], metadata['model_type'], metadata['epoch'], metadata['lr'], metadata['weight_decay'],
+            args.metric, metadata[args.metric]))
+    return checkpoints
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Select checkpoints by their metadata')
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
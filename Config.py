@@ -1,19 +1,5 @@
-import numpy as np
-import time
-from collections import OrderedDict
-import torch
-import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
-import torch.optim as optim
-from torch.utils.data import DataLoader
-from torch.optim.lr_scheduler import ReduceLROnPlateau
-from sklearn.metrics import roc_auc_score
-from DatasetGenerator import DatasetGenerator
-import PIL
-import matplotlib.pyplot as plt
-import os
-import gc
-
+# ---- settings only: no imports, the command line (Main.py) and the light modules read the settings without loading
+# ---- torch / torchvision (each module imports the libraries it uses)
 
 RESNET18 = 'RES-NET-18'
 BASIC_AE = 'BASIC_AE'
@@ -27,8 +13,42 @@ AE_ARCH = [BASIC_AE, IMPROVED_AE, ATTENTION_AE]
 CLASSIFIER_ARCH = [RESNET18]
 DATA_PARALLEL = False
 NUM_CLASSES = 14
+# ---- DataLoader settings: NUM_WORKERS = None - one worker per core
+NUM_WORKERS = None
+PREFETCH_FACTOR = 2
+PERSISTENT_WORKERS = True
+# ---- shared cache of decoded images (SharedImageCache.py) in MB, allocated upfront, None - no cache
+IMAGE_CACHE_MB = None
+# ---- image decoder backend (ImageDecoders.py): 'pil', 'torchvision', 'opencv' or 'auto' (OpenCV if installed)
+IMAGE_DECODER = 'pil'
+# ---- decode at a reduced size (1/2, 1/4, 1/8) when the input is resized to a smaller size anyway
+REDUCED_DECODE = True
+# ---- the workers emit uint8 images, converted to float and normalized on the device (BatchTransfer.py)
+UINT8_TRANSFER = True
+# ---- evaluator process of the asynchronous validation (run parameter async_validation): threads and DataLoader workers
+ASYNC_VALIDATION_THREADS = 1
+ASYNC_VALIDATION_WORKERS = 1
+# ---- distillation (run parameter distillation_teacher): cache of the teacher probabilities and teacher batch size
+PATH_TEACHER_CACHE_DIR = r'.\teacher_cache'
+DISTILLATION_TEACHER_BATCH_SIZE = 32
+# ---- persistent store of the predictions (PredictionStore.py), keyed by image content hash and model checkpoint hash
+PATH_PREDICTION_STORE = r'.\prediction_store\predictions.sqlite'
+# ---- per-host profiles of the hardware tuner (HardwareTuner.py): batch sizes, DataLoader workers, torch threads
+PATH_HARDWARE_PROFILE_DIR = r'.\hardware_profiles'
+IMAGE_SIZE = 1024  # size of the Chest X-ray14 PNG files
+# default input size (after crop) of each architecture, the size used in the report
+DEFAULT_INPUT_SIZE = {RESNET18: 224,
+                      BASIC_AE: 128,
+                      IMPROVED_AE: 128,
+                      ATTENTION_AE: 128,
+                      AE_RESNET18: 896,
+                      IMPROVED_AE_RESNET18: 896,
+                      ATTENTION_AE_RESNET18: 896}
 
 PATH_IMG_DIR = r'.\database'
+# ---- multi-resolution cache of the database (built by PyramidCache.py), None to always decode the original images
+PATH_PYRAMID_DIR = r'.\database_pyramid'
+PYRAMID_LEVELS = [1024, 512, 256]
 PATH_FILE_TRAIN = r".\Dataset_files\train_1.txt"
 PATH_FILE_VALIDATION = r".\Dataset_files\val_1.txt"
 PATH_FILE_TEST = r'.\Dataset_files\test_1.txt'
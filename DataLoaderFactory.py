@@ -0,0 +1,103 @@
+"""
+DataLoader factory shared by the train / validation / test loops.
+
+- the number of workers is sized to the available cores, or read from the host profile of the hardware tuner (unless
+  set explicitly)
+- the workers are persistent and the loaders are cached by their settings, so the workers (and their copy of the
+  dataset) are created once and reused by the following epochs and by the following runs of a sweep in the same process
+- the number of batches prefetched by each worker is configurable
+persistent_workers / prefetch_factor need torch >= 1.7, on older versions the loaders are still cached and the
+workers are re-created every epoch as before.
+"""
+import inspect
+import os
+from collections import OrderedDict
+
+import torch
+from torch.utils.data import DataLoader
+
+from HardwareTuner import get_profile_value
+
+DATA_LOADER_ARGS = inspect.signature(DataLoader.__init__).parameters
+MAX_AUTO_WORKERS = 16
+
+
+def get_num_workers(num_workers=None):
+    """
+    :param num_workers - None for auto: the workers of the host profile (HardwareTuner.py) if the host was tuned,
+                         else get_default_num_workers
+    """
+    if num_workers is not None:
+        return num_workers
+    return get_profile_value('num_workers', default=get_default_num_workers())
+
+
+def get_default_num_workers():
+    """
+    :return one worker per available core, one core is left for the main process
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        num_cores = len(os.sched_getaffinity(0))
+    else:
+        num_cores = os.cpu_count() or 1
+    return max(0, min(num_cores - 1, MAX_AUTO_WORKERS))
+
+
+class DataLoaderFactory:
+
+    def __init__(self, num_workers=None, prefetch_factor=2, persistent_workers=True, pin_memory=None,
+                 max_cached_loaders=4):
+        self.num_workers = get_num_workers(num_workers)
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.max_cached_loaders = max_cached_loaders
+        self.loaders = OrderedDict()
+
+    def create(self, dataset, batch_size, shuffle, **kwargs):
+        """
+        Build a new (not cached) DataLoader with the factory settings.
+        """
+        loader_args = {'batch_size': batch_size, 'shuffle': shuffle, 'num_workers': self.num_workers,
+                       'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            if 'persistent_workers' in DATA_LOADER_ARGS:
+                loader_args['persistent_workers'] = self.persistent_workers
+            if 'prefetch_factor' in DATA_LOADER_ARGS:
+                loader_args['prefetch_factor'] = self.prefetch_factor
+        loader_args.update(kwargs)
+        return DataLoader(dataset=dataset, **loader_args)
+
+    def get(self, key, build_dataset, batch_size, shuffle, build_sampler=None, **kwargs):
+        """
+        :param key - hashable description of the dataset (file, transform settings, ...)
+        :param build_dataset - function that builds the dataset, called only if there is no cached loader
+        :param build_sampler - function that builds the sampler of the dataset (with shuffle=False, its settings
+                               must be in the key), None for the default sampler
+        :return a cached DataLoader for the key, or a new one
+        """
+        key = (key, batch_size, shuffle, tuple(sorted(kwargs.items())))
+        if key in self.loaders:
+            self.loaders.move_to_end(key)
+            return self.loaders[key]
+        dataset = build_dataset()
+        if build_sampler is not None:
+            kwargs['sampler'] = build_sampler(dataset)
+        data_loader = self.create(dataset, batch_size, shuffle, **kwargs)
+        self.loaders[key] = data_loader
+        while len(self.loaders) > self.max_cached_loaders:
+            _, old_loader = self.loaders.popitem(last=False)
+            shutdown_workers(old_loader)
+        return data_loader
+
+    def clear(self):
+        for data_loader in self.loaders.values():
+            shutdown_workers(data_loader)
+        self.loaders.clear()
+
+
+def shutdown_workers(data_loader):
+    iterator = getattr(data_loader, '_iterator', None)
+    if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+        iterator._shutdown_workers()
+        data_loader._iterator = None
@@ -0,0 +1,287 @@
+"""
+Download and extract the Chest X-ray14 images (12 tar.gz archives).
+
+- the archives are downloaded concurrently, every download resumes from its partial file (HTTP Range requests), a
+  download is complete only when its size matches the size reported by the source
+- the archives are verified against an MD5 checksum file (md5sum format), when given
+- every verified archive is extracted as a stream directly into <target dir>/images_0XX/ (no intermediate
+  "images" directory), optionally straight into the multi-resolution cache (PyramidCache.py)
+- extracted archives are marked, so running the tool again only fetches what is missing
+
+Offline / mirror mode: --mirror replaces the NIH links with <mirror>/<archive name>, where the mirror is a base URL
+(e.g. a local stand-in HTTP server: http://localhost:8000) or a local directory.
+
+Usage:
+    python DatasetFetcher.py --target-dir ./database --workers 4 --checksums ./database/checksums.md5
+    python DatasetFetcher.py --target-dir ./database --pyramid-dir ./database_pyramid --no-originals
+"""
+import argparse
+import hashlib
+import http.client
+import io
+import os
+import shutil
+import tarfile
+import time
+import urllib.error
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PIL import Image
+
+from PyramidCache import write_image_pyramid
+
+# URLs for the zip files
+LINKS = [
+    'https://nihcc.box.com/shared/static/vfk49d74nhbxq3nqjg0900w5nvkorp5c.gz',
+    'https://nihcc.box.com/shared/static/i28rlmbvmfjbl8p2n3ril0pptcmcu9d1.gz',
+    'https://nihcc.box.com/shared/static/f1t00wrtdk94satdfb9olcolqx20z2jp.gz',
+    'https://nihcc.box.com/shared/static/0aowwzs5lhjrceb3qp67ahp0rd1l1etg.gz',
+    'https://nihcc.box.com/shared/static/v5e3goj22zr6h8tzualxfsqlqaygfbsn.gz',
+    'https://nihcc.box.com/shared/static/asi7ikud9jwnkrnkj99jnpfkjdes7l6l.gz',
+    'https://nihcc.box.com/shared/static/jn1b4mw4n6lnh74ovmcjb8y48h8xj07n.gz',
+    'https://nihcc.box.com/shared/static/tvpxmn7qyrgl0w8wfh9kqfjskv6nmm1j.gz',
+    'https://nihcc.box.com/shared/static/upyy3ml7qdumlgk2rfcvlb9k6gvqq2pj.gz',
+    'https://nihcc.box.com/shared/static/l6nilvfa9cg3s28tqv1qc1olm3gnz54p.gz',
+    'https://nihcc.box.com/shared/static/hhq8fkdgvcari67vfhs7ppg2w6ni4jze.gz',
+    'https://nihcc.box.com/shared/static/ioqwiy20ihqwyr8pf4c24eazhh281pbu.gz'
+]
+
+CHUNK_SIZE = 1 << 20
+NUM_RETRIES = 5
+
+
+def archive_name(idx):
+    return 'images_0%02d.tar.gz' % (idx + 1)
+
+
+def archive_dir_name(idx):
+    return 'images_0%02d' % (idx + 1)
+
+
+def read_checksums(path_checksums):
+    """
+    :return dict of archive name -> MD5, from a file in md5sum format ("<md5>  <file name>" per line)
+    """
+    checksums = {}
+    if path_checksums is None:
+        return checksums
+    with open(path_checksums, 'r') as file_descriptor:
+        for line in file_descriptor:
+            line_items = line.split()
+            if len(line_items) >= 2:
+                checksums[os.path.basename(line_items[-1].lstrip('*'))] = line_items[0].lower()
+    return checksums
+
+
+def md5_of_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file_descriptor:
+        for chunk in iter(lambda: file_descriptor.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_total_size(url, error=None):
+    """
+    :param error - 416 (range not satisfiable) response of a Range request, its Content-Range is "bytes */<total>"
+    :return size of the file reported by the server (None if it is not reported)
+    """
+    if error is not None:
+        content_range = error.headers.get('Content-Range')
+        if content_range is not None and not content_range.endswith('/*'):
+            return int(content_range.rsplit('/', 1)[1])
+    with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=60) as response:
+        content_length = response.headers.get('Content-Length')
+    return None if content_length is None else int(content_length)
+
+
+def open_source(url, offset):
+    """
+    Open a download source from the given byte offset.
+    :return (stream, resumed, total size) - resumed is False if the source can only be read from the start, the total
+            size of the file is None if the source does not report it
+    """
+    if '://' not in url:
+        # local mirror directory
+        stream = open(url, 'rb')
+        stream.seek(offset)
+        return stream, True, os.fstat(stream.fileno()).st_size
+    request = urllib.request.Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as error:
+        if error.code == 416:
+            # range not satisfiable - the partial file is complete if its size is the size of the file
+            return io.BytesIO(b''), True, get_total_size(url, error)
+        raise
+    resumed = offset > 0 and response.getcode() == 206
+    total_size = None
+    content_range = response.headers.get('Content-Range')
+    content_length = response.headers.get('Content-Length')
+    if resumed and content_range is not None and not content_range.endswith('/*'):
+        # bytes <first>-<last>/<total>
+        total_size = int(content_range.rsplit('/', 1)[1])
+    elif content_length is not None:
+        total_size = int(content_length) + (offset if resumed else 0)
+    return response, resumed, total_size
+
+
+def download(url, path, log_prefix=''):
+    """
+    Download url to path, resuming from path + '.part' if it exists. The partial file is renamed only when its size
+    matches the total size reported by the source (a dropped connection is resumed by the next attempt).
+    """
+    path_part = path + '.part'
+    for attempt in range(NUM_RETRIES):
+        offset = os.path.getsize(path_part) if os.path.exists(path_part) else 0
+        try:
+            stream, resumed, total_size = open_source(url, offset)
+            with stream, open(path_part, 'ab' if resumed else 'wb') as file_descriptor:
+                if offset > 0:
+                    print(log_prefix, 'resuming from byte', offset if resumed else 0)
+                shutil.copyfileobj(stream, file_descriptor, CHUNK_SIZE)
+            size = os.path.getsize(path_part)
+            if total_size is not None and size > total_size:
+                # not a part of this file, the next attempt downloads it from the start
+                os.remove(path_part)
+                raise IOError('partial file larger than the file: {} of {} bytes'.format(size, total_size))
+            if total_size is not None and size != total_size:
+                raise IOError('incomplete download: {} of {} bytes'.format(size, total_size))
+            if total_size is None:
+                print(log_prefix, 'the source does not report the file size, the download size is not verified')
+            os.replace(path_part, path)
+            return
+        except (OSError, urllib.error.URLError, http.client.HTTPException) as error:
+            print(log_prefix, 'download failed (attempt', attempt + 1, '/', NUM_RETRIES, '):', error)
+            time.sleep(min(2 ** attempt, 30))
+    raise RuntimeError('could not download ' + url)
+
+
+def extract_archive(path_archive, path_target_dir, dir_name, path_pyramid_dir=None, pyramid_levels=None,
+                    keep_originals=True):
+    """
+    Stream the archive members directly into <path_target_dir>/<dir_name>/ and/or the pyramid cache.
+    :return number of extracted images
+    """
+    num_images = 0
+    with tarfile.open(path_archive, 'r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.lower().endswith('.png'):
+                continue
+            # only the file name is used, the archive directory ("images") is replaced by dir_name
+            image_name = os.path.join(dir_name, os.path.basename(member.name))
+            image_bytes = tar.extractfile(member).read()
+            if keep_originals:
+                path_image = os.path.join(path_target_dir, image_name)
+                with open(path_image + '.tmp', 'wb') as file_descriptor:
+                    file_descriptor.write(image_bytes)
+                os.replace(path_image + '.tmp', path_image)
+            if path_pyramid_dir is not None:
+                write_image_pyramid(Image.open(io.BytesIO(image_bytes)), path_pyramid_dir, pyramid_levels,
+                                    image_name)
+            num_images += 1
+    return num_images
+
+
+def fetch_archive(idx, url, args, checksums):
+    """
+    Download, verify and extract one archive (each step is skipped if it was already done).
+    """
+    name = archive_name(idx)
+    dir_name = archive_dir_name(idx)
+    log_prefix = '[' + name + ']'
+    path_done = os.path.join(args.target_dir, '.' + dir_name + '.extracted')
+    if os.path.exists(path_done):
+        print(log_prefix, 'already extracted')
+        return name, 0
+
+    path_archive = os.path.join(args.download_dir, name)
+    if not os.path.exists(path_archive):
+        print(log_prefix, 'downloading', url)
+        s = time.time()
+        download(url, path_archive, log_prefix)
+        size_mb = os.path.getsize(path_archive) / 2 ** 20
+        print(log_prefix, 'downloaded {:.1f} MB in {:.1f} sec'.format(size_mb, time.time() - s))
+
+    if name in checksums:
+        md5 = md5_of_file(path_archive)
+        if md5 != checksums[name]:
+            os.remove(path_archive)
+            raise RuntimeError(log_prefix + ' checksum mismatch (' + md5 + '), the archive was removed')
+        print(log_prefix, 'checksum OK')
+    elif len(checksums) > 0:
+        print(log_prefix, 'no checksum for this archive, not verified')
+
+    s = time.time()
+    if not args.no_originals:
+        os.makedirs(os.path.join(args.target_dir, dir_name), exist_ok=True)
+    try:
+        num_images = extract_archive(path_archive, args.target_dir, dir_name, args.pyramid_dir, args.levels,
+                                     keep_originals=not args.no_originals)
+    except (tarfile.TarError, EOFError, zlib.error) as error:
+        # a damaged archive is downloaded again by the next run (an OSError of the target, e.g. a full disk, is
+        # raised with the archive kept)
+        os.remove(path_archive)
+        raise RuntimeError(log_prefix + ' extraction failed (' + str(error) + '), the archive was removed')
+    print(log_prefix, 'extracted', num_images, 'images in {:.1f} sec'.format(time.time() - s))
+    open(path_done, 'w').close()
+    if not args.keep_archives:
+        os.remove(path_archive)
+    return name, num_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download and extract the Chest X-ray14 images')
+    parser.add_argument('--target-dir', default='database', help='extracted images: <target>/images_0XX/*.png')
+    parser.add_argument('--download-dir', default=None, help='archives location (default: the target dir)')
+    parser.add_argument('--workers', type=int, default=4, help='number of concurrent downloads')
+    parser.add_argument('--checksums', default=None, help='MD5 checksums of the archives (md5sum format)')
+    parser.add_argument('--mirror', default=None, help='base URL or local directory with the archives')
+    parser.add_argument('--archives', nargs='+', type=int, default=None,
+                        help='archive numbers to fetch (1-12, default: all)')
+    parser.add_argument('--pyramid-dir', default=None, help='also write the multi-resolution cache')
+    parser.add_argument('--levels', nargs='+', type=int, default=[1024, 512, 256])
+    parser.add_argument('--no-originals', action='store_true', help='write only the pyramid cache')
+    parser.add_argument('--keep-archives', action='store_true')
+    args = parser.parse_args()
+
+    if args.no_originals and args.pyramid_dir is None:
+        parser.error('--no-originals requires --pyramid-dir')
+    if args.download_dir is None:
+        args.download_dir = args.target_dir
+    os.makedirs(args.target_dir, exist_ok=True)
+    os.makedirs(args.download_dir, exist_ok=True)
+    checksums = read_checksums(args.checksums)
+
+    indices = range(len(LINKS)) if args.archives is None else [i - 1 for i in args.archives]
+    urls = {}
+    for idx in indices:
+        if args.mirror is None:
+            urls[idx] = LINKS[idx]
+        elif '://' in args.mirror:
+            urls[idx] = args.mirror.rstrip('/') + '/' + archive_name(idx)
+        else:
+            urls[idx] = os.path.join(args.mirror, archive_name(idx))
+
+    s = time.time()
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(fetch_archive, idx, url, args, checksums): idx for idx, url in urls.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                failed.append(archive_name(futures[future]))
+                print('[' + archive_name(futures[future]) + ']', 'failed:', error)
+    print('done in {:.1f} sec'.format(time.time() - s))
+    if len(failed) > 0:
+        print('failed archives (run again to resume):', ' '.join(sorted(failed)))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,21 +3,68 @@ import numpy as np
 from PIL import Image
 
 import torch
+import torchvision.transforms as transforms
 from torch.utils.data import Dataset
 
+from ImageDecoders import get_decoder
+from PyramidCache import pyramid_image_path, select_pyramid_level
+
+#-------------------------------------------------------------------------------- 
+
+class MultiTransform(object):
+    """
+    Apply several transforms to the same decoded image: the item is the tuple of their outputs (one input per model
+    group of the multi-checkpoint evaluation), the image is decoded once for all of them.
+    """
+    def __init__(self, transform_list):
+        self.transform_list = transform_list
+
+    def __call__(self, image):
+        return tuple(transform(image) for transform in self.transform_list)
+
+
+def required_image_size(transform):
+    """
+    :return minimal image size that gives the same transform result: the target of a leading Resize (the largest
+            one of a MultiTransform), None (full resolution) if the transform does not start with a resize
+    """
+    if isinstance(transform, MultiTransform):
+        sizes = [required_image_size(sub_transform) for sub_transform in transform.transform_list]
+        return None if len(sizes) == 0 or None in sizes else max(sizes)
+    transform_list = getattr(transform, 'transforms', [])
+    if len(transform_list) > 0 and isinstance(transform_list[0], transforms.Resize):
+        size = transform_list[0].size
+        return size if isinstance(size, int) else max(size)
+    return None
+
 #-------------------------------------------------------------------------------- 
 
 class DatasetGenerator (Dataset):
     
     #-------------------------------------------------------------------------------- 
     
-    def __init__ (self, pathImageDirectory, pathDatasetFile, transform, num_img_chs=1, num_labels=14):
+    # ---- pathPyramidDirectory - multi-resolution cache (PyramidCache.py), images are read from the smallest level
+    # ---- that satisfies the transform. None (or a missing directory) - always read the original images
+    # ---- image_decoder - decoder backend (ImageDecoders.py): 'pil', 'torchvision', 'opencv' or 'auto'
+    # ---- reduced_decode - decode at a reduced size (power of 2) when the transform starts with a smaller resize
+    def __init__ (self, pathImageDirectory, pathDatasetFile, transform, num_img_chs=1, num_labels=14,
+                  pathPyramidDirectory=None, pyramid_levels=None, image_decoder='pil', reduced_decode=True):
     
-        self.listImagePaths = []
-        self.listImageLabels = []
+        listImageNames = []
+        listImageLabels = []
+        self.pathImageDirectory = pathImageDirectory
+        if pathPyramidDirectory is not None and not os.path.isdir(pathPyramidDirectory):
+            pathPyramidDirectory = None
+        self.pathPyramidDirectory = pathPyramidDirectory
+        self.pyramid_levels = pyramid_levels
         self.transform = transform
         self.num_img_chs = num_img_chs
-        self.num_sample_per_label = [0] * num_labels
+        self.image_cache = None
+        self.cache_keys = None
+        self.image_decoder = get_decoder(image_decoder)
+        self.reduced_decode = reduced_decode
+        # ---- preallocated decode buffer, allocated by each worker on its first image
+        self.decode_buffer = None
 
 
         #---- Open file, get image paths and labels
@@ -36,31 +83,137 @@ class DatasetGenerator (Dataset):
           
                 lineItems = line.split()
                 
-                imagePath = os.path.join(pathImageDirectory, lineItems[0])
                 imageLabel = lineItems[1:]
                 imageLabel = [int(i) for i in imageLabel]
-                for label_idx, label in enumerate(imageLabel):
-                    self.num_sample_per_label[label_idx] += label
-                
-                self.listImagePaths.append(imagePath)
-                self.listImageLabels.append(imageLabel)   
+                if len(imageLabel) > num_labels:
+                    raise ValueError(pathDatasetFile + ' has ' + str(len(imageLabel)) + ' labels, expected ' +
+                                     str(num_labels))
+
+                listImageNames.append(lineItems[0].encode())
+                listImageLabels.append(imageLabel)   
             
         fileDescriptor.close()
+
+        #---- the index is kept in two shared memory tensors (instead of python lists of strings and lists): the
+        #---- DataLoader workers attach to them instead of copying (pickling) the lists, and forked workers do not
+        #---- touch (copy-on-write) millions of python objects
+        num_images = len(listImageNames)
+        max_name_len = max([len(name) for name in listImageNames] + [1])
+        image_names = np.array(listImageNames, dtype='S' + str(max_name_len)).view(np.uint8)
+        self.image_names = torch.from_numpy(image_names.reshape(num_images, max_name_len)).share_memory_()
+        image_labels = np.zeros((num_images, num_labels), dtype=np.uint8)
+        if num_images > 0:
+            image_labels[:, :len(listImageLabels[0])] = np.array(listImageLabels, dtype=np.uint8)
+        self.image_labels = torch.from_numpy(image_labels).share_memory_()
+        self.num_sample_per_label = [int(count) for count in image_labels.sum(0, dtype=np.int64)]
+        self.soft_labels = None
+
+    #-------------------------------------------------------------------------------- 
+
+    def get_image_name(self, index):
+        """
+        :return path of the image relative to the image directory (as in the dataset file)
+        """
+        return self.image_names[index].numpy().tobytes().rstrip(b'\0').decode()
+
+    #-------------------------------------------------------------------------------- 
     
+    def get_required_image_size(self):
+        """
+        :return minimal image size that gives the same transform result (required_image_size)
+        """
+        return required_image_size(self.transform)
+
+    def get_pyramid_level(self):
+        """
+        :return pyramid level the images are read from, None for the original images
+        """
+        if self.pathPyramidDirectory is None:
+            return None
+        return select_pyramid_level(self.pyramid_levels, self.get_required_image_size())
+
+    def get_image_path(self, index):
+        level = self.get_pyramid_level()
+        if level is not None:
+            imagePath = pyramid_image_path(self.pathPyramidDirectory, level, self.get_image_name(index))
+            if os.path.exists(imagePath):
+                return imagePath
+        return os.path.join(self.pathImageDirectory, self.get_image_name(index))
+
+    def get_decode_size(self):
+        """
+        :return minimal size of the decoded image, None for a full resolution decode
+        """
+        if not self.reduced_decode:
+            return None
+        return self.get_required_image_size()
+
+    def get_cache_variant(self):
+        """
+        :return id of the decoded image version: depends on the pyramid level it is read from and on the decode size
+        """
+        return (self.get_pyramid_level() or 0) << 16 | (self.get_decode_size() or 0)
+
+    def decode_image(self, index):
+        """
+        :return decoded 8-bit grayscale image (HxW array), in the preallocated decode buffer
+        """
+        image_array = self.image_decoder.decode(self.get_image_path(index), self.get_decode_size(),
+                                                self.decode_buffer)
+        if self.decode_buffer is None or image_array.size > self.decode_buffer.size:
+            self.decode_buffer = image_array.reshape(-1)
+        return image_array
+
+    def set_image_cache(self, image_cache):
+        """
+        Use a shared decoded-image cache (SharedImageCache), must be set before the DataLoader workers start.
+        """
+        self.cache_keys = image_cache.register([self.get_image_name(index) for index in range(len(self))])
+        self.image_cache = image_cache if self.cache_keys is not None else None
+
+    def set_soft_labels(self, soft_labels):
+        """
+        Per-image soft labels (e.g. the probabilities of a distillation teacher, N x C), appended to the labels of
+        every item: the label of an item is then the C labels followed by the C soft labels.
+        """
+        soft_labels = torch.as_tensor(np.asarray(soft_labels, dtype=np.float32))
+        if soft_labels.shape[0] != len(self):
+            raise ValueError('expected soft labels of ' + str(len(self)) + ' images, got ' + str(soft_labels.shape[0]))
+        self.soft_labels = soft_labels.share_memory_()
+
     #-------------------------------------------------------------------------------- 
     
     def __getitem__(self, index):
         
-        imagePath = self.listImagePaths[index]
+        image_array = None
+        if self.image_cache is not None:
+            cache_variant = self.get_cache_variant()
+            image_array = self.image_cache.get(int(self.cache_keys[index]), cache_variant)
 
-        if self.num_img_chs == 3:
-            imageData = Image.open(imagePath).convert('RGB')
-        else:
-            imageData = Image.open(imagePath).convert('L')
+        if image_array is None:
+            image_array = self.decode_image(index)
+
+            if self.image_cache is not None:
+                self.image_cache.put(int(self.cache_keys[index]), cache_variant, image_array)
 
-        imageLabel= torch.FloatTensor(self.listImageLabels[index])
+        #---- the image stays single-channel (grayscale) through the transform, the transform expands it to 3
+        #---- channels when the model needs them (data_augmentations)
+        imageData = Image.fromarray(image_array)
+        imageLabel= self.image_labels[index].float()
+        if self.soft_labels is not None:
+            imageLabel = torch.cat((imageLabel, self.soft_labels[index]))
         
-        if self.transform != None: imageData = self.transform(imageData)
+        if self.transform != None:
+            imageData = self.transform(imageData)
+            # uint8 images are expanded (and normalized) on the device, after the transfer
+            if self.num_img_chs == 3 and isinstance(imageData, torch.Tensor) and imageData.is_floating_point() \
+                    and imageData.shape[0] == 1:
+                imageData = imageData.expand(3, -1, -1)
+        elif self.num_img_chs == 3:
+            imageData = imageData.convert('RGB')
+        else:
+            # the image shares the decode buffer, that is reused by the next image
+            imageData = imageData.copy()
         
         return imageData, imageLabel
         
@@ -68,7 +221,7 @@ class DatasetGenerator (Dataset):
     
     def __len__(self):
         
-        return len(self.listImagePaths)
+        return len(self.image_names)
 
     def get_num_samples_in_label(self, label_idx):
         return self.num_sample_per_label[label_idx]
@@ -0,0 +1,140 @@
+"""
+Knowledge distillation: the soft per-class probabilities of a teacher checkpoint (e.g. ATTENTION-AE-RES-NET-18 at 896)
+supervise a faster student (e.g. RES-NET-18 at 224), mixed with the classifier loss of the student
+(run parameters distillation_teacher and distillation_weight).
+
+The teacher runs once per image (validation transform: no augmentation) and its probabilities are cached on disk,
+keyed by the image path of the dataset file, one cache file per teacher checkpoint and input size
+(PATH_TEACHER_CACHE_DIR in Config.py). The cache is filled incrementally: only the images that are not in the cache
+are run through the teacher, and the cache is rebuilt if the teacher checkpoint file changes.
+"""
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+from Config import PATH_TEACHER_CACHE_DIR, DISTILLATION_TEACHER_BATCH_SIZE, NUM_CLASSES
+
+
+def get_dataset_names(path_file):
+    """
+    :return image paths of the dataset file, in the order of the dataset
+    """
+    with open(path_file, 'r') as file_descriptor:
+        return [line.split()[0] for line in file_descriptor if line.strip()]
+
+
+class TeacherCache:
+    # ---- path_teacher_checkpoint - checkpoint of the teacher, its architecture is read from the checkpoint
+    # ---- input_size - crop size of the teacher input, None for the default size of its architecture
+    def __init__(self, device, path_teacher_checkpoint, input_size=None, path_cache_dir=PATH_TEACHER_CACHE_DIR,
+                 batch_size=DISTILLATION_TEACHER_BATCH_SIZE):
+        from CheckpointEvaluator import get_checkpoint_name
+        self.device = device
+        self.path_teacher_checkpoint = path_teacher_checkpoint
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.path_cache = os.path.join(path_cache_dir, get_checkpoint_name(path_teacher_checkpoint) + '-' +
+                                       str(input_size or 'default') + '.npz')
+        self.checkpoint_mtime = os.path.getmtime(path_teacher_checkpoint)
+        self.probabilities = self.load()
+
+    def load(self):
+        """
+        :return dict: image path -> teacher probabilities, empty if there is no valid cache file
+        """
+        if not os.path.exists(self.path_cache):
+            return {}
+        cache = np.load(self.path_cache)
+        if float(cache['checkpoint_mtime']) != self.checkpoint_mtime:
+            print('teacher checkpoint changed, the teacher cache is rebuilt: ', self.path_cache)
+            return {}
+        return dict(zip([name.decode() for name in cache['names']], cache['probabilities']))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path_cache) or '.', exist_ok=True)
+        names = list(self.probabilities)
+        probabilities = np.array([self.probabilities[name] for name in names], dtype=np.float32)
+        # written to a temporary file and renamed: an interrupted run does not leave a broken cache
+        path_tmp = self.path_cache + '.tmp.npz'
+        np.savez(path_tmp, names=np.array([name.encode() for name in names]),
+                 probabilities=probabilities.reshape(len(names), NUM_CLASSES),
+                 checkpoint_mtime=np.float64(self.checkpoint_mtime))
+        os.replace(path_tmp, self.path_cache)
+
+    def compute(self, path_img_dir, path_file, indices):
+        """
+        Run the teacher on the images (indices of the dataset file) and add their probabilities to the cache.
+        """
+        from CheckpointEvaluator import LoadedCheckpoint
+        from ModelTrainer import get_data_loader_factory, get_pin_memory_args
+        teacher = LoadedCheckpoint(self.device, self.path_teacher_checkpoint, input_size=self.input_size)
+        if not teacher.trainer.has_classifier_output():
+            raise ValueError(teacher.architecture_type + ' has no classifier output, can not be a teacher')
+        dataset = teacher.trainer.build_dataset(path_img_dir, path_file, teacher.transform, use_image_cache=False)
+        names = [dataset.get_image_name(index) for index in indices]
+        data_loader = get_data_loader_factory().create(Subset(dataset, indices), self.batch_size, shuffle=False,
+                                                       persistent_workers=False, **get_pin_memory_args())
+        print('computing the teacher probabilities of ', len(indices), ' images (', teacher.architecture_type, ')')
+        probabilities = []
+        with torch.no_grad():
+            for batch_id, (input_img, _) in enumerate(data_loader):
+                if np.mod(batch_id, 10) == 0:
+                    print('.', end="", flush=True)
+                varOutput = teacher.trainer.model(teacher.trainer.input_to_device(input_img))
+                probabilities.append(teacher.trainer.get_class_probabilities(varOutput).cpu().numpy())
+        print('')
+        for name, probability in zip(names, np.concatenate(probabilities)):
+            self.probabilities[name] = probability
+        self.save()
+
+    def get(self, path_img_dir, path_file):
+        """
+        :return N x C teacher probabilities of the images of the dataset file (in the dataset order)
+        """
+        names = get_dataset_names(path_file)
+        missing = [index for index, name in enumerate(names) if name not in self.probabilities]
+        if len(missing) > 0:
+            self.compute(path_img_dir, path_file, missing)
+        return np.stack([self.probabilities[name] for name in names]) if len(names) > 0 else \
+            np.zeros((0, NUM_CLASSES), dtype=np.float32)
+
+
+def compare_student(device, path_teacher_checkpoint, path_student_checkpoint, path_img_dir, path_file_test, batch_size,
+                    teacher_input_size=None, student_input_size=None, latency_batch_sizes=(1, 8)):
+    """
+    Print the AUROC gap between the student and the teacher on the test split (a single pass, CheckpointEvaluator)
+    and the inference latency of both.
+    :return dict: AUROC mean of the teacher / student and latency (ms per batch) per batch size
+    """
+    from CheckpointEvaluator import LoadedCheckpoint, evaluate_checkpoints
+    from Benchmark import timed_runs, num_input_channels
+    if teacher_input_size == student_input_size:
+        teacher_results, student_results = evaluate_checkpoints(
+            device, [path_teacher_checkpoint, path_student_checkpoint], path_img_dir, path_file_test, batch_size,
+            input_size=teacher_input_size)
+    else:
+        teacher_results = evaluate_checkpoints(device, [path_teacher_checkpoint], path_img_dir, path_file_test,
+                                               batch_size, input_size=teacher_input_size)[0]
+        student_results = evaluate_checkpoints(device, [path_student_checkpoint], path_img_dir, path_file_test,
+                                               batch_size, input_size=student_input_size)[0]
+    results = {'auroc_mean_teacher': teacher_results['auroc_mean'], 'auroc_mean_student': student_results['auroc_mean']}
+    for name, path_checkpoint, input_size in [('teacher', path_teacher_checkpoint, teacher_input_size),
+                                              ('student', path_student_checkpoint, student_input_size)]:
+        checkpoint = LoadedCheckpoint(device, path_checkpoint, input_size=input_size)
+        num_chs = num_input_channels(checkpoint.architecture_type)
+        for latency_batch_size in latency_batch_sizes:
+            x = torch.rand(latency_batch_size, num_chs, checkpoint.trans_crop_size, checkpoint.trans_crop_size,
+                           device=device)
+            with torch.no_grad():
+                times = timed_runs(lambda: checkpoint.trainer.model(x), 1, 5, device)
+            results['ms_' + name + '_batch_' + str(latency_batch_size)] = 1000 * float(np.median(times))
+    print('distillation: AUROC mean teacher {:.4f}, student {:.4f} (gap {:.4f})'.format(
+        results['auroc_mean_teacher'], results['auroc_mean_student'],
+        results['auroc_mean_teacher'] - results['auroc_mean_student']))
+    for latency_batch_size in latency_batch_sizes:
+        print('  latency batch {}: teacher {:.1f} ms, student {:.1f} ms'.format(
+            latency_batch_size, results['ms_teacher_batch_' + str(latency_batch_size)],
+            results['ms_student_batch_' + str(latency_batch_size)]))
+    return results
@@ -0,0 +1,323 @@
+"""
+Ensemble inference of several checkpoints of the same architecture (e.g. the outputs of a batch_run_train sweep).
+
+The parameters of the members are stacked into one model that evaluates all of them in a single forward: the members
+are laid out side by side along the channel dimension (member-major), every convolution becomes a grouped convolution
+(groups = members x groups), every batch norm a batch norm of the concatenated channels and every linear layer a
+batched matrix product. The input is repeated once per member. The member logits are combined by their mean, or by a
+weighted mean (e.g. weighted by the validation AUROC of every member).
+
+On GPU the stacked forward replaces N small kernel launches per layer by one; on CPU the grouped convolutions are
+slower than the separate convolutions, so by default the members are stacked only on GPU (build_ensemble).
+The stacked models are for inference only (eval mode). Models with layers that mix channels of different members
+(e.g. the concatenations of the attention U-Net) are not stacked: their members are run one after the other.
+
+Ensemble latency vs. number of members (stacked and sequential):
+    python EnsembleModels.py --architecture RES-NET-18 --members 1 2 4 8
+"""
+import abc
+import argparse
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision
+
+from ClassifierModels import Resnet18
+from AEClassifierModels import BasicAutoEncoder, ImprovedAutoEncoder, AutoEncoderClassifier
+from AttentionUnetModel import AttentionUnet2D
+
+# ---- modules without parameters of their own whose forward treats every channel (or every feature) separately:
+# ---- they can run the stacked members as they are
+CHANNEL_WISE_MODULES = (nn.Sequential, nn.ReLU, nn.ELU, nn.Sigmoid, nn.MaxPool2d, nn.AdaptiveAvgPool2d, nn.Dropout,
+                        nn.PixelShuffle, torchvision.models.resnet.BasicBlock, torchvision.models.resnet.ResNet,
+                        Resnet18, BasicAutoEncoder, ImprovedAutoEncoder)
+# ---- models without classifier logits (BASIC_AE, IMPROVED_AE, ATTENTION_AE): their (encoder, decoder) outputs are
+# ---- not combined
+AUTO_ENCODER_MODELS = (BasicAutoEncoder, ImprovedAutoEncoder, AttentionUnet2D)
+
+
+class StackedLinear(nn.Module):
+    """
+    Linear layers of the members: (batch, members x in features) -> (batch, members x out features).
+    """
+    def __init__(self, layers):
+        super(StackedLinear, self).__init__()
+        self.num_members = len(layers)
+        self.weight = nn.Parameter(torch.stack([layer.weight.detach() for layer in layers]))
+        if layers[0].bias is not None:
+            self.bias = nn.Parameter(torch.stack([layer.bias.detach() for layer in layers]))
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        x = x.view(x.shape[0], self.num_members, -1).transpose(0, 1)
+        # members x batch x out features
+        output = torch.bmm(x, self.weight.transpose(1, 2))
+        if self.bias is not None:
+            output = output + self.bias.unsqueeze(1)
+        return output.transpose(0, 1).reshape(x.shape[1], -1)
+
+
+def stack_conv2d(layers):
+    first = layers[0]
+    num_members = len(layers)
+    stacked = nn.Conv2d(first.in_channels * num_members, first.out_channels * num_members, first.kernel_size,
+                        stride=first.stride, padding=first.padding, dilation=first.dilation,
+                        groups=first.groups * num_members, bias=first.bias is not None,
+                        padding_mode=first.padding_mode)
+    stacked.weight.data.copy_(torch.cat([layer.weight.detach() for layer in layers]))
+    if first.bias is not None:
+        stacked.bias.data.copy_(torch.cat([layer.bias.detach() for layer in layers]))
+    return stacked.to(first.weight.device)
+
+
+def stack_batch_norm2d(layers):
+    first = layers[0]
+    if not first.track_running_stats:
+        raise ValueError('batch norm without running statistics can not be stacked')
+    stacked = nn.BatchNorm2d(first.num_features * len(layers), eps=first.eps, momentum=first.momentum,
+                             affine=first.affine)
+    if first.affine:
+        stacked.weight.data.copy_(torch.cat([layer.weight.detach() for layer in layers]))
+        stacked.bias.data.copy_(torch.cat([layer.bias.detach() for layer in layers]))
+    stacked.running_mean.copy_(torch.cat([layer.running_mean for layer in layers]))
+    stacked.running_var.copy_(torch.cat([layer.running_var for layer in layers]))
+    return stacked.to(first.running_mean.device)
+
+
+def stack_modules(modules):
+    """
+    :return one module that runs all the modules (same structure) side by side along the channel dimension
+    :raise ValueError if a module can not be stacked
+    """
+    first = modules[0]
+    if isinstance(first, nn.DataParallel):
+        return stack_modules([module.module for module in modules])
+    if any(type(module) != type(first) for module in modules):
+        raise ValueError('the members have different structures')
+    if isinstance(first, nn.Conv2d):
+        return stack_conv2d(modules)
+    if isinstance(first, nn.BatchNorm2d):
+        return stack_batch_norm2d(modules)
+    if isinstance(first, nn.Linear):
+        return StackedLinear(modules)
+    if not isinstance(first, CHANNEL_WISE_MODULES):
+        raise ValueError(type(first).__name__ + ' can not be stacked')
+    # shallow copy: the module keeps its settings (e.g. pooling sizes), its sub-modules are replaced
+    stacked = copy.copy(first)
+    stacked._modules = copy.copy(first._modules)
+    for name, child in first._modules.items():
+        if child is not None:
+            stacked._modules[name] = stack_modules([module._modules[name] for module in modules])
+    return stacked
+
+
+def get_member_weights(num_members, weights=None):
+    """
+    :return normalized weights of the members (the mean if weights is None)
+    """
+    if weights is None:
+        weights = np.ones(num_members)
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) != num_members or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError('expected ' + str(num_members) + ' non-negative member weights, got ' + str(weights))
+    return torch.tensor(weights / weights.sum(), dtype=torch.float32)
+
+
+def check_members(members):
+    """
+    :return True if the members are combined models (decoder outputs and classifier logits)
+    :raise ValueError for auto-encoder members (no classifier output)
+    """
+    member = members[0].module if isinstance(members[0], nn.DataParallel) else members[0]
+    if isinstance(member, AUTO_ENCODER_MODELS):
+        raise ValueError(type(member).__name__ + ' has no classifier output, it can not be an ensemble member')
+    return isinstance(member, AutoEncoderClassifier)
+
+
+class Ensemble(nn.Module, metaclass=abc.ABCMeta):
+    """
+    Base of the ensembles: combines the member outputs (same output format as a single member).
+    :raise ValueError for auto-encoder members (no classifier output)
+    """
+    def __init__(self, members, weights=None):
+        super(Ensemble, self).__init__()
+        self.is_combined = check_members(members)
+        self.num_members = len(members)
+        self.register_buffer('member_weights', get_member_weights(self.num_members, weights))
+
+    def combine(self, output):
+        """
+        :param output - batch x (members x channels) x ... member outputs
+        :return the weighted mean of the member outputs
+        """
+        output = output.view(output.shape[0], self.num_members, -1, *output.shape[2:])
+        weights = self.member_weights.view(1, self.num_members, *([1] * (output.dim() - 2)))
+        return (output * weights).sum(1)
+
+    @abc.abstractmethod
+    def member_outputs(self, x):
+        """
+        :return member outputs of the batch, batch x (members x channels) x ... (for the combined models:
+                decoder outputs, classifier logits)
+        """
+
+    def forward(self, x):
+        if self.is_combined:
+            decoder_output, logits = self.member_outputs(x)
+            return self.combine(decoder_output), self.combine(logits)
+        return self.combine(self.member_outputs(x))
+
+
+class StackedEnsemble(Ensemble):
+    """
+    All the members in a single forward (stack_modules).
+    """
+    def __init__(self, members, weights=None):
+        super(StackedEnsemble, self).__init__(members, weights)
+        if self.is_combined:
+            self.auto_encoder = stack_modules([member.auto_encoder for member in members])
+            self.classifier = stack_modules([member.classifier for member in members])
+            self.member_type = type(members[0])
+        else:
+            self.model = stack_modules(members)
+        self.eval()
+
+    def member_outputs(self, x):
+        x = x.repeat(1, self.num_members, 1, 1)
+        if not self.is_combined:
+            return self.model(x)
+        encoder_output, decoder_output = self.auto_encoder(x)
+        # the latent image of every member is normalized (broadcast to 3 channels) as in the member model
+        batch_size, num_chs, height, width = encoder_output.shape
+        latent_x = self.member_type.latent(self, encoder_output.reshape(batch_size * self.num_members,
+                                                                        num_chs // self.num_members, height, width))
+        latent_x = latent_x.reshape(batch_size, -1, height, width)
+        return decoder_output, self.classifier(latent_x)
+
+
+class SequentialEnsemble(Ensemble):
+    """
+    The members one after the other (models that can not be stacked).
+    """
+    def __init__(self, members, weights=None):
+        super(SequentialEnsemble, self).__init__(members, weights)
+        self.members = nn.ModuleList(members)
+        self.eval()
+
+    def member_outputs(self, x):
+        outputs = [member(x) for member in self.members]
+        if self.is_combined:
+            return torch.cat([output[0] for output in outputs], 1), torch.cat([output[1] for output in outputs], 1)
+        return torch.cat(outputs, 1)
+
+
+def build_ensemble(members, weights=None, stacked=None):
+    """
+    :param members - models of the same architecture (their weights are copied into the stacked model)
+    :param weights - weight of every member in the mean of the logits, None - plain mean
+    :param stacked - stack the members into a single forward when the architecture allows it. None - only on GPU:
+                     the grouped convolutions are slower than the separate ones on CPU (see the benchmark)
+    """
+    check_members(members)
+    if stacked is None:
+        stacked = next(members[0].parameters()).is_cuda
+    for member in members:
+        if isinstance(member, AutoEncoderClassifier):
+            member.set_stage('joint')
+        member.eval()
+    if stacked:
+        try:
+            return StackedEnsemble(members, weights)
+        except ValueError as error:
+            print('members are not stacked (', error, '), running them one after the other')
+    return SequentialEnsemble(members, weights)
+
+
+def load_ensemble(device, path_checkpoints, weights=None, balanced_classifier_loss=False, input_size=None,
+                  stacked=None):
+    """
+    :return ModelTrainer of the first checkpoint with the ensemble as its model (its test/validation methods evaluate
+            the ensemble), and the input resize and crop sizes
+    """
+    from CheckpointEvaluator import LoadedCheckpoint
+    checkpoints = [LoadedCheckpoint(device, path_checkpoint, balanced_classifier_loss, input_size)
+                   for path_checkpoint in path_checkpoints]
+    architecture_types = set(checkpoint.architecture_type for checkpoint in checkpoints)
+    if len(architecture_types) != 1:
+        raise ValueError('the ensemble members must have the same architecture, got ' + ', '.join(architecture_types))
+    trainer = checkpoints[0].trainer
+    if not trainer.has_classifier_output():
+        raise ValueError(checkpoints[0].architecture_type + ' has no classifier output')
+    trainer.model = build_ensemble([checkpoint.trainer.model for checkpoint in checkpoints], weights,
+                                   stacked).to(device)
+    return trainer, checkpoints[0].trans_resize_size, checkpoints[0].trans_crop_size
+
+
+def benchmark_ensemble(architecture_type, member_counts, batch_size, input_size, warmup, iterations, device):
+    """
+    Print the latency of the stacked and the sequential ensembles for every number of members (random weights).
+    """
+    from Benchmark import build_model_trainer, num_input_channels, timed_runs
+    from ModelTrainer import get_input_settings
+    _, crop_size, _, num_chs = get_input_settings(architecture_type, input_size)
+    x = torch.rand(batch_size, num_input_channels(architecture_type), crop_size, crop_size, device=device)
+    members = []
+    results = {}
+    for num_members in member_counts:
+        while len(members) < num_members:
+            members.append(build_model_trainer(architecture_type, device).model)
+        for stacked in [True, False]:
+            ensemble = build_ensemble(members[:num_members], stacked=stacked).to(device)
+            if stacked and not isinstance(ensemble, StackedEnsemble):
+                continue
+            with torch.no_grad():
+                times = timed_runs(lambda: ensemble(x), warmup, iterations, device)
+            results[(num_members, stacked)] = 1000 * np.median(times)
+        line = '{:2d} members: '.format(num_members)
+        for stacked, name in [(True, 'stacked'), (False, 'sequential')]:
+            if (num_members, stacked) in results:
+                line += '{} {:8.1f} ms ({:.2f}x 1 member)  '.format(
+                    name, results[(num_members, stacked)], results[(num_members, stacked)] / results[(1, False)])
+        print(line)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ensemble inference latency vs. number of members')
+    parser.add_argument('--architecture', default='RES-NET-18')
+    parser.add_argument('--members', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--input-size', type=int, default=None, help='crop size, default size of the architecture')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    # the stacked and the sequential ensembles give the same output
+    from Benchmark import build_model_trainer, num_input_channels
+    members = [build_model_trainer(args.architecture, device).model for _ in range(3)]
+    for member in members:
+        for module in member.modules():
+            if isinstance(module, nn.BatchNorm2d):  # non-trivial running statistics
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+    x = torch.rand(2, num_input_channels(args.architecture), 64, 64, device=device)
+    with torch.no_grad():
+        for weights in [None, [1, 2, 3]]:
+            stacked_output = build_ensemble(members, weights, stacked=True).to(device)(x)
+            sequential_output = build_ensemble(members, weights, stacked=False).to(device)(x)
+            if isinstance(stacked_output, tuple):
+                stacked_output, sequential_output = stacked_output[1], sequential_output[1]
+            print('weights', weights, ': max difference stacked / sequential {:.2e}'.format(
+                float((stacked_output - sequential_output).abs().max())))
+
+    benchmark_ensemble(args.architecture, args.members, args.batch_size, args.input_size, args.warmup,
+                       args.iterations, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Online hard-example mining (run parameter hard_example_mining), after hard_example_warmup epochs of uniform shuffle:
+
+- 'sampling' - loss-aware sampling: the train loss of every image is recorded (indexed by its dataset position, one
+  float32 per image), and every epoch draws hard_example_fraction of the images without replacement, with
+  probabilities proportional to their last loss (mixed with a uniform floor, so the easy images are still revisited).
+  The images that were not seen yet get the largest recorded loss.
+- 'top_k' - every batch is scored without gradients and only the hard_example_fraction images with the largest loss
+  run the forward and backward of the training step.
+"""
+import numpy as np
+import torch
+
+from TrainingResume import ResumableSampler
+
+HARD_EXAMPLE_SAMPLING = 'sampling'
+HARD_EXAMPLE_TOP_K = 'top_k'
+HARD_EXAMPLE_MODES = [HARD_EXAMPLE_SAMPLING, HARD_EXAMPLE_TOP_K]
+
+
+def check_hard_example_mode(mode):
+    if mode is not None and mode not in HARD_EXAMPLE_MODES:
+        raise ValueError('unknown hard example mining mode ' + str(mode) + ', select from: ' +
+                         ', '.join(HARD_EXAMPLE_MODES))
+
+
+class LossAwareSampler(ResumableSampler):
+    """
+    The position in the epoch and the recorded losses are saved in the resume checkpoints (TrainingResume.py).
+    :param num_samples - size of the dataset
+    :param fraction - fraction of the dataset drawn every epoch after the warm-up
+    :param warmup_epochs - epochs with the uniform shuffle of the whole dataset
+    :param uniform_weight - weight of the uniform distribution in the sampling probabilities
+    """
+    def __init__(self, num_samples, fraction=0.5, warmup_epochs=1, uniform_weight=0.1, seed=0):
+        super(LossAwareSampler, self).__init__(num_samples, seed)
+        self.fraction = fraction
+        self.warmup_epochs = warmup_epochs
+        self.uniform_weight = uniform_weight
+        self.losses = np.full(num_samples, np.nan, dtype=np.float32)
+        self.epoch = 0
+
+    def reset(self):
+        """
+        Forget the recorded losses (a new training run).
+        """
+        self.losses.fill(np.nan)
+        self.epoch = 0
+
+    def copy_losses(self, sampler):
+        """
+        Continue from the losses recorded by another sampler of the same dataset (e.g. at another input size).
+        """
+        if sampler.num_samples == self.num_samples:
+            self.losses[:] = sampler.losses
+
+    def set_epoch(self, epoch):
+        """
+        Select the epoch of the next iteration, must be called before the DataLoader iterates.
+        """
+        self.epoch = epoch
+
+    def is_uniform(self):
+        return self.epoch < self.warmup_epochs or np.isnan(self.losses).all()
+
+    def get_probabilities(self):
+        unseen = np.isnan(self.losses)
+        losses = np.where(unseen, np.nanmax(self.losses), self.losses) if unseen.any() else self.losses
+        losses = np.maximum(losses.astype(np.float64), 0)
+        if losses.sum() <= 0:
+            return np.full(self.num_samples, 1.0 / self.num_samples)
+        return (1 - self.uniform_weight) * losses / losses.sum() + self.uniform_weight / self.num_samples
+
+    def get_epoch_size(self):
+        if self.is_uniform():
+            return self.num_samples
+        return max(1, int(np.ceil(self.fraction * self.num_samples)))
+
+    def draw_indices(self):
+        if self.is_uniform():
+            return self.rng.permutation(self.num_samples)
+        return self.rng.choice(self.num_samples, self.get_epoch_size(), replace=False, p=self.get_probabilities())
+
+    def state_dict(self):
+        state = super(LossAwareSampler, self).state_dict()
+        state['losses'] = self.losses.copy()
+        return state
+
+    def load_state_dict(self, state, start=0):
+        super(LossAwareSampler, self).load_state_dict(state, start)
+        self.losses[:] = state['losses']
+
+    def record_losses(self, batch_id, batch_size, losses):
+        """
+        Record the per-image losses of a batch of the current epoch (the batches follow the order of the indices).
+        """
+        indices = self.epoch_indices[batch_id * batch_size:batch_id * batch_size + len(losses)]
+        self.losses[indices] = losses.detach().float().cpu().numpy()
+
+
+def select_hard_examples(per_sample_losses, fraction):
+    """
+    :return indices of the fraction of the batch with the largest losses (at least one)
+    """
+    num_hard = max(1, int(np.ceil(fraction * len(per_sample_losses))))
+    return torch.topk(per_sample_losses, num_hard, sorted=False)[1]
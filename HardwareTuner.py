@@ -0,0 +1,436 @@
+"""
+Hardware auto-tuner: probes the batch sizes, DataLoader workers and torch threads of the architectures on this machine
+with short timed runs, and writes a per-host profile (PATH_HARDWARE_PROFILE_DIR/<host name>.json) that the training
+and inference runs load automatically:
+- torch intra-op / inter-op threads (apply_thread_settings, called by the runs of Runs.py and PredictionStore.py)
+- DataLoader workers (DataLoaderFactory, when NUM_WORKERS in Config.py is None)
+- train and test batch sizes of every tuned architecture (Main.py train / sweep, run_test, run_cascade_test and
+  PredictionStore.py, when the batch size is not given), only for runs at the tuned input size
+
+The probes:
+1. threads - train step throughput of every thread setting at the default batch size
+2. batch sizes - train step and inference throughput of the candidate batch sizes (powers of 2), up to the largest
+   batch that fits in MEMORY_FRACTION of the memory (GPU memory, or RAM on CPU); the batch with the best throughput is
+   selected
+A tuned thread setting or batch size replaces the default only if it is MIN_GAIN faster.
+3. workers - DataLoader throughput with the train augmentations: the fewest workers that feed the tuned train step
+   with LOADER_HEADROOM to spare (the other cores are left to the compute threads)
+Every model probe runs in a fresh process (threads settings and peak memory of the probe only). The report compares
+the tuned settings with the defaults.
+    python HardwareTuner.py --archs RES-NET-18 ATTENTION-AE-RES-NET-18  (or: python Main.py tune ...)
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from Config import PATH_HARDWARE_PROFILE_DIR, COMBINED_ARCH, RESNET18, ATTENTION_AE_RESNET18, DEFAULT_INPUT_SIZE, \
+    PATH_IMG_DIR
+
+# ---- fraction of the memory the probed batches may use
+MEMORY_FRACTION = 0.8
+# ---- loader throughput needed vs. the train step throughput
+LOADER_HEADROOM = 1.2
+# ---- relative throughput gain a tuned setting needs over the default setting to replace it (timing noise)
+MIN_GAIN = 0.05
+# ---- messages of the RuntimeErrors of a failed allocation (the batch does not fit in memory)
+ALLOCATION_ERRORS = ['out of memory', "can't allocate memory", 'DefaultCPUAllocator']
+# ---- default train batch size (ModelTrainer.parameters)
+DEFAULT_TRAIN_BATCH_SIZE = 64
+# ---- profiles read by this process, by path
+loaded_profiles = {}
+
+
+def get_default_test_batch_size(architecture_type):
+    return 32 if architecture_type in COMBINED_ARCH else 1024
+
+
+def get_profile_path(path_profile_dir=PATH_HARDWARE_PROFILE_DIR):
+    return os.path.join(path_profile_dir, socket.gethostname() + '.json')
+
+
+def load_profile(path_profile=None):
+    """
+    :return profile dict of this host, None if the host was not tuned
+    """
+    path_profile = path_profile or get_profile_path()
+    if path_profile not in loaded_profiles:
+        profile = None
+        if os.path.exists(path_profile):
+            with open(path_profile, 'r') as file_descriptor:
+                profile = json.load(file_descriptor)
+        loaded_profiles[path_profile] = profile
+    return loaded_profiles[path_profile]
+
+
+def get_profile_value(name, architecture_type=None, default=None):
+    """
+    :param architecture_type - None for the host settings (threads, workers), else a setting of the architecture
+    :return the setting of the host profile, default if it is not in the profile
+    """
+    profile = load_profile()
+    if profile is None:
+        return default
+    if architecture_type is not None:
+        profile = profile['architectures'].get(architecture_type, {})
+    value = profile.get(name)
+    return default if value is None else value
+
+
+def get_profile_batch_size(mode, architecture_type, input_sizes=None, default=None):
+    """
+    :param mode - 'train' or 'test'
+    :param input_sizes - input sizes of the run (e.g. the sizes of a resize schedule), None entries (or None) - the
+                         default size of the architecture
+    :return batch size of the profile if it was tuned at the largest input size of the run (a batch tuned at a
+            smaller size may not fit in memory), else default
+    """
+    input_sizes = [input_size or DEFAULT_INPUT_SIZE[architecture_type] for input_size in (input_sizes or [None])]
+    if get_profile_value('input_size', architecture_type) != max(input_sizes):
+        return default
+    return get_profile_value(mode + '_batch_size', architecture_type, default)
+
+
+def set_threads(num_threads, num_interop_threads):
+    import torch
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # can be set only before the first inter-op parallel work of the process
+            print('inter-op threads already in use, not set to ', num_interop_threads)
+
+
+def apply_thread_settings():
+    """
+    Set the torch threads of the host profile (if any), at the start of a run.
+    """
+    set_threads(get_profile_value('num_threads'), get_profile_value('num_interop_threads'))
+
+
+def save_profile(profile, path_profile=None):
+    path_profile = path_profile or get_profile_path()
+    os.makedirs(os.path.dirname(path_profile) or '.', exist_ok=True)
+    path_tmp = path_profile + '.tmp'
+    with open(path_tmp, 'w') as file_descriptor:
+        json.dump(profile, file_descriptor, indent=1, sort_keys=True)
+    os.replace(path_tmp, path_profile)
+    loaded_profiles.pop(path_profile, None)
+
+
+def get_memory_limit_mb(device_name):
+    """
+    :return memory (MB) the probes may use, None if unknown (only the out of memory errors stop the batch probes)
+    """
+    if device_name.startswith('cuda'):
+        import torch
+        total_mb = torch.cuda.get_device_properties(0).total_memory / 2 ** 20
+    elif hasattr(os, 'sysconf') and 'SC_PHYS_PAGES' in os.sysconf_names:
+        total_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 20
+    else:
+        return None
+    return MEMORY_FRACTION * total_mb
+
+
+def is_allocation_error(error):
+    """
+    :return True if the RuntimeError is a failed allocation (CUDA: 'out of memory', CPU: "can't allocate memory" from
+            the DefaultCPUAllocator)
+    """
+    message = str(error)
+    return any(text in message for text in ALLOCATION_ERRORS)
+
+
+def probe_model(architecture_type, input_size, batch_size, num_threads, num_interop_threads, device_name, inference,
+                warmup, iterations):
+    """
+    Time the train step (or the inference) of a batch, in a fresh process.
+    :return dict: images_per_sec, peak_memory_mb; None if the batch does not fit in memory
+    """
+    import numpy as np
+    import torch
+    from Benchmark import build_model_trainer, timed_runs, peak_memory_mb, num_input_channels
+    set_threads(num_threads, num_interop_threads)
+    device = torch.device(device_name)
+    try:
+        model_trainer = build_model_trainer(architecture_type, device)
+        model = model_trainer.model
+        input_img = torch.rand(batch_size, num_input_channels(architecture_type), input_size, input_size)
+        if inference:
+            model.eval()
+            input_img = input_img.to(device)
+            with torch.no_grad():
+                times = timed_runs(lambda: model(input_img), warmup, iterations, device)
+        else:
+            target_label = (torch.rand(batch_size, model_trainer.num_classes) > 0.8).float()
+            optimizer = model_trainer.build_optimizer()
+            model.train()
+
+            def train_step():
+                loss_value, _, _ = model_trainer.run_batch(input_img, target_label, train=True)
+                optimizer.zero_grad()
+                loss_value.backward()
+                optimizer.step()
+
+            times = timed_runs(train_step, warmup, iterations, device)
+    except (MemoryError, RuntimeError) as error:
+        if isinstance(error, RuntimeError) and not is_allocation_error(error):
+            raise
+        return None
+    return {'images_per_sec': batch_size / float(np.median(times)), 'peak_memory_mb': peak_memory_mb(device)}
+
+
+class HardwareTuner:
+    # ---- device_name - 'cpu' or 'cuda:0'
+    # ---- warmup, iterations - untimed and timed steps of every probe (the median step time is used)
+    # ---- max_batch_size - largest candidate batch size (the default batch sizes are always candidates)
+    def __init__(self, device_name, warmup=1, iterations=3, max_batch_size=256, min_batch_size=4):
+        self.device_name = device_name
+        self.warmup = warmup
+        self.iterations = iterations
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.memory_limit_mb = get_memory_limit_mb(device_name)
+        self.num_cores = os.cpu_count() or 1
+
+    def probe(self, architecture_type, input_size, batch_size, num_threads, num_interop_threads, inference=False):
+        from Benchmark import run_isolated
+        s = time.time()
+        result = run_isolated(probe_model, architecture_type, input_size, batch_size, num_threads, num_interop_threads,
+                              self.device_name, inference, self.warmup, self.iterations)
+        if result is not None and self.memory_limit_mb is not None and result['peak_memory_mb'] is not None and \
+                result['peak_memory_mb'] > self.memory_limit_mb:
+            result = None
+        print('{} {} batch {:5d} threads {}/{}: {} ({:.1f} sec)'.format(
+            architecture_type, 'inference' if inference else 'train', batch_size, num_threads or 'default',
+            num_interop_threads or 'default', 'does not fit' if result is None else
+            '{:.1f} images/sec, peak memory {:.0f} MB'.format(result['images_per_sec'], result['peak_memory_mb'] or 0),
+            time.time() - s))
+        return result
+
+    def get_thread_candidates(self):
+        """
+        :return (intra-op, inter-op) thread settings, None - the torch default
+        """
+        intra_op = sorted({2 ** i for i in range(8) if 2 ** i <= self.num_cores} | {self.num_cores})
+        return [(None, None)] + [(num_threads, 1) for num_threads in intra_op] + [(self.num_cores, None)]
+
+    def tune_threads(self, architecture_types, input_sizes):
+        """
+        :return best (intra-op, inter-op) threads: the highest train throughput relative to the best setting of every
+                architecture, averaged over the architectures (the default if it is within MIN_GAIN)
+        """
+        if self.device_name.startswith('cuda'):
+            return None, None
+        candidates = self.get_thread_candidates()
+        scores = {candidate: [] for candidate in candidates}
+        for architecture_type in architecture_types:
+            batch_size = DEFAULT_TRAIN_BATCH_SIZE
+            results = {candidate: self.probe(architecture_type, input_sizes[architecture_type], batch_size, *candidate)
+                       for candidate in candidates}
+            if all(result is None for result in results.values()):
+                continue
+            best = max(result['images_per_sec'] for result in results.values() if result is not None)
+            for candidate, result in results.items():
+                scores[candidate].append(0 if result is None else result['images_per_sec'] / best)
+        best = max(candidates, key=lambda candidate: sum(scores[candidate]))
+        if sum(scores[best]) < (1 + MIN_GAIN) * sum(scores[(None, None)]):
+            return None, None
+        return best
+
+    def get_batch_size_candidates(self, default_batch_size):
+        """
+        :return powers of 2 up to max_batch_size, and up to the default batch size
+        """
+        max_batch_size = max(self.max_batch_size, default_batch_size)
+        return sorted({2 ** i for i in range(16) if self.min_batch_size <= 2 ** i <= max_batch_size} |
+                      {default_batch_size})
+
+    def tune_batch_size(self, architecture_type, input_size, num_threads, num_interop_threads, inference,
+                        default_batch_size):
+        """
+        Probe the candidate batch sizes (ascending) until a batch does not fit in memory.
+        :return dict: batch size -> probe result of the batches that fit
+        """
+        results = {}
+        for batch_size in self.get_batch_size_candidates(default_batch_size):
+            result = self.probe(architecture_type, input_size, batch_size, num_threads, num_interop_threads, inference)
+            if result is None:
+                break
+            results[batch_size] = result
+            if self.memory_limit_mb is not None and result['peak_memory_mb'] is not None and \
+                    2 * result['peak_memory_mb'] > self.memory_limit_mb:
+                # the next (double) batch would not fit: not probed, a probe over the RAM may get the process killed
+                break
+        return results
+
+    def probe_default(self, architecture_type, input_size, batch_size, results, inference, tuned_threads):
+        """
+        :param results - probe results of the batch sizes with the tuned threads
+        :return images/sec of the default batch size with the default threads, None if it does not fit
+        """
+        if batch_size not in results:
+            # did not fit with the tuned threads
+            return None
+        if tuned_threads == (None, None):
+            return results[batch_size]['images_per_sec']
+        result = self.probe(architecture_type, input_size, batch_size, None, None, inference)
+        return None if result is None else result['images_per_sec']
+
+    def tune_workers(self, architecture_type, input_size, path_img_dir, path_dataset_file, batch_size,
+                     required_images_per_sec, num_batches=4):
+        """
+        :return fewest workers whose loader throughput is at least required_images_per_sec (else the fastest), the
+                throughput of every worker count
+        """
+        from Benchmark import benchmark_data_loader
+        candidates = sorted({0} | {2 ** i for i in range(8) if 2 ** i < self.num_cores} |
+                            {max(0, self.num_cores - 1)})
+        results = {}
+        for num_workers in candidates:
+            results[num_workers] = benchmark_data_loader(architecture_type, input_size, path_img_dir,
+                                                         path_dataset_file, batch_size, num_workers,
+                                                         num_batches)['loader_images_per_sec']
+            print('{} loader workers {:3d}: {:.1f} images/sec'.format(architecture_type, num_workers,
+                                                                     results[num_workers]))
+        fast_enough = [num_workers for num_workers in candidates if results[num_workers] >= required_images_per_sec]
+        if len(fast_enough) > 0:
+            return min(fast_enough), results
+        return max(candidates, key=lambda num_workers: results[num_workers]), results
+
+    def tune(self, architecture_types, input_sizes=None, path_img_dir=PATH_IMG_DIR, path_dataset_file=None,
+             tune_workers=True):
+        """
+        :param input_sizes - dict: architecture -> crop size, default the training size of the architecture
+        :return profile dict of the host (the entries of the other architectures of an existing profile are kept)
+        """
+        import torch
+        from Benchmark import make_synthetic_images, PATH_FILE_BENCHMARK
+        from DataLoaderFactory import get_default_num_workers
+        input_sizes = input_sizes or {}
+        input_sizes = {architecture_type: input_sizes.get(architecture_type) or DEFAULT_INPUT_SIZE[architecture_type]
+                       for architecture_type in architecture_types}
+        profile = load_profile() or {'architectures': {}}
+        profile.update({'host': socket.gethostname(), 'tuned': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'torch': torch.__version__, 'cpu_count': self.num_cores, 'device': self.device_name,
+                        'memory_limit_mb': self.memory_limit_mb})
+
+        num_threads, num_interop_threads = self.tune_threads(architecture_types, input_sizes)
+        profile['num_threads'] = num_threads
+        profile['num_interop_threads'] = num_interop_threads
+        for architecture_type in architecture_types:
+            input_size = input_sizes[architecture_type]
+            settings = {'input_size': input_size}
+            for mode, inference, default_batch_size in [
+                    ('train', False, DEFAULT_TRAIN_BATCH_SIZE),
+                    ('test', True, get_default_test_batch_size(architecture_type))]:
+                results = self.tune_batch_size(architecture_type, input_size, num_threads, num_interop_threads,
+                                               inference, default_batch_size)
+                if len(results) == 0:
+                    print(architecture_type, mode, ': the smallest batch does not fit in memory')
+                    continue
+                batch_size = max(results, key=lambda candidate: results[candidate]['images_per_sec'])
+                if default_batch_size in results and results[batch_size]['images_per_sec'] < \
+                        (1 + MIN_GAIN) * results[default_batch_size]['images_per_sec']:
+                    batch_size = default_batch_size
+                settings[mode + '_batch_size'] = batch_size
+                settings['max_' + mode + '_batch_size'] = max(results)
+                settings[mode + '_images_per_sec'] = results[batch_size]['images_per_sec']
+                settings['default_' + mode + '_images_per_sec'] = self.probe_default(
+                    architecture_type, input_size, default_batch_size, results, inference,
+                    (num_threads, num_interop_threads))
+            profile['architectures'][architecture_type] = settings
+
+        if tune_workers:
+            path_dataset_file = path_dataset_file or PATH_FILE_BENCHMARK
+            architecture_type = architecture_types[0]
+            batch_size = min(profile['architectures'][architecture_type].get('train_batch_size',
+                                                                              DEFAULT_TRAIN_BATCH_SIZE), 16)
+            required = max(settings.get('train_images_per_sec', 0)
+                           for settings in profile['architectures'].values()) * LOADER_HEADROOM
+            synthetic_dir = None
+            with open(path_dataset_file, 'r') as file_descriptor:
+                first_image = file_descriptor.readline().split()[0]
+            if not os.path.exists(os.path.join(path_img_dir, first_image)):
+                synthetic_dir = tempfile.mkdtemp(prefix='tuner_images_')
+                make_synthetic_images(path_dataset_file, synthetic_dir, batch_size * 4)
+                path_img_dir = synthetic_dir
+            try:
+                num_workers, results = self.tune_workers(architecture_type, input_sizes[architecture_type],
+                                                         path_img_dir, path_dataset_file, batch_size, required)
+            finally:
+                if synthetic_dir is not None:
+                    shutil.rmtree(synthetic_dir, ignore_errors=True)
+            default_num_workers = get_default_num_workers()
+            profile['num_workers'] = num_workers
+            profile['loader_images_per_sec'] = results[num_workers]
+            profile['default_num_workers'] = default_num_workers
+            profile['default_loader_images_per_sec'] = results.get(default_num_workers)
+        return profile
+
+
+def format_gain(tuned, default):
+    if tuned is None:
+        return 'n/a'
+    if default is None:
+        return '{:.1f} (default does not fit)'.format(tuned)
+    return '{:.1f} vs {:.1f} ({:+.0f}%)'.format(tuned, default, 100 * (tuned / default - 1))
+
+
+def print_report(profile, architecture_types):
+    print('\nHardware profile of {} ({}, {} cores):'.format(profile['host'], profile['device'], profile['cpu_count']))
+    print('threads: {} intra-op, {} inter-op'.format(profile['num_threads'] or 'default',
+                                                     profile['num_interop_threads'] or 'default'))
+    if 'num_workers' in profile:
+        print('loader workers: {} (default {}), images/sec: {}'.format(
+            profile['num_workers'], profile['default_num_workers'],
+            format_gain(profile['loader_images_per_sec'], profile['default_loader_images_per_sec'])))
+    for architecture_type in architecture_types:
+        settings = profile['architectures'][architecture_type]
+        for mode in ['train', 'test']:
+            if mode + '_batch_size' not in settings:
+                continue
+            print('{} input {} {}: batch {} (max {}), images/sec: {}'.format(
+                architecture_type, settings['input_size'], mode, settings[mode + '_batch_size'],
+                settings['max_' + mode + '_batch_size'],
+                format_gain(settings[mode + '_images_per_sec'], settings['default_' + mode + '_images_per_sec'])))
+
+
+def add_arguments(parser):
+    parser.add_argument('--archs', nargs='+', default=[RESNET18, ATTENTION_AE_RESNET18])
+    parser.add_argument('--input-size', type=int, default=None, help='crop size, default size of every architecture')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--cpu', action='store_true', help='tune for the CPU even if CUDA is available')
+    parser.add_argument('--img-dir', default=PATH_IMG_DIR)
+    parser.add_argument('--dataset-file', default=None, help='images of the loader probe (default: the benchmark '
+                                                             'file, synthetic images if they do not exist)')
+    parser.add_argument('--no-workers', action='store_true', help='do not tune the DataLoader workers')
+
+
+def run(args):
+    import torch
+    device_name = 'cuda:0' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    tuner = HardwareTuner(device_name, args.warmup, args.iterations, args.max_batch_size)
+    input_sizes = {architecture_type: args.input_size for architecture_type in args.archs}
+    profile = tuner.tune(args.archs, input_sizes, args.img_dir, args.dataset_file, not args.no_workers)
+    save_profile(profile)
+    print_report(profile, args.archs)
+    print('profile saved to ', get_profile_path())
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the batch sizes, DataLoader workers and threads of this host')
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Image decoder backends: PIL, torchvision.io (decode_png on the raw bytes) and OpenCV (if installed).
+
+All the decoders return an 8-bit grayscale HxW array. When the caller only needs a smaller image (min_size), the
+decoders that support it decode at a reduced size (the largest power of 2 reduction that keeps the smaller edge at
+least min_size) instead of decoding the full 1024x1024 image and resizing it later.
+
+Per-backend decode benchmark:
+    python ImageDecoders.py --img-dir ./database --dataset-file ./Dataset_files/val_only_15_small_for_check.txt
+"""
+import argparse
+import os
+import struct
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+try:
+    from torchvision.io import decode_png  # torchvision >= 0.8
+except ImportError:
+    decode_png = None
+try:
+    from torchvision.io import ImageReadMode  # torchvision >= 0.10
+except ImportError:
+    ImageReadMode = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_size(data):
+    """
+    :return (width, height) from the PNG header, None if data is not a PNG file
+    """
+    if data[:8] != PNG_SIGNATURE:
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def get_reduce_factor(width, height, min_size, max_factor=8):
+    """
+    :return the largest power of 2 (up to max_factor) that keeps the smaller edge at least min_size
+    """
+    factor = 1
+    if min_size is None:
+        return factor
+    while factor < max_factor and min(width, height) // (factor * 2) >= min_size:
+        factor *= 2
+    return factor
+
+
+def copy_to_buffer(image, out):
+    """
+    Copy the decoded image into the preallocated array out, if it is large enough.
+    :return the image in out, or in a new (writable) array that can be used as the next buffer
+    """
+    if out is None or out.size < image.size:
+        if image.flags.writeable and image.flags.c_contiguous:
+            return image
+        return np.array(image, order='C')
+    result = out.reshape(-1)[:image.size].reshape(image.shape)
+    np.copyto(result, image)
+    return result
+
+
+class PILDecoder:
+    name = 'pil'
+
+    def decode(self, path, min_size=None, out=None):
+        image = Image.open(path)
+        factor = get_reduce_factor(image.size[0], image.size[1], min_size)
+        # some of the database images are RGBA
+        image = image.convert('L')
+        if factor > 1:
+            if hasattr(image, 'reduce'):  # Pillow >= 7
+                image = image.reduce(factor)
+            else:
+                image = image.resize((image.size[0] // factor, image.size[1] // factor), Image.BOX)
+        return copy_to_buffer(np.asarray(image), out)
+
+
+class TorchvisionDecoder:
+    """
+    torchvision.io.decode_png on the raw file bytes (torchvision >= 0.8), no reduced-size decode: the image is
+    reduced after the decode (average pooling) so the output matches the other decoders.
+    """
+    name = 'torchvision'
+
+    def __init__(self):
+        if decode_png is None:
+            raise ImportError('torchvision.io.decode_png needs torchvision >= 0.8')
+
+    def decode(self, path, min_size=None, out=None):
+        with open(path, 'rb') as file_descriptor:
+            encoded = torch.from_numpy(np.frombuffer(bytearray(file_descriptor.read()), dtype=np.uint8))
+        if ImageReadMode is not None:
+            image = decode_png(encoded, ImageReadMode.GRAY)
+        else:
+            image = decode_png(encoded)
+        if image.shape[0] != 1:
+            # RGB(A) file: ITU-R 601-2 luma, as PIL convert('L')
+            image = (image[0:1].float() * 0.299 + image[1:2].float() * 0.587 + image[2:3].float() * 0.114).round()
+        factor = get_reduce_factor(image.shape[2], image.shape[1], min_size)
+        if factor > 1:
+            image = torch.nn.functional.avg_pool2d(image.float().unsqueeze(0), factor)[0].round()
+        return copy_to_buffer(image[0].to(torch.uint8).numpy(), out)
+
+
+class OpenCVDecoder:
+    """
+    OpenCV decoder, uses the IMREAD_REDUCED_GRAYSCALE_2/4/8 flags for a reduced-size decode.
+    """
+    name = 'opencv'
+    REDUCED_FLAGS = {1: 'IMREAD_GRAYSCALE', 2: 'IMREAD_REDUCED_GRAYSCALE_2', 4: 'IMREAD_REDUCED_GRAYSCALE_4',
+                     8: 'IMREAD_REDUCED_GRAYSCALE_8'}
+
+    def __init__(self):
+        if cv2 is None:
+            raise ImportError('OpenCV (cv2) is not installed')
+
+    def decode(self, path, min_size=None, out=None):
+        with open(path, 'rb') as file_descriptor:
+            data = file_descriptor.read()
+        size = png_size(data)
+        factor = 1 if size is None else get_reduce_factor(size[0], size[1], min_size)
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), getattr(cv2, self.REDUCED_FLAGS[factor]))
+        if image is None:
+            raise IOError('could not decode ' + path)
+        return copy_to_buffer(image, out)
+
+
+DECODERS = {PILDecoder.name: PILDecoder,
+            TorchvisionDecoder.name: TorchvisionDecoder,
+            OpenCVDecoder.name: OpenCVDecoder}
+
+
+def get_decoder(name='pil'):
+    """
+    :param name - 'pil', 'torchvision', 'opencv' or 'auto' (OpenCV if installed, otherwise PIL)
+    """
+    if name == 'auto':
+        name = OpenCVDecoder.name if cv2 is not None else PILDecoder.name
+    if name not in DECODERS:
+        raise ValueError('unknown image decoder ' + str(name) + ', select from: ' + ', '.join(DECODERS))
+    return DECODERS[name]()
+
+
+def benchmark_decoders(image_paths, min_sizes, repeats=1):
+    """
+    Print the decode time (ms per image) of every available backend, for full and reduced-size decodes.
+    """
+    out = np.empty(4096 * 4096, dtype=np.uint8)
+    results = {}
+    for name in DECODERS:
+        try:
+            decoder = get_decoder(name)
+        except ImportError as error:
+            print(name, 'not available:', error)
+            continue
+        for min_size in min_sizes:
+            decoder.decode(image_paths[0], min_size, out)  # warm-up
+            s = time.perf_counter()
+            for _ in range(repeats):
+                for image_path in image_paths:
+                    image = decoder.decode(image_path, min_size, out)
+            ms_per_image = 1000 * (time.perf_counter() - s) / (repeats * len(image_paths))
+            results[(name, min_size)] = ms_per_image
+            print('{:12s} min size {:>5s}: {:7.2f} ms/image, output {}'.format(name, str(min_size), ms_per_image,
+                                                                                 image.shape))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image decoder backends')
+    parser.add_argument('--img-dir', default='database')
+    parser.add_argument('--dataset-file', default=os.path.join('Dataset_files', 'val_only_15_small_for_check.txt'))
+    parser.add_argument('--num-images', type=int, default=50)
+    parser.add_argument('--min-sizes', nargs='+', type=int, default=[0, 512, 256],
+                        help='required image sizes (0 - full resolution)')
+    parser.add_argument('--repeats', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.dataset_file, 'r') as file_descriptor:
+        names = [line.split()[0] for line in file_descriptor if line.strip()][:args.num_images]
+    image_paths = [os.path.join(args.img_dir, name) for name in names]
+    image_paths = [path for path in image_paths if os.path.exists(path)]
+    if len(image_paths) == 0:
+        print('no images found in', args.img_dir)
+        exit(1)
+    print('decoding', len(image_paths), 'images')
+    benchmark_decoders(image_paths, [size or None for size in args.min_sizes], args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,188 +1,196 @@
-from ModelTrainer import *
+"""
+Command line of the runs (Runs.py) and tools:
+    python Main.py train --architecture RES-NET-18 --lr 1e-4 --max-epoch 15
+    python Main.py sweep --lrs 1e-4 1e-5 --weight-decays 1e-4 1e-5 --max-epochs 15
+    python Main.py test --checkpoints m-RES-NET-18-<timestamp>.pth.tar  (or --checkpoint-dir <dir> --top 5)
+    python Main.py predict --checkpoint <checkpoint> --dataset-file <file>  (or --watch <folder>, PredictionStore.py)
+    python Main.py cascade --cheap <checkpoint> --full <checkpoint>
+    python Main.py checkpoints --dir <dir> --metric auroc_mean  (checkpoint metadata, CheckpointIndex.py)
+    python Main.py tune --archs RES-NET-18  (per-host batch sizes, workers and threads, HardwareTuner.py)
+    python Main.py plot --log m-RES-NET-18-<timestamp>.metrics.jsonl  (plots of the metrics log, MetricsLog.py)
+    python Main.py startup  (startup time of the light commands)
+Only the settings (Config.py) and the light modules are imported at startup: torch, the models and the datasets are
+imported by the commands that use them, so --help and the metadata commands start fast.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import CheckpointIndex
+import HardwareTuner
+import MetricsLog
+import PredictionStore
+from Config import *
+
+ALL_ARCH = CLASSIFIER_ARCH + AE_ARCH + COMBINED_ARCH
+# ---- startup time budget (sec) of the commands that do not load torch
+STARTUP_BUDGET = 0.5
+
+
+def schedule_arg(value_type):
+    """
+    :return argparse type of a schedule: "<first epoch>:<value>,..." -> [(first epoch, value), ...]
+    """
+    def schedule(text):
+        return [(int(epoch), value_type(value)) for epoch, value in (item.split(':') for item in text.split(','))]
+    return schedule
+
+
+def module_lr_arg(text):
+    """
+    "<module>:<lr>,..." -> {module: lr}
+    """
+    return {module: float(lr) for module, lr in (item.split(':') for item in text.split(','))}
+
+
+# ---- run parameters (ModelTrainer.parameters) of the train command, None - the default value
+RUN_PARAMETER_ARGS = [('lr', float), ('weight_decay', float), ('lambda_loss', float), ('decay_factor', float),
+                      ('decay_patience', int), ('batch_size', int), ('max_epoch', int), ('input_size', int),
+                      ('target_auroc', float), ('validation_subsample', float), ('full_validation_interval', int),
+                      ('distillation_teacher', str), ('distillation_weight', float), ('hard_example_fraction', float),
+                      ('hard_example_warmup', int), ('resume_checkpoint_interval', int), ('resume_checkpoint', str),
+                      ('resize_schedule', schedule_arg(int)), ('training_stages', schedule_arg(str)),
+                      ('module_lr', module_lr_arg), ('async_validation_wait', float), ('bootstrap_resamples', int),
+                      ('metrics_step_interval', int)]
+RUN_PARAMETER_HELP = {'resize_schedule': 'first epoch:input size,..., e.g. 0:448,10:896',
+                      'training_stages': 'first epoch:stage,..., e.g. 0:auto_encoder,5:frozen_encoder,15:joint',
+                      'module_lr': 'module:lr,..., e.g. auto_encoder:1e-5,classifier:1e-4'}
+
+
+def get_run_parameters(args):
+    from ModelTrainer import parameters
+    run_parameters = {name: getattr(args, name) for name, _ in RUN_PARAMETER_ARGS if getattr(args, name) is not None}
+    if 'batch_size' not in run_parameters:
+        # the train batch size of the host profile (HardwareTuner.py), if tuned at the input size of the run
+        batch_size = HardwareTuner.get_profile_batch_size('train', args.architecture, [args.input_size])
+        if batch_size is not None:
+            run_parameters['batch_size'] = batch_size
+    return parameters(async_validation=args.async_validation, hard_example_mining=args.hard_example_mining,
+                      **run_parameters)
+
+
+def train(args):
+    from Runs import run_train, run_hard_example_comparison
+    run_parameters = get_run_parameters(args)
+    if args.compare_hard_example_mining:
+        return run_hard_example_comparison(run_parameters, architecture_type=args.architecture)
+    return run_train(run_parameters, architecture_type=args.architecture)
+
+
+def sweep(args):
+    from Runs import batch_run_train
+    batch_sizes = args.batch_sizes or [HardwareTuner.get_profile_batch_size('train', args.architecture, default=32)]
+    batch_run_train(lrs=args.lrs, weight_decays=args.weight_decays, decay_patiences=args.decay_patiences,
+                    lambda_losses=args.lambda_losses, decay_factors=args.decay_factors, batch_sizes=batch_sizes,
+                    max_epochs=args.max_epochs, architecture_type=args.architecture)
+
+
+def test(args):
+    from Runs import run_test
+    run_test(args.checkpoints, args.checkpoint_dir, args.top, args.architecture, args.input_size, args.batch_size)
+
+
+def cascade(args):
+    from Runs import run_cascade_test
+    return run_cascade_test(args.cheap, args.full, args.miss_rate)
+
+
+def startup(args):
+    """
+    Print the median startup time (sec) of the commands that do not load torch, vs. the budget.
+    :return True if all the commands are within the budget
+    """
+    commands = [['--help'], ['train', '--help'], ['checkpoints', '--top', '1']]
+    within_budget = True
+    for command in commands:
+        times = []
+        for _ in range(args.repeats):
+            s = time.time()
+            subprocess.run([sys.executable, os.path.abspath(__file__)] + command, stdout=subprocess.DEVNULL,
+                           check=True)
+            times.append(time.time() - s)
+        median_time = statistics.median(times)
+        within_budget = within_budget and median_time <= args.budget
+        print('{:30s} {:.3f} sec {}'.format(' '.join(command), median_time,
+                                            'ok' if median_time <= args.budget else 'over budget'))
+    print('budget {:.3f} sec: {}'.format(args.budget, 'ok' if within_budget else 'over budget'))
+    return within_budget
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='AE Classifier: train, test and score Chest X-ray14 models')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    train_parser = commands.add_parser('train', help='train a model and test it (Runs.run_train)')
+    train_parser.add_argument('--architecture', default=ATTENTION_AE_RESNET18, choices=ALL_ARCH)
+    for name, value_type in RUN_PARAMETER_ARGS:
+        train_parser.add_argument('--' + name.replace('_', '-'), type=value_type, default=None,
+                                  help=RUN_PARAMETER_HELP.get(name))
+    train_parser.add_argument('--async-validation', action='store_true')
+    train_parser.add_argument('--hard-example-mining', default=None,
+                              help="'sampling' or 'top_k' (HardExampleMining.py)")
+    train_parser.add_argument('--compare-hard-example-mining', action='store_true',
+                              help='train with the uniform shuffle and every hard example mining mode')
+    train_parser.set_defaults(func=train)
+
+    sweep_parser = commands.add_parser('sweep', help='train every combination of the hyper parameters')
+    sweep_parser.add_argument('--architecture', default=ATTENTION_AE_RESNET18, choices=ALL_ARCH)
+    sweep_parser.add_argument('--lrs', nargs='+', type=float, default=[1e-4])
+    sweep_parser.add_argument('--weight-decays', nargs='+', type=float, default=[1e-4])
+    sweep_parser.add_argument('--decay-patiences', nargs='+', type=int, default=[3])
+    sweep_parser.add_argument('--lambda-losses', nargs='+', type=float, default=[0.9])
+    sweep_parser.add_argument('--decay-factors', nargs='+', type=float, default=[0.1])
+    sweep_parser.add_argument('--batch-sizes', nargs='+', type=int, default=None,
+                              help='default: the train batch size of the host profile, or 32')
+    sweep_parser.add_argument('--max-epochs', nargs='+', type=int, default=[15])
+    sweep_parser.set_defaults(func=sweep)
+
+    test_parser = commands.add_parser('test', help='test checkpoints in one pass over the test split')
+    test_parser.add_argument('--checkpoints', nargs='+', default=None)
+    test_parser.add_argument('--checkpoint-dir', default=None,
+                             help='test the best checkpoints of the directory (validation AUROC)')
+    test_parser.add_argument('--top', type=int, default=5)
+    test_parser.add_argument('--architecture', default=AE_RESNET18, choices=ALL_ARCH, help='sets the batch size')
+    test_parser.add_argument('--input-size', type=int, default=None)
+    test_parser.add_argument('--batch-size', type=int, default=None)
+    test_parser.set_defaults(func=test)
+
+    predict_parser = commands.add_parser('predict', help='score images with the persistent prediction store')
+    PredictionStore.add_arguments(predict_parser)
+    predict_parser.set_defaults(func=PredictionStore.run)
+
+    cascade_parser = commands.add_parser('cascade', help='evaluate a cheap -> expensive model cascade')
+    cascade_parser.add_argument('--cheap', default=None)
+    cascade_parser.add_argument('--full', default=None)
+    cascade_parser.add_argument('--miss-rate', type=float, default=0.01)
+    cascade_parser.set_defaults(func=cascade)
+
+    checkpoints_parser = commands.add_parser('checkpoints', help='select checkpoints by their metadata')
+    CheckpointIndex.add_arguments(checkpoints_parser)
+    checkpoints_parser.set_defaults(func=CheckpointIndex.run)
+
+    tune_parser = commands.add_parser('tune', help='tune the batch sizes, loader workers and threads of this host')
+    HardwareTuner.add_arguments(tune_parser)
+    tune_parser.set_defaults(func=HardwareTuner.run)
+
+    plot_parser = commands.add_parser('plot', help='plot the metrics logs of the training runs')
+    MetricsLog.add_arguments(plot_parser)
+    plot_parser.set_defaults(func=MetricsLog.run)
+
+    startup_parser = commands.add_parser('startup', help='startup time of the light commands')
+    startup_parser.add_argument('--repeats', type=int, default=5)
+    startup_parser.add_argument('--budget', type=float, default=STARTUP_BUDGET)
+    startup_parser.set_defaults(func=startup)
+    return parser
 
 
 def main():
-    batch_run_train(lrs=[1e-4], weight_decays=[1e-4], lambda_losses=[0.9], max_epochs=[15])
-    
-	# run_parameters = parameters()
-    # run_train(run_parameters)
-    
-	# run_test()
-
-
-def batch_run_train(lrs=[1e-4], weight_decays=[1e-5], decay_patiences=[3], lambda_losses=[0.9], decay_factors=[0.1],
-                    batch_sizes=[32], max_epochs=[20]):
-    if not os.path.exists(r"./ResultSummary.txt"):
-        file1 = open(r"./ResultSummary.txt", 'w')
-        file1.write(
-            'time path lr weight_decay decay_patience lambda_loss decay_factor batch_size max_epoch AUROC_mean loss_train loss_val loss_test\n')
-        file1.close()
-
-    #
-    # workbook = xlsxwriter.Workbook(launch_timestamp+'.xlsx')
-    # worksheet = workbook.add_worksheet()
-    # worksheet.write('A1', 'Path')
-    # worksheet.write('B1', 'weight_decay')
-    # worksheet.write('C1', 'decay_patience')
-    # worksheet.write('D1', 'lambda_loss')
-    # worksheet.write('E1', 'decay_factor')
-    # worksheet.write('F1', 'batch_size')
-    # worksheet.write('G1', 'max_epoch')
-    # worksheet.write('H1', 'AUROC mean')
-
-    runs_parameters = []
-    for lr in lrs:
-        for weight_decay in weight_decays:
-            for decay_patience in decay_patiences:
-                for lambda_loss in lambda_losses:
-                    for decay_factor in decay_factors:
-                        for batch_size in batch_sizes:
-                            for max_epoch in max_epochs:
-                                runs_parameters.append(
-                                    parameters(lr=lr, weight_decay=weight_decay, decay_patience=decay_patience,
-                                               lambda_loss=lambda_loss, decay_factor=decay_factor,
-                                               batch_size=batch_size, max_epoch=max_epoch))
-    i = 2
-    for run_parameters in runs_parameters:
-        print('******* Parameter check ', i - 1, '/', len(runs_parameters), '*******')
-        timestampTime = time.strftime("%H%M%S")
-        timestampDate = time.strftime("%d%m%Y")
-        launch_timestamp = timestampDate + '-' + timestampTime
-        AUROC_mean, train_loss, val_loss, test_loss, path_model = run_train(run_parameters)
-        # worksheet.write('A'+str(i), path_model)
-        # worksheet.write('B'+str(i), run_parameters.weight_decay)
-        # worksheet.write('C'+str(i), run_parameters.decay_patience)
-        # worksheet.write('D'+str(i), run_parameters.lambda_loss)
-        # worksheet.write('E'+str(i), run_parameters.decay_factor)
-        # worksheet.write('F'+str(i), run_parameters.batch_size)
-        # worksheet.write('G'+str(i), run_parameters.max_epoch)
-        # worksheet.write('H'+str(i), auroc_mean)
-        file1 = open(r"./ResultSummary.txt", 'a')
-        file1.write(launch_timestamp + ' ' + path_model + ' ' + str(run_parameters.lr) + ' ' + str(
-            run_parameters.weight_decay) + ' ' +
-                    str(run_parameters.decay_patience) + ' ' + str(run_parameters.lambda_loss) + ' ' + str(
-            run_parameters.decay_factor) + ' ' + str(run_parameters.batch_size) + ' '
-                    + str(run_parameters.max_epoch) + ' ' + str(AUROC_mean) + ' ' + str(train_loss) + ' ' + str(
-            val_loss) + ' ' + str(test_loss) + '\n')
-        file1.close()
-        i += 1
-    # workbook.close()
-
-
-def run_train(run_parameters):
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    # device = torch.device("cpu")
-    if device == torch.device("cuda:0"):
-        gc.collect()
-        torch.cuda.empty_cache()
-        print('Using GPU')
-    else:
-        print('Using CPU')
-
-    timestampTime = time.strftime("%H%M%S")
-    timestampDate = time.strftime("%d%m%Y")
-    launch_timestamp = timestampDate + '-' + timestampTime
-
-    # ---- Path to the directory with images
-
-    # ---- Paths to the files with training, validation and testing sets.
-    # ---- Each file should contains pairs [path to image, output vector]
-    # ---- Example: images_011/00027736_001.png 0 0 0 0 0 0 0 0 0 0 0 0 0 0
-
-    # ---- Neural network parameters: type of the network, is it pre-trained
-    # ---- on imagenet, number of classes
-    # choose from: RESNET18, BASIC_AE, AE_RESNET18, ATTENTION_AE, ATTENTION_AE_RESNET18
-    architecture_type = ATTENTION_AE_RESNET18
-    is_backbone_pretrained = True
-    balanced_classifier_loss = True
-
-    # ---- Training settings: batch size, maximum number of epochs
-    batch_size = run_parameters.batch_size
-    max_epoch = run_parameters.max_epoch
-
-    # ---- Parameters related to image transforms: size of the down-scaled image, cropped image
-    trans_resize_size = None
-    trans_crop_size = None
-    trans_rotation_angle = None
-    num_of_input_channels = 1
-    # parameters per architecture:
-    if architecture_type == RESNET18:
-        # resize to 256 -> random crop to 224 -> random rotate [-5,5]
-        trans_resize_size = 256
-        trans_crop_size = 224
-        trans_rotation_angle = 5
-        num_of_input_channels = 3
-    elif architecture_type == BASIC_AE or architecture_type == ATTENTION_AE:
-        # random crop to 128
-        trans_crop_size = 128
-    elif architecture_type == AE_RESNET18 or architecture_type == ATTENTION_AE_RESNET18 or architecture_type == IMPROVED_AE_RESNET18:
-        # random crop to 896 -> random rotate [-5,5]
-        trans_crop_size = 896
-        trans_rotation_angle = 5
-
-    path_saved_model = 'm-' + architecture_type + '-' + launch_timestamp + '.pth.tar'
-    checkpoint_encoder = None
-    checkpoint_classifier = None
-    checkpoint_combined = None
-
-    print('Training NN architecture = ', architecture_type)
-    model_trainer = ModelTrainer(device, architecture_type, num_of_input_channels, is_backbone_pretrained, NUM_CLASSES,
-                                 balanced_classifier_loss, run_parameters)
-    train_loss, val_loss = model_trainer.train(PATH_IMG_DIR, PATH_FILE_TRAIN, PATH_FILE_VALIDATION, batch_size,
-                                               max_epoch, trans_resize_size, trans_crop_size, trans_rotation_angle,
-                                               launch_timestamp,
-                                               checkpoint_classifier, checkpoint_encoder, checkpoint_combined)
-    print('Testing the trained model')
-    auroc_mean, test_loss = model_trainer.test(PATH_IMG_DIR, PATH_FILE_TEST, path_saved_model,
-                                               batch_size, trans_resize_size, trans_crop_size)
-    return auroc_mean, train_loss, val_loss, test_loss, path_saved_model
-
-
-def run_test():
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
-    if device == torch.device("cuda:0"):
-        gc.collect()
-        torch.cuda.empty_cache()
-        print('Using GPU')
-    else:
-        print('Using CPU')
-
-    architecture_type = AE_RESNET18  # select from: RESNET18, AE_RESNET18, IMPROVED_AE_RESNET18
-    is_backbone_pretrained = True
-    balanced_classifier_loss = True
-    num_of_input_channels = 1
-    trans_resize_size = None
-    if architecture_type == RESNET18:
-        # resize to 256 -> random crop to 224 -> random rotate [-5,5]
-        batch_size = 1024
-        trans_resize_size = 256
-        trans_crop_size = 224
-        num_of_input_channels = 3
-    elif architecture_type == BASIC_AE or architecture_type == ATTENTION_AE:
-        batch_size = 1024
-        # random crop to 128
-        trans_crop_size = 128
-    elif architecture_type == AE_RESNET18 or architecture_type == ATTENTION_AE_RESNET18:
-        # random crop to 896 -> random rotate [-5,5]
-        batch_size = 32
-        trans_crop_size = 896
-
-    path_trained_model = r'C:\Users\pazi\Desktop\Uni\BioDeepLearning\1e4\m-RES-NET-18-20072020-073848.pth.tar'
-    path_trained_models = [path_trained_model]
-    auroc_means = []
-    for path_trained_model in path_trained_models:
-        model_trainer = ModelTrainer(device, architecture_type, num_of_input_channels, is_backbone_pretrained,
-                                     NUM_CLASSES, balanced_classifier_loss)
-        auroc_mean, test_loss = model_trainer.test(PATH_IMG_DIR, PATH_FILE_TEST, path_trained_model,
-                                                   batch_size, trans_resize_size, trans_crop_size)
-        auroc_means.append(auroc_mean)
-    best_model = np.argmax(auroc_means)
-    modelCheckpoint = torch.load(path_trained_models[best_model])
-    decay = modelCheckpoint['optimizer']['param_groups'][0]['weight_decay']
-    lr = modelCheckpoint['optimizer']['param_groups'][0]['lr']
-    torch.save(modelCheckpoint, 'm-' + modelCheckpoint['model_type'] + '-' + str(decay) + '-' + str(lr) + '-' + str(
-        np.round(10000 * auroc_means[best_model]) / 10000) + '.pth.tar')
+    args = build_parser().parse_args()
+    args.func(args)
 
 
 if __name__ == '__main__':
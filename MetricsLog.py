@@ -0,0 +1,170 @@
+"""
+Metrics event log of the training runs, replacing the matplotlib plots of the training loop.
+
+The trainer logs scalar events (per step: the batch loss; per epoch: train / validation loss, AUROC mean and per class,
+lr, images/sec; per test: the test loss and AUROC) to a MetricsSink: log() only puts the event in a queue, a background
+thread appends the events to a JSON lines file (<checkpoint name>.metrics.jsonl) and flushes it every flush_interval
+seconds and when the sink is closed (also at exit).
+
+The plots are generated offline from the log:
+    python MetricsLog.py --log m-RES-NET-18-<timestamp>.metrics.jsonl  (or: python Main.py plot --log ...)
+"""
+import argparse
+import atexit
+import json
+import queue
+import threading
+import time
+
+METRICS_SUFFIX = '.metrics.jsonl'
+
+
+def get_metrics_path(path_checkpoint):
+    """
+    :return metrics log of a checkpoint: the best and the last checkpoint of a run share the log of the run
+    """
+    name = path_checkpoint[:path_checkpoint.find('.pth')] if '.pth' in path_checkpoint else path_checkpoint
+    if name.endswith('_last'):
+        name = name[:-len('_last')]
+    return name + METRICS_SUFFIX
+
+
+def to_json_value(value):
+    """
+    numpy scalars / arrays and tensors of the logged values
+    """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class MetricsSink:
+    # ---- path_log - JSON lines file, the events are appended
+    # ---- flush_interval - seconds between the flushes of the file (the events of a crash in the interval are lost)
+    def __init__(self, path_log, flush_interval=2.0):
+        self.path_log = path_log
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_events, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, event, **values):
+        """
+        Queue an event (e.g. 'step', 'epoch', 'test') with its values, returns immediately.
+        """
+        values['event'] = event
+        values['time'] = time.time()
+        self.queue.put(values)
+
+    def write_events(self):
+        with open(self.path_log, 'a') as file_descriptor:
+            last_flush = time.time()
+            while True:
+                try:
+                    values = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    values = {}
+                if values is None:
+                    break
+                if len(values) > 0:
+                    file_descriptor.write(json.dumps(values, default=to_json_value) + '\n')
+                if time.time() - last_flush >= self.flush_interval:
+                    file_descriptor.flush()
+                    last_flush = time.time()
+
+    def close(self):
+        """
+        Write the queued events and stop the writer thread.
+        """
+        # a closed sink is not kept alive until the exit (a sweep creates one per run)
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def read_events(path_log):
+    with open(path_log, 'r') as file_descriptor:
+        return [json.loads(line) for line in file_descriptor if line.strip()]
+
+
+def plot_curves(curves, title, x_label, path_figure):
+    """
+    :param curves - list of (label, x values, y values)
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    figure = plt.figure()
+    plt.xlabel(x_label)
+    for label, x_values, y_values in curves:
+        plt.plot(x_values, y_values, label=label)
+    plt.title(title)
+    plt.legend(loc='upper right', fontsize='small')
+    figure.savefig(path_figure, dpi=100)
+    plt.close('all')
+
+
+def plot_log(path_log):
+    """
+    Plot the train / validation loss, the validation AUROC (mean and per class) and the step loss of a run (or the
+    loss lists of the tested checkpoint when the log has no epochs).
+    :return paths of the saved figures
+    """
+    events = read_events(path_log)
+    name = path_log[:-len(METRICS_SUFFIX)] if path_log.endswith(METRICS_SUFFIX) else path_log
+    epochs = [event for event in events if event['event'] == 'epoch']
+    steps = [event for event in events if event['event'] == 'step']
+    tests = [event for event in events if event['event'] == 'test']
+    figures = []
+    if len(epochs) > 0:
+        x_values = [event['epoch'] for event in epochs]
+        curves = [('Train', x_values, [event['loss_train'] for event in epochs]),
+                  ('Validation', x_values, [event['loss_validation'] for event in epochs])]
+    elif len(tests) > 0:
+        loss_train_list = tests[-1]['loss_train_list']
+        curves = [('Train', range(1, len(loss_train_list) + 1), loss_train_list),
+                  ('Validation', range(1, len(loss_train_list) + 1), tests[-1]['loss_validation_list'])]
+    else:
+        curves = []
+    if len(curves) > 0:
+        title = name + '_Train'
+        if len(tests) > 0 and tests[-1].get('auroc_mean') is not None:
+            title += '_AUROCmean_' + str(round(tests[-1]['auroc_mean'], 3))
+        figures.append(name + '_loss.png')
+        plot_curves(curves, title, 'Epoch #', figures[-1])
+    epochs_auroc = [event for event in epochs if event.get('auroc') is not None]
+    if len(epochs_auroc) > 0:
+        x_values = [event['epoch'] for event in epochs_auroc]
+        curves = [('mean', x_values, [event['auroc_mean'] for event in epochs_auroc])]
+        for class_idx in range(len(epochs_auroc[0]['auroc'])):
+            curves.append(('c' + str(class_idx), x_values, [event['auroc'][class_idx] for event in epochs_auroc]))
+        figures.append(name + '_auroc.png')
+        plot_curves(curves, name + '_validation_AUROC', 'Epoch #', figures[-1])
+    if len(steps) > 0:
+        figures.append(name + '_steps.png')
+        plot_curves([('Train', range(len(steps)), [event['loss'] for event in steps])], name + '_step_loss', 'Step #',
+                    figures[-1])
+    for path_figure in figures:
+        print('saved ', path_figure)
+    return figures
+
+
+def add_arguments(parser):
+    parser.add_argument('--log', nargs='+', required=True, help='metrics logs (<checkpoint name>.metrics.jsonl)')
+
+
+def run(args):
+    for path_log in args.log:
+        plot_log(path_log)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot the metrics logs of the training runs')
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
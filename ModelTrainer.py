@@ -1,13 +1,103 @@
+import gc
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import PIL
+import torch
+import torch.backends.cudnn as cudnn
+import torch.optim as optim
+import torchvision.transforms as transforms
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
 from Config import *
+from DatasetGenerator import DatasetGenerator
 from ClassifierModels import Resnet18
 from AttentionUnetModel import AttentionUnet2D
 from AEClassifierModels import BasicAutoEncoder, ImprovedAutoEncoder, \
-    AE_Resnet18, IMPROVED_AE_Resnet18, AttentionUnetResnet18
+    AE_Resnet18, IMPROVED_AE_Resnet18, AttentionUnetResnet18, \
+    STAGE_AUTO_ENCODER, STAGE_FROZEN_ENCODER, STAGE_JOINT
 from class_balanced_loss import CB_loss
+from DataLoaderFactory import DataLoaderFactory
+from BatchTransfer import ToUint8Tensor, DeviceNormalize, PinnedRingBuffer
+from CheckpointIndex import build_metadata, write_metadata
+from MetricsLog import MetricsSink, get_metrics_path
+from torch.utils.data import Subset
+# ---- the modules of the optional features (AsyncValidation, ValidationMetrics, Distillation, ChannelPruning,
+# ---- TrainingResume, HardExampleMining, SharedImageCache) are imported where their run parameter is used
+
+# ---- one factory per process (created on first use): the loaders (and their workers) are reused by all the runs of
+# ---- a sweep
+data_loader_factory = None
+# ---- one decoded-image cache per process (if enabled), shared by the train and validation loaders
+image_cache = None
+
+
+def get_data_loader_factory():
+    """
+    :return the data loader factory of the process (the workers of the host profile are read on the first call)
+    """
+    global data_loader_factory
+    if data_loader_factory is None:
+        data_loader_factory = DataLoaderFactory(NUM_WORKERS, PREFETCH_FACTOR, PERSISTENT_WORKERS)
+    return data_loader_factory
+
+
+def get_image_cache():
+    global image_cache
+    if image_cache is None and IMAGE_CACHE_MB is not None:
+        from SharedImageCache import SharedImageCache
+        # the decoded images are always grayscale (expanded to 3 channels by the transform)
+        image_cache = SharedImageCache(int(IMAGE_CACHE_MB * 2 ** 20), IMAGE_SIZE * IMAGE_SIZE)
+        print('Image cache: ', IMAGE_CACHE_MB, ' MB, ', image_cache.num_pages, ' pages of ',
+              image_cache.page_bytes // 2 ** 10, ' KB')
+    return image_cache
+
+
+def get_pin_memory_args():
+    """
+    :return DataLoader pin_memory argument: the uint8 batches are pinned by the trainer's ring buffer instead
+    """
+    if UINT8_TRANSFER:
+        return {'pin_memory': False}
+    return {}
 
 
 class parameters():
-    def __init__(self, lambda_loss=0.9, lr = 0.0001, weight_decay = 1e-5, decay_factor = 0.1, decay_patience = 5, batch_size=64, max_epoch=30):
+    # ---- input_size - crop size of the input image, None for the default size of the architecture
+    # ---- resize_schedule - progressive resizing: list of (first epoch, input size) pairs, e.g. [(0, 448), (10, 896)]
+    # ---- target_auroc - the training reports the time it took to reach this validation AUROC mean
+    # ---- training_stages - combined models: list of (first epoch, stage) pairs, e.g.
+    # ----     [(0, 'auto_encoder'), (5, 'frozen_encoder'), (15, 'joint')], None - joint training in all the epochs
+    # ---- module_lr - combined models: learning rate per module, e.g. {'auto_encoder': 1e-5, 'classifier': 1e-4}
+    # ----     (modules that are not in the dict use lr)
+    # ---- async_validation - validate weight snapshots in an evaluator process while the training continues, the
+    # ----     results reach the scheduler / best checkpoint one epoch late, or after waiting up to
+    # ----     async_validation_wait seconds
+    # ---- validation_subsample - validate every epoch on a fixed label-stratified fraction of the validation split
+    # ----     (with bootstrap confidence intervals of the AUROC), the full split is validated every
+    # ----     full_validation_interval epochs, at the last epoch, at the first epoch of a phase / stage and when the
+    # ----     subsample AUROC improves by more than its confidence interval, the scheduler steps on the subsample loss
+    # ---- distillation_teacher - checkpoint of a teacher model: its probabilities (cached on disk, Distillation.py)
+    # ----     supervise the classifier, mixed with the classifier loss: (1 - distillation_weight) * classifier loss +
+    # ----     distillation_weight * BCE with the teacher probabilities
+    # ---- hard_example_mining - online hard-example mining after hard_example_warmup epochs (HardExampleMining.py):
+    # ----     'sampling' - every epoch trains on hard_example_fraction of the images, sampled by their last loss,
+    # ----     'top_k' - only the hard_example_fraction images of every batch with the largest loss run the backward,
+    # ----     None - uniform shuffle
+    # ---- metrics_step_interval - batches between the 'step' events of the metrics log (MetricsLog.py), None - only
+    # ----     the epoch events
+    # ---- resume_checkpoint_interval - batches between the resume checkpoints of the run (TrainingResume.py, also
+    # ----     written at the start of every epoch), None - no resume checkpoints
+    # ---- resume_checkpoint - resume checkpoint of a preempted run: the training continues from its batch
+    def __init__(self, lambda_loss=0.9, lr = 0.0001, weight_decay = 1e-5, decay_factor = 0.1, decay_patience = 5, batch_size=64, max_epoch=30,
+                 input_size=None, resize_schedule=None, target_auroc=None, training_stages=None, module_lr=None,
+                 async_validation=False, async_validation_wait=None, validation_subsample=None,
+                 full_validation_interval=None, bootstrap_resamples=1000, distillation_teacher=None,
+                 distillation_weight=0.5, hard_example_mining=None, hard_example_fraction=0.5,
+                 hard_example_warmup=1, metrics_step_interval=1,
+                 resume_checkpoint_interval=None, resume_checkpoint=None):
         self.lr = lr
         self.weight_decay = weight_decay
         self.decay_factor = decay_factor
@@ -15,10 +105,47 @@ class parameters():
         self.lambda_loss = lambda_loss
         self.batch_size = batch_size
         self.max_epoch = max_epoch
+        self.input_size = input_size
+        self.resize_schedule = resize_schedule
+        self.target_auroc = target_auroc
+        self.training_stages = training_stages
+        self.module_lr = module_lr
+        self.async_validation = async_validation
+        self.async_validation_wait = async_validation_wait
+        self.validation_subsample = validation_subsample
+        self.full_validation_interval = full_validation_interval
+        self.bootstrap_resamples = bootstrap_resamples
+        self.distillation_teacher = distillation_teacher
+        self.distillation_weight = distillation_weight
+        if hard_example_mining is not None:
+            from HardExampleMining import check_hard_example_mode
+            check_hard_example_mode(hard_example_mining)
+        self.hard_example_mining = hard_example_mining
+        self.hard_example_fraction = hard_example_fraction
+        self.hard_example_warmup = hard_example_warmup
+        self.metrics_step_interval = metrics_step_interval
+        self.resume_checkpoint_interval = resume_checkpoint_interval
+        self.resume_checkpoint = resume_checkpoint
 
 
+class ExpandChannels(object):
+    """
+    Expand a single-channel (grayscale) image tensor to num_chs channels, without copying.
+    """
+    def __init__(self, num_chs):
+        self.num_chs = num_chs
+
+    def __call__(self, tensor):
+        if tensor.shape[0] == self.num_chs:
+            return tensor
+        return tensor.expand(self.num_chs, -1, -1)
+
+
+# ---- num_output_chs - the images are augmented as grayscale, and expanded to num_output_chs channels at the end
+# ---- uint8_output - end with a uint8 tensor, the float conversion / expansion / normalization are done on the
+# ---- device (BatchTransfer.DeviceNormalize)
 def data_augmentations(resize_target, crop_target, normalization_vec, rotation_angle=None, center_crop=False,
-                       flip=True):
+                       flip=True, num_output_chs=1, uint8_output=False):
     transformList = []
     # optional augmentation:
     if resize_target is not None:
@@ -37,25 +164,69 @@ def data_augmentations(resize_target, crop_target, normalization_vec, rotation_a
         transformList.append(transforms.RandomRotation(rotation_angle, PIL.Image.BILINEAR))
 
     # basic augmentations (end)
-    transformList.append(transforms.ToTensor())
-    if normalization_vec is not None:
-        transformList.append(transforms.Normalize(normalization_vec[0], normalization_vec[1]))
+    if uint8_output:
+        transformList.append(ToUint8Tensor())
+    else:
+        transformList.append(transforms.ToTensor())
+        if num_output_chs > 1:
+            transformList.append(ExpandChannels(num_output_chs))
+        if normalization_vec is not None:
+            transformList.append(transforms.Normalize(normalization_vec[0], normalization_vec[1]))
 
     transformSequence = transforms.Compose(transformList)
     return transformSequence
 
 
-def plt_data(data_train, data_val, titleStr, save_fig=False, save_dir=''):
-    fig1 = plt.figure()
-    plt.xlabel('Epoch #')
-    plt.plot(data_train, color='b', label='Train')
-    plt.plot(data_val, color='r', label='Validation')
-    titleStr_train = titleStr + '_Train'
-    plt.title(titleStr_train)
-    plt.legend(loc='upper right')
-    if save_fig:
-        fig1.savefig(save_dir + titleStr_train + '.png', dpi=100)
-    plt.close('all')
+def get_input_settings(architecture_type, input_size=None):
+    """
+    Image transform settings of an architecture for a given input size.
+    For the classifier and the combined models a smaller input size is a down-scaled image with the same field of
+    view (the resize keeps the resize/crop ratio of the default size), for the auto-encoders it is a smaller patch.
+    :param input_size - crop size of the input image, None for the default size of the architecture
+    :return resize size (None - no resize), crop size, rotation angle (None - no rotation), number of input channels
+    """
+    default_size = DEFAULT_INPUT_SIZE[architecture_type]
+    if input_size is None:
+        input_size = default_size
+    if input_size % 4 != 0:
+        raise ValueError('input size should be a multiple of 4 (auto-encoder scale), got ' + str(input_size))
+
+    resize_size = None
+    rotation_angle = None
+    num_of_input_channels = 1
+    if architecture_type in CLASSIFIER_ARCH:
+        # resize to 256 -> random crop to 224 -> random rotate [-5,5]
+        resize_size = int(round(input_size * 256 / default_size))
+        rotation_angle = 5
+        num_of_input_channels = 3
+    elif architecture_type in COMBINED_ARCH:
+        # (resize) -> random crop to 896 -> random rotate [-5,5]
+        if input_size != default_size:
+            resize_size = int(round(input_size * IMAGE_SIZE / default_size))
+        rotation_angle = 5
+    return resize_size, input_size, rotation_angle, num_of_input_channels
+
+
+def get_scheduled_value(schedule, epoch_id, default=None):
+    """
+    Value of an epoch in a schedule.
+    :param schedule - list of (first epoch, value) pairs, None - default in all the epochs
+    """
+    value = default
+    if schedule is None:
+        return value
+    for first_epoch, scheduled_value in sorted(schedule, key=lambda item: item[0]):
+        if epoch_id >= first_epoch:
+            value = scheduled_value
+    return value
+
+
+def get_scheduled_input_size(resize_schedule, epoch_id, input_size=None):
+    """
+    Input size of an epoch in a progressive resizing schedule.
+    :param resize_schedule - list of (first epoch, input size) pairs, None for a fixed input size
+    """
+    return get_scheduled_value(resize_schedule, epoch_id, input_size)
 
 
 def get_state_dict(modelCheckpoint):
@@ -72,6 +243,29 @@ def get_state_dict(modelCheckpoint):
     return new_state_dict
 
 
+def load_model_weights(model, modelCheckpoint):
+    """
+    Load the weights of the checkpoint, the model is first shrunk to the channels of a pruned checkpoint
+    (ChannelPruning.py).
+    """
+    state_dict = get_state_dict(modelCheckpoint)
+    if modelCheckpoint.get('pruned', False):
+        from ChannelPruning import shrink_to_state_dict
+        shrink_to_state_dict(model, state_dict)
+    model.load_state_dict(state_dict)
+
+
+def print_auroc_ci(class_ci, mean_ci, num_images):
+    """
+    Print the AUROC confidence intervals (ValidationMetrics.bootstrap_auroc).
+    """
+    if mean_ci is None:
+        return
+    print('\nAUROC mean {:.4f} [{:.4f}, {:.4f}] ({} images), per class: '.format(mean_ci[0], mean_ci[1], mean_ci[2],
+                                                                                  num_images) +
+          ' '.join('n/a' if ci is None else '{:.3f}[{:.3f},{:.3f}]'.format(*ci) for ci in class_ci))
+
+
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']
@@ -105,6 +299,28 @@ class ModelTrainer:
         print("Using balanced loss: " + str(balanced_classifier_loss))
         self.num_sample_per_label_train = []
         self.num_sample_per_label_val = []
+        self.time_to_target_auroc = None
+        self.train_time = None
+        # ---- loss-aware sampler of the train loader (run parameter hard_example_mining), set by get_data_loaders
+        self.hard_example_sampler = None
+        # ---- resumable sampler of the train loader (resume checkpoints or hard example sampling), set by
+        # ---- get_data_loaders
+        self.train_sampler = None
+        # ---- launch timestamp of the checkpoints of the last training run (of the preempted run when resumed)
+        self.launch_timestamp = None
+        # ---- metrics log of the training run (MetricsLog.py), set by train
+        self.metrics = None
+        # ---- AUROC of every class of the last validation, None for the auto-encoders
+        self.validation_auroc = None
+        # ---- uint8 input batches: pinned host->device transfer, converted to float on the device
+        self.input_transfer = PinnedRingBuffer()
+        self.device_transform = None
+        # ---- training stage of the combined models (STAGE_JOINT for the other architectures)
+        self.stage = STAGE_JOINT
+        self.stage_stats = OrderedDict()
+        # ---- validation subsample loader (run parameter validation_subsample), set by get_data_loaders
+        self.dataLoader_validation_subsample = None
+        self.validation_auroc_ci = None
         # -------------------- SETTINGS: NETWORK ARCHITECTURE
         if self.architecture_type not in COMBINED_ARCH:
             if self.architecture_type in CLASSIFIER_ARCH:
@@ -119,6 +335,8 @@ class ModelTrainer:
                     self.model = BasicAutoEncoder().to(self.device)
                 elif self.architecture_type == 'IMPROVED_AE':
                     self.model = ImprovedAutoEncoder().to(self.device)
+                elif self.architecture_type == 'ATTENTION_AE':
+                    self.model = AttentionUnet2D().to(self.device)
                 else:
                     print(self.architecture_type, ' not supported in model trainer!')
                     exit()
@@ -146,24 +364,35 @@ class ModelTrainer:
         self.bce_logits_loss = torch.nn.BCEWithLogitsLoss(reduction='mean')
         self.mse_loss = torch.nn.MSELoss(reduction='mean')
 
-    def load_checkpoint(self, checkpoint_classifier, checkpoint_encoder, checkpoint_combined, optimizer=None):
+    def load_checkpoint(self, checkpoint_classifier, checkpoint_encoder, checkpoint_combined, optimizer=None,
+                        scheduler=None):
+        """
+        :param optimizer, scheduler - if not None, their states are loaded from the checkpoint (the older checkpoints
+                                      have no scheduler state)
+        """
         modelCheckpoint = None
         if self.architecture_type in COMBINED_ARCH:
             if checkpoint_combined is not None:
                 modelCheckpoint = torch.load(checkpoint_combined, map_location=self.device)
-                self.model.load_state_dict(get_state_dict(modelCheckpoint))
+                load_model_weights(self.model, modelCheckpoint)
                 if optimizer is not None:
-                    optimizer.load_state_dict(modelCheckpoint['optimizer'])
+                    try:
+                        optimizer.load_state_dict(modelCheckpoint['optimizer'])
+                        if scheduler is not None and 'scheduler' in modelCheckpoint:
+                            scheduler.load_state_dict(modelCheckpoint['scheduler'])
+                    except ValueError:
+                        # saved in another training stage (different parameter groups)
+                        print('optimizer state of the checkpoint does not match the training stage, not loaded')
                 loss_train_list = modelCheckpoint['loss_train_list']
                 loss_validation_list = modelCheckpoint['loss_validation_list']
                 init_epoch = modelCheckpoint['epoch']
             else:
                 if checkpoint_classifier is not None:
                     modelCheckpoint = torch.load(checkpoint_classifier, map_location=self.device)
-                    self.model.classifier.load_state_dict(get_state_dict(modelCheckpoint))
+                    load_model_weights(self.model.classifier, modelCheckpoint)
                 if checkpoint_encoder is not None:
                     modelCheckpoint = torch.load(checkpoint_encoder, map_location=self.device)
-                    self.model.auto_encoder.load_state_dict(get_state_dict(modelCheckpoint))
+                    load_model_weights(self.model.auto_encoder, modelCheckpoint)
                 loss_train_list = []
                 loss_validation_list = []
                 init_epoch = 0
@@ -175,9 +404,11 @@ class ModelTrainer:
                 checkpoint = checkpoint_encoder
             if checkpoint is not None:
                 modelCheckpoint = torch.load(checkpoint, map_location=self.device)
-                self.model.load_state_dict(get_state_dict(modelCheckpoint))
+                load_model_weights(self.model, modelCheckpoint)
                 if optimizer is not None:
                     optimizer.load_state_dict(modelCheckpoint['optimizer'])
+                if scheduler is not None and 'scheduler' in modelCheckpoint:
+                    scheduler.load_state_dict(modelCheckpoint['scheduler'])
                 loss_train_list = modelCheckpoint['loss_train_list']
                 loss_validation_list = modelCheckpoint['loss_validation_list']
                 init_epoch = modelCheckpoint['epoch']
@@ -194,7 +425,94 @@ class ModelTrainer:
             run_parameters = self.run_parameters
         return loss_train_list, loss_validation_list, init_epoch, run_parameters
 
-    def classifier_loss(self, varOutput, varTarget, is_train=False):
+    def has_classifier_output(self):
+        return self.architecture_type not in AE_ARCH and self.stage != STAGE_AUTO_ENCODER
+
+    def set_stage(self, stage):
+        """
+        Select the training stage of a combined model (AEClassifierModels.TRAINING_STAGES).
+        """
+        if stage == self.stage:
+            return
+        if self.architecture_type not in COMBINED_ARCH:
+            print('training stages are supported only by the combined models, ', self.architecture_type,
+                  ' is trained in the joint stage')
+            return
+        self.model.set_stage(stage)
+        self.stage = stage
+
+    def build_optimizer(self):
+        """
+        Optimizer of the trained (requires_grad) parameters, built again at every stage change.
+        The combined models get a parameter group per module when module_lr is set or when a module is frozen.
+        """
+        module_lr = self.run_parameters.module_lr
+        if self.architecture_type in COMBINED_ARCH and (module_lr is not None or self.stage != STAGE_JOINT):
+            module_lr = module_lr or {}
+            param_groups = []
+            for module_name in ['auto_encoder', 'classifier']:
+                params = [param for param in getattr(self.model, module_name).parameters() if param.requires_grad]
+                if len(params) > 0:
+                    param_groups.append({'params': params, 'lr': module_lr.get(module_name, self.lr)})
+        else:
+            param_groups = self.model.parameters()
+        return optim.Adam(param_groups, lr=self.lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=self.weight_decay)
+
+    def build_scheduler(self, optimizer):
+        return ReduceLROnPlateau(optimizer, factor=self.decay_factor, patience=self.decay_patience, mode='min',
+                                 verbose=True)
+
+    def reset_peak_memory(self):
+        if self.device.type == 'cuda':
+            if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+                torch.cuda.reset_peak_memory_stats(self.device)
+            else:
+                torch.cuda.reset_max_memory_allocated(self.device)
+
+    def get_peak_memory_mb(self):
+        """
+        :return peak allocated device memory (MB) since the last reset, None on CPU
+        """
+        if self.device.type != 'cuda':
+            return None
+        return torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+
+    def update_stage_stats(self, epoch_time, num_images):
+        stats = self.stage_stats.setdefault(self.stage, {'epochs': 0, 'train_time': 0, 'images': 0,
+                                                         'images_per_sec': 0, 'peak_memory_mb': None})
+        stats['epochs'] += 1
+        stats['train_time'] += epoch_time
+        stats['images'] += num_images
+        stats['images_per_sec'] = stats['images'] / stats['train_time']
+        peak_memory_mb = self.get_peak_memory_mb()
+        if peak_memory_mb is not None:
+            stats['peak_memory_mb'] = max(stats['peak_memory_mb'] or 0, peak_memory_mb)
+
+    def print_stage_stats(self):
+        for stage, stats in self.stage_stats.items():
+            print('stage {}: {} epochs, {:.1f} sec, {:.1f} images/sec, peak memory {}'.format(
+                stage, stats['epochs'], stats['train_time'], stats['images_per_sec'],
+                'n/a' if stats['peak_memory_mb'] is None else '{:.0f} MB'.format(stats['peak_memory_mb'])))
+
+    def bce_logits(self, varOutput, varTarget, reduction='mean'):
+        if reduction == 'mean':
+            return self.bce_logits_loss(varOutput, varTarget)
+        return torch.nn.functional.binary_cross_entropy_with_logits(varOutput, varTarget, reduction='none').mean(1)
+
+    def mse(self, varOutput, varTarget, reduction='mean'):
+        if reduction == 'mean':
+            return self.mse_loss(varOutput, varTarget)
+        return (varOutput - varTarget).pow(2).view(varOutput.shape[0], -1).mean(1)
+
+    def classifier_loss(self, varOutput, varTarget, is_train=False, reduction='mean'):
+        """
+        :param reduction - 'mean', or 'none' for the loss of every image of the batch
+        """
+        distillation_loss = None
+        if varTarget.shape[1] > self.num_classes:
+            # distillation: the labels are followed by the teacher probabilities (DatasetGenerator.set_soft_labels)
+            distillation_loss = self.bce_logits(varOutput, varTarget[:, self.num_classes:], reduction)
+            varTarget = varTarget[:, :self.num_classes]
         if self.b_balanced_classifier_loss:
             if is_train:
                 samples_per_cls = self.num_sample_per_label_train
@@ -202,35 +520,88 @@ class ModelTrainer:
                 samples_per_cls = self.num_sample_per_label_val
             classifier_loss = CB_loss(labels=varTarget, logits=varOutput,
                                 samples_per_cls=samples_per_cls, no_of_classes=self.num_classes,
-                                loss_type="sigmoid", beta=0.9999, gamma=2, device=self.device)
+                                loss_type="sigmoid", beta=0.9999, gamma=2, device=self.device,
+                                reduction=reduction)
         else:
-            classifier_loss = self.bce_logits_loss(varOutput, varTarget)
+            classifier_loss = self.bce_logits(varOutput, varTarget, reduction)
+        if distillation_loss is not None:
+            distillation_weight = self.run_parameters.distillation_weight
+            classifier_loss = (1 - distillation_weight) * classifier_loss + distillation_weight * distillation_loss
 
         return classifier_loss
 
-    def loss(self, varOutput, varTarget, varInput, is_train=False):
+    def loss(self, varOutput, varTarget, varInput, is_train=False, reduction='mean'):
+        """
+        :param reduction - 'mean', or 'none' for the loss of every image of the batch (the display loss is the mean)
+        """
         if self.architecture_type in AE_ARCH:
-            curr_loss = self.mse_loss(varOutput, varInput)
-            display_loss = curr_loss.item()
+            # auto-encoders return (encoder, decoder) outputs
+            curr_loss = self.mse(varOutput[1], varInput, reduction)
+            display_loss = curr_loss.mean().item()
         elif self.architecture_type in CLASSIFIER_ARCH:
-            curr_loss = self.classifier_loss(varOutput, varTarget, is_train)
-            display_loss = curr_loss.item()
+            curr_loss = self.classifier_loss(varOutput, varTarget, is_train, reduction)
+            display_loss = curr_loss.mean().item()
+
+        elif self.architecture_type in COMBINED_ARCH and varOutput[1] is None:
+            # auto-encoder stage: reconstruction only
+            curr_loss = self.mse(varOutput[0], varInput, reduction)
+            display_loss = curr_loss.mean().item()
 
         elif self.architecture_type in COMBINED_ARCH:
-            curr_loss1 = self.mse_loss(varOutput[0], varInput)
-            curr_loss2 = self.classifier_loss(varOutput[1], varTarget, is_train)
-            display_loss = curr_loss2.item()
+            curr_loss1 = self.mse(varOutput[0], varInput, reduction)
+            curr_loss2 = self.classifier_loss(varOutput[1], varTarget, is_train, reduction)
+            display_loss = curr_loss2.mean().item()
             curr_loss = self.lambda_loss * curr_loss2 + (1 - self.lambda_loss) * curr_loss1
 
         return curr_loss, display_loss
 
-    def run_batch(self, input_img, target_label, train=False):
-        varInput = torch.autograd.Variable(input_img).to(self.device)
+    def input_to_device(self, input_img):
+        if self.device_transform is None:
+            return input_img.to(self.device)
+        return self.device_transform(self.input_transfer.to_device(input_img, self.device))
+
+    def run_batch(self, input_img, target_label, train=False, reduction='mean'):
+        varInput = self.input_to_device(input_img)
         varTarget = torch.autograd.Variable(target_label).to(self.device)
         varOutput = self.model(varInput)
-        loss_value, display_loss = self.loss(varOutput, varTarget, varInput,train)
+        loss_value, display_loss = self.loss(varOutput, varTarget, varInput, train, reduction)
         return loss_value, display_loss, varOutput
 
+    def run_hard_examples_batch(self, input_img, target_label):
+        """
+        Top-k hard example mining in the batch: the batch is scored without gradients (in eval mode, the batch norm
+        statistics are updated once), only the hard_example_fraction images with the largest loss run the training
+        forward and backward.
+        :return loss of the hard images, display loss of the whole batch, number of hard images
+        """
+        varInput = self.input_to_device(input_img)
+        varTarget = target_label.to(self.device)
+        self.model.eval()
+        with torch.no_grad():
+            sample_losses, display_loss = self.loss(self.model(varInput), varTarget, varInput, True, reduction='none')
+        self.model.train()
+        from HardExampleMining import select_hard_examples
+        hard_examples = select_hard_examples(sample_losses, self.run_parameters.hard_example_fraction)
+        varInput = varInput[hard_examples]
+        loss_value, _ = self.loss(self.model(varInput), varTarget[hard_examples], varInput, True)
+        return loss_value, display_loss, len(hard_examples)
+
+    def get_class_probabilities(self, varOutput):
+        """
+        :return batch x classes probabilities
+        """
+        if self.architecture_type in CLASSIFIER_ARCH:
+            return torch.sigmoid(varOutput)
+        return torch.sigmoid(varOutput[1])
+
+    def get_predictions(self, varOutput):
+        """
+        :return prediction score of every image of the batch (the mean of the class probabilities), as used by
+                compute_AUROC
+        """
+        predictions = self.get_class_probabilities(varOutput)
+        return predictions.view(predictions.shape[0], -1).mean(1).data
+
     def compute_AUROC(self, gt_data, prediction):
         """
         Computes area under ROC curve
@@ -238,6 +609,7 @@ class ModelTrainer:
         :param prediction - predicted data
         :return out_auroc - area under ROC curve vector (value for each class)
         """
+        from sklearn.metrics import roc_auc_score  # loaded on the first evaluation only
         out_auroc = []
 
         np_gt_data = gt_data.cpu().numpy()
@@ -251,25 +623,108 @@ class ModelTrainer:
 
         return out_auroc
 
-    def epoch_train(self, epoch_id, data_loader, optimizer):
+    def epoch_train(self, epoch_id, data_loader, optimizer, epoch_state=None, save_resume_checkpoint=None):
+        """
+        :param epoch_state - partial epoch of a resumed run (TrainingResume.py): the next batch and the metrics of the
+                             trained batches, the sampler of the loader continues from the next batch
+        :param save_resume_checkpoint - function(epoch state) that saves a resume checkpoint, called every
+                                        resume_checkpoint_interval batches
+        :return mean train loss of the epoch
+        """
         self.model.train()
+        start_batch = 0
         loss_value_mean = 0
-        for batch_id, (input_img, target_label) in enumerate(data_loader):
+        num_images = 0
+        num_backward_images = 0
+        elapsed_time = 0
+        if epoch_state is not None:
+            start_batch = epoch_state['batch']
+            loss_value_mean = epoch_state['loss_sum']
+            num_images = epoch_state['num_images']
+            num_backward_images = epoch_state['num_backward_images']
+            elapsed_time = epoch_state['train_time']
+            print("----> EpochID: {}, resumed at batch {}".format(epoch_id + 1, start_batch + 1))
+        num_resumed_images = num_images
+        self.input_transfer.reset_stats()
+        # ---- hard example mining: the loss-aware sampler draws the images of the epoch by their recorded losses,
+        # ---- the top-k mining runs the backward only on the hard images of every batch
+        sampler = None
+        top_k = False
+        if self.run_parameters.hard_example_mining is not None:
+            from HardExampleMining import LossAwareSampler, HARD_EXAMPLE_TOP_K
+            sampler = data_loader.sampler if isinstance(data_loader.sampler, LossAwareSampler) else None
+            top_k = self.run_parameters.hard_example_mining == HARD_EXAMPLE_TOP_K and \
+                epoch_id >= self.run_parameters.hard_example_warmup
+        if sampler is not None:
+            sampler.set_epoch(epoch_id)
+        if epoch_state is not None or save_resume_checkpoint is not None:
+            from TrainingResume import get_epoch_state, set_rng_state
+        # the length of a resumed loader is the number of the remaining batches
+        num_batches = start_batch + len(data_loader)
+        step_interval = self.run_parameters.metrics_step_interval if self.metrics is not None else None
+        checkpoint_interval = self.run_parameters.resume_checkpoint_interval \
+            if save_resume_checkpoint is not None else None
+        first_batch_wait = None
+        s = time.time()
+        # the loader iterator draws its seed from the torch random state: a resumed epoch restores the random states
+        # of the batch 0 before the iterator, and those of a later batch after it (the seed was drawn before them)
+        if epoch_state is not None and start_batch == 0:
+            set_rng_state(epoch_state['rng'])
+        batches = iter(data_loader)
+        if epoch_state is not None and start_batch > 0:
+            set_rng_state(epoch_state['rng'])
+        for batch_id, (input_img, target_label) in enumerate(batches, start_batch):
+            if batch_id == start_batch:
+                # epoch boundary stall: waiting for the workers to start and deliver the first batch
+                first_batch_wait = time.time() - s
             # target_label = target_label.to(self.device, non_blocking=True)
-            loss_value, display_loss, _ = self.run_batch(input_img, target_label, train=True)
+            if top_k:
+                loss_value, display_loss, num_hard_images = self.run_hard_examples_batch(input_img, target_label)
+                num_backward_images += num_hard_images
+            elif sampler is not None:
+                loss_value, display_loss, _ = self.run_batch(input_img, target_label, train=True, reduction='none')
+                sampler.record_losses(batch_id, data_loader.batch_size, loss_value)
+                loss_value = loss_value.mean()
+                num_backward_images += input_img.shape[0]
+            else:
+                loss_value, display_loss, _ = self.run_batch(input_img, target_label, train=True)
+                num_backward_images += input_img.shape[0]
             loss_value_mean += display_loss
+            num_images += input_img.shape[0]
             optimizer.zero_grad()
             loss_value.backward()
             optimizer.step()
+            if step_interval is not None and batch_id % step_interval == 0:
+                self.metrics.log('step', epoch=epoch_id + 1, batch=batch_id, loss=display_loss)
+            if checkpoint_interval is not None and (batch_id + 1) % checkpoint_interval == 0 and \
+                    batch_id + 1 < num_batches:
+                save_resume_checkpoint(get_epoch_state(batch_id + 1, loss_value_mean, num_images, num_backward_images,
+                                                       elapsed_time + time.time() - s))
 
-            if batch_id % (int(len(data_loader) * 0.3)) == 0:
+            if batch_id % max(1, int(num_batches * 0.3)) == 0:
                 print("----> EpochID: {}, BatchID/NumBatches: {}/{}, mean train loss: {}"
-                      .format(epoch_id + 1, batch_id + 1, len(data_loader), loss_value_mean / (batch_id + 1)))
+                      .format(epoch_id + 1, batch_id + 1, num_batches, loss_value_mean / (batch_id + 1)))
 
-        loss_value_mean /= len(data_loader)
+        loss_value_mean /= max(1, num_batches)
+        transfer_stats = self.input_transfer.get_stats()
+        images_per_sec = (num_images - num_resumed_images) / (time.time() - s)
+        print("----> EpochID: {}, input batch: {:.3f} MB ({}), {:.1f} images/sec, first batch wait: {:.3f} sec".format(
+            epoch_id + 1, transfer_stats['mb_per_batch'], transfer_stats['dtype'], images_per_sec,
+            first_batch_wait or 0))
+        if self.run_parameters.hard_example_mining is not None:
+            print("----> EpochID: {}, hard example mining ({}): {} images, {} in the backward".format(
+                epoch_id + 1, self.run_parameters.hard_example_mining, num_images, num_backward_images))
+        if self.metrics is not None:
+            self.metrics.log('train_epoch', epoch=epoch_id + 1, loss=loss_value_mean, images=num_images,
+                             backward_images=num_backward_images, images_per_sec=images_per_sec,
+                             first_batch_wait=first_batch_wait)
         return loss_value_mean
 
-    def epoch_validation(self, data_loader):
+    def epoch_validation(self, data_loader, confidence_intervals=False):
+        """
+        :param confidence_intervals - also print the bootstrap confidence intervals of the AUROC
+                                      (the mean AUROC interval is kept in self.validation_auroc_ci)
+        """
         self.model.eval()
         loss_val = 0
         loss_val_norm = 0
@@ -283,127 +738,334 @@ class ModelTrainer:
                     print('.', end="", flush=True)
                 target_label = target_label.to(self.device, non_blocking=True)
                 loss_value, display_loss, varOutput = self.run_batch(input_img, target_label)
-                if self.architecture_type not in AE_ARCH:
-                    if self.architecture_type in CLASSIFIER_ARCH:
-                        predictions = torch.sigmoid(varOutput)
-                    else:
-                        predictions = torch.sigmoid(varOutput[1])
+                if self.has_classifier_output():
                     out_gt = torch.cat((out_gt, target_label), 0)
-                    bs, c, h, w = input_img.size()
-                    out_mean = predictions.view(bs, -1).mean(1)
-                    out_pred = torch.cat((out_pred, out_mean.data), 0)
+                    out_pred = torch.cat((out_pred, self.get_predictions(varOutput)), 0)
 
                 loss_tensor_mean += loss_value
                 loss_val += display_loss
                 loss_val_norm += 1
 
-        if self.architecture_type not in AE_ARCH:
+        self.validation_auroc = None
+        if self.has_classifier_output():
             auroc_individual = self.compute_AUROC(out_gt, out_pred)
             auroc_mean = np.array(auroc_individual).mean()
+            self.validation_auroc = auroc_individual
+            if confidence_intervals:
+                from ValidationMetrics import bootstrap_auroc
+                class_ci, self.validation_auroc_ci = bootstrap_auroc(out_gt.cpu().numpy(), out_pred.cpu().numpy(),
+                                                                     self.run_parameters.bootstrap_resamples)
+                print_auroc_ci(class_ci, self.validation_auroc_ci, len(out_gt))
         else:
             auroc_mean = 0
         out_loss = loss_val / loss_val_norm
         loss_tensor_mean = loss_tensor_mean / loss_val_norm
         return out_loss, loss_tensor_mean, auroc_mean
 
-    def train(self, path_img_dir, path_file_train, path_file_validation, batch_size,
-              max_epochs, trans_resize_size, trans_crop_size, trans_rotation_angle, launch_timestamp,
-              checkpoint_classifier, checkpoint_encoder, checkpoint_combined):
-
-        # -------------------- SETTINGS: DATA AUGMENTATION
+    def get_transforms(self, trans_resize_size, trans_crop_size, trans_rotation_angle):
+        """
+        :return train (augmented) and validation/test transforms of the architecture
+        """
         if self.architecture_type == 'RES-NET-18':
             normalization_vec = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         else:
             normalization_vec = None
         transformSequence = data_augmentations(trans_resize_size, trans_crop_size,
-                                               normalization_vec, trans_rotation_angle)
+                                               normalization_vec, trans_rotation_angle,
+                                               num_output_chs=self.num_of_input_channels,
+                                               uint8_output=UINT8_TRANSFER)
 
         transformSequence_val = data_augmentations(trans_resize_size, trans_crop_size,
                                                    normalization_vec, None, center_crop=True,
-                                                   flip=False)
+                                                   flip=False, num_output_chs=self.num_of_input_channels,
+                                                   uint8_output=UINT8_TRANSFER)
+        if UINT8_TRANSFER:
+            self.device_transform = DeviceNormalize(self.num_of_input_channels, normalization_vec)
+        return transformSequence, transformSequence_val
+
+    def build_dataset(self, path_img_dir, path_file, transform_sequence, use_image_cache=True):
+        dataset = DatasetGenerator(pathImageDirectory=path_img_dir, pathDatasetFile=path_file,
+                                   transform=transform_sequence, num_img_chs=self.num_of_input_channels,
+                                   pathPyramidDirectory=PATH_PYRAMID_DIR, pyramid_levels=PYRAMID_LEVELS,
+                                   image_decoder=IMAGE_DECODER, reduced_decode=REDUCED_DECODE)
+        if use_image_cache and get_image_cache() is not None:
+            dataset.set_image_cache(image_cache)
+        return dataset
+
+    def get_data_loaders(self, path_img_dir, path_file_train, path_file_validation, batch_size, trans_resize_size,
+                         trans_crop_size, trans_rotation_angle):
+        """
+        :return train and validation DataLoaders (cached by the data loader factory), the loader of the validation
+                subsample (run parameter validation_subsample) is set in self.dataLoader_validation_subsample
+        """
+        # -------------------- SETTINGS: DATA AUGMENTATION
+        transformSequence, transformSequence_val = self.get_transforms(trans_resize_size, trans_crop_size,
+                                                                       trans_rotation_angle)
+        transform_key = (self.architecture_type, self.num_of_input_channels, trans_resize_size, trans_crop_size,
+                         trans_rotation_angle)
+        distillation_teacher = self.run_parameters.distillation_teacher
+        build_sampler = None
+        sampler_key = None
+        if self.run_parameters.hard_example_mining is not None:
+            from HardExampleMining import LossAwareSampler, HARD_EXAMPLE_SAMPLING
+        if self.run_parameters.hard_example_mining is not None and \
+                self.run_parameters.hard_example_mining == HARD_EXAMPLE_SAMPLING:
+            fraction = self.run_parameters.hard_example_fraction
+            warmup = self.run_parameters.hard_example_warmup
+            build_sampler = lambda dataset: LossAwareSampler(len(dataset), fraction, warmup)
+            sampler_key = (HARD_EXAMPLE_SAMPLING, fraction, warmup)
+        elif self.run_parameters.resume_checkpoint_interval is not None or \
+                self.run_parameters.resume_checkpoint is not None:
+            # the shuffled order of the epoch is saved in the resume checkpoints
+            from TrainingResume import ResumableSampler
+            seed = torch.initial_seed() % 2 ** 32
+            build_sampler = lambda dataset: ResumableSampler(len(dataset), seed)
+            sampler_key = ('resumable',)
+
         # -------------------- SETTINGS: DATASET BUILDERS
-        dataset_train = DatasetGenerator(pathImageDirectory=path_img_dir, pathDatasetFile=path_file_train,
-                                         transform=transformSequence, num_img_chs=self.num_of_input_channels)
-        dataset_validation = DatasetGenerator(pathImageDirectory=path_img_dir, pathDatasetFile=path_file_validation,
-                                              transform=transformSequence_val, num_img_chs=self.num_of_input_channels)
+        def build_train_dataset():
+            dataset = self.build_dataset(path_img_dir, path_file_train, transformSequence)
+            if distillation_teacher is not None:
+                # the teacher runs only on the images that are not in its cache
+                from Distillation import TeacherCache
+                dataset.set_soft_labels(TeacherCache(self.device, distillation_teacher).get(path_img_dir,
+                                                                                            path_file_train))
+            return dataset
 
-        self.num_sample_per_label_train = dataset_train.num_sample_per_label
-        self.num_sample_per_label_val = dataset_validation.num_sample_per_label
+        data_loader_factory = get_data_loader_factory()
+        dataLoader_train = data_loader_factory.get(
+            ('train', path_img_dir, path_file_train, distillation_teacher, sampler_key) + transform_key,
+            build_train_dataset, batch_size, shuffle=build_sampler is None, build_sampler=build_sampler,
+            **get_pin_memory_args())
+        if self.run_parameters.hard_example_mining is not None and \
+                isinstance(dataLoader_train.sampler, LossAwareSampler):
+            # a new resizing phase continues from the losses recorded at the previous input size
+            if self.hard_example_sampler is not None and self.hard_example_sampler is not dataLoader_train.sampler:
+                dataLoader_train.sampler.copy_losses(self.hard_example_sampler)
+            self.hard_example_sampler = dataLoader_train.sampler
+        # the samplers of the hard example mining and of the resume checkpoints are both ResumableSampler
+        self.train_sampler = dataLoader_train.sampler if build_sampler is not None else None
+        dataLoader_validation = data_loader_factory.get(
+            ('validation', path_img_dir, path_file_validation) + transform_key,
+            lambda: self.build_dataset(path_img_dir, path_file_validation, transformSequence_val),
+            batch_size, shuffle=False, **get_pin_memory_args())
 
-        dataLoader_train = DataLoader(dataset=dataset_train, batch_size=batch_size,
-                                      shuffle=True, num_workers=8, pin_memory=True)
-        dataLoader_validation = DataLoader(dataset=dataset_validation, batch_size=batch_size,
-                                           shuffle=False, num_workers=8, pin_memory=True)
+        validation_subsample = self.run_parameters.validation_subsample
+        if validation_subsample is not None and not self.run_parameters.async_validation:
+            # the subsample shares the dataset of the validation split (and its decoded-image cache keys)
+            from ValidationMetrics import stratified_subsample
+            dataset_validation = dataLoader_validation.dataset
+            self.dataLoader_validation_subsample = data_loader_factory.get(
+                ('validation_subsample', validation_subsample, path_img_dir, path_file_validation) + transform_key,
+                lambda: Subset(dataset_validation, stratified_subsample(dataset_validation.image_labels.numpy(),
+                                                                        validation_subsample)),
+                batch_size, shuffle=False, **get_pin_memory_args())
+            print('validation subsample: ', len(self.dataLoader_validation_subsample.dataset), '/',
+                  len(dataset_validation), ' images')
+
+        self.num_sample_per_label_train = dataLoader_train.dataset.num_sample_per_label
+        self.num_sample_per_label_val = dataLoader_validation.dataset.num_sample_per_label
+        return dataLoader_train, dataLoader_validation
+
+    def train(self, path_img_dir, path_file_train, path_file_validation, batch_size,
+              max_epochs, trans_resize_size, trans_crop_size, trans_rotation_angle, launch_timestamp,
+              checkpoint_classifier, checkpoint_encoder, checkpoint_combined):
+
+        # -------------------- RESUME CHECKPOINT of a preempted run (TrainingResume.py)
+        resume_state = None
+        if self.run_parameters.resume_checkpoint is not None:
+            resume_state = torch.load(self.run_parameters.resume_checkpoint, map_location=self.device)
+            if resume_state['batch_size'] != batch_size:
+                raise ValueError('the resumed run was trained with batch size ' + str(resume_state['batch_size']) +
+                                 ', not ' + str(batch_size))
+            # the checkpoints and the metrics log of the preempted run are continued
+            launch_timestamp = resume_state['launch_timestamp']
+            print('resumed from ', self.run_parameters.resume_checkpoint, ' epoch ', resume_state['init_epoch'] +
+                  resume_state['epoch'] + 1, ' batch ', resume_state['epoch_state']['batch'] + 1)
+        self.launch_timestamp = launch_timestamp
+        self.hard_example_sampler = None
+        dataLoader_train, dataLoader_validation = self.get_data_loaders(path_img_dir, path_file_train,
+                                                                        path_file_validation, batch_size,
+                                                                        trans_resize_size, trans_crop_size,
+                                                                        trans_rotation_angle)
+        if self.hard_example_sampler is not None:
+            # the cached loader may come from a previous run of the sweep
+            self.hard_example_sampler.reset()
 
         # -------------------- SETTINGS: OPTIMIZER & SCHEDULER  # TODO: add parameters of the optimizer
-        optimizer = optim.Adam(self.model.parameters(), lr=self.lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=self.weight_decay)
-        scheduler = ReduceLROnPlateau(optimizer, factor=self.decay_factor, patience=self.decay_patience, mode='min', verbose=True)
+        training_stages = self.run_parameters.training_stages
+        self.set_stage(get_scheduled_value(training_stages, 0, STAGE_JOINT))
+        optimizer = self.build_optimizer()
+        scheduler = self.build_scheduler(optimizer)
 
         # -------------------- LOAD CHECKPOINT
-        loss_train_list, loss_validation_list, init_epoch,_ = self.load_checkpoint(checkpoint_classifier, checkpoint_encoder, checkpoint_combined, optimizer)
+        start_epoch = 0
+        if resume_state is None:
+            loss_train_list, loss_validation_list, init_epoch,_ = self.load_checkpoint(checkpoint_classifier, checkpoint_encoder, checkpoint_combined, optimizer, scheduler)
+            stage = get_scheduled_value(training_stages, init_epoch, STAGE_JOINT)
+        else:
+            load_model_weights(self.model, resume_state)
+            loss_train_list = resume_state['loss_train_list']
+            loss_validation_list = resume_state['loss_validation_list']
+            init_epoch = resume_state['init_epoch']
+            start_epoch = resume_state['epoch']
+            stage = resume_state['stage']
+        if stage != self.stage:
+            # resumed in a later stage
+            self.set_stage(stage)
+            optimizer = self.build_optimizer()
+            scheduler = self.build_scheduler(optimizer)
+        self.stage_stats = OrderedDict()
+        if resume_state is not None:
+            optimizer.load_state_dict(resume_state['optimizer'])
+            scheduler.load_state_dict(resume_state['scheduler'])
+            self.stage_stats = resume_state['stage_stats']
 
         # ---- TRAIN THE NETWORK
         min_loss = 100000
         max_auroc_mean = 0
+        min_stage_loss = float('inf')
 
 
         print('Run params: lr ', self.lr, ' weight decay ', self.weight_decay, ' patience ', self.decay_patience,
               ' lambda loss ', self.lambda_loss)
-        s = time.time()
-        loss_validation, loss_validation_tensor, auroc_mean = self.epoch_validation(dataLoader_validation)
-        print('val epoch time: ', time.time() - s)
-        torch.save({'model_type': self.architecture_type,
-                    'epoch': 0,
-                    'state_dict': self.model.state_dict(),
-                    'best_loss': min_loss,
-                    'optimizer': optimizer.state_dict(),
-                    'loss_train_list': loss_train_list,
-                    'loss_validation_list': loss_validation_list,
-                    'run_parameters': self.run_parameters},
-                   'm-' + self.architecture_type + '-' + launch_timestamp + '.pth.tar')
-        print("-------> EpochID: {}/{}, mean validation loss: {}, AUROC mean: {}".format(init_epoch,
-                                                                                         init_epoch + max_epochs,
-                                                                                         loss_validation, auroc_mean))
-        for epoch_id in range(0, max_epochs):
-            timestampTime = time.strftime("%H%M%S")
-            timestampDate = time.strftime("%d%m%Y")
-            timestampSTART = timestampDate + '-' + timestampTime
-            s = time.time()
-            loss_train = self.epoch_train(epoch_id, dataLoader_train, optimizer)
-            print('train epoch time: ', time.time() - s)
-            s = time.time()
-            loss_validation, loss_validation_tensor, auroc_mean = self.epoch_validation(dataLoader_validation)
-            print('val epoch time: ', time.time() - s)
+        resize_schedule = self.run_parameters.resize_schedule
+        input_size = get_scheduled_input_size(resize_schedule, init_epoch + start_epoch)
+        if input_size is not None:
+            dataLoader_train, dataLoader_validation = self.get_data_loaders(
+                path_img_dir, path_file_train, path_file_validation, batch_size,
+                *get_input_settings(self.architecture_type, input_size)[:3])
+        target_auroc = self.run_parameters.target_auroc
+        train_time = 0
+        time_to_target_auroc = None
+        min_loss_train = None
+        validation_settings = (trans_resize_size, trans_crop_size) if input_size is None else \
+            get_input_settings(self.architecture_type, input_size)[:2]
+        epoch_state = None
+        if resume_state is not None:
+            # the train loader continues the saved epoch order from the next batch
+            epoch_state = resume_state['epoch_state']
+            self.train_sampler.load_state_dict(resume_state['sampler'], epoch_state['batch'] * batch_size)
+        # ---- metrics log of the run, plotted offline (MetricsLog.py)
+        self.metrics = MetricsSink(get_metrics_path('m-' + self.architecture_type + '-' + launch_timestamp +
+                                                    '.pth.tar'))
+        self.metrics.log('run', model_type=self.architecture_type, launch_timestamp=launch_timestamp,
+                         run_parameters=vars(self.run_parameters), batch_size=batch_size, max_epochs=max_epochs,
+                         init_epoch=init_epoch)
+        validator = None
+        if self.run_parameters.async_validation:
+            from AsyncValidation import AsyncValidator
+            validator = AsyncValidator(self, path_img_dir, path_file_validation, batch_size,
+                                       ASYNC_VALIDATION_THREADS, ASYNC_VALIDATION_WORKERS)
+
+        def save_metadata(path_checkpoint, epoch, loss_validation, auroc_mean, full_validation=True):
+            """
+            Sidecar metadata of a saved checkpoint (CheckpointIndex.py)
+            :param full_validation - False if the validation results are of the validation subsample
+            """
+            write_metadata(path_checkpoint, build_metadata(
+                self.architecture_type, epoch, optimizer, self.run_parameters, min_loss, loss_validation,
+                auroc_mean if self.has_classifier_output() else None, loss_train_list, loss_validation_list,
+                full_validation, input_size=validation_settings[1], stage=self.stage,
+                launch_timestamp=launch_timestamp))
+
+        checkpoint_writer = None
+        path_resume = None
+        if self.run_parameters.resume_checkpoint_interval is not None or resume_state is not None:
+            from TrainingResume import CheckpointWriter, get_resume_path, get_epoch_state
+            if self.run_parameters.resume_checkpoint_interval is not None:
+                checkpoint_writer = CheckpointWriter()
+            path_resume = get_resume_path(self.architecture_type, launch_timestamp)
+
+        def save_resume_checkpoint(epoch_id, epoch_state):
+            """
+            Resume checkpoint of the run at a batch of the epoch (TrainingResume.py), saved in the background.
+            """
+            checkpoint_writer.save({'model_type': self.architecture_type,
+                                    'launch_timestamp': launch_timestamp,
+                                    'batch_size': batch_size,
+                                    'init_epoch': init_epoch,
+                                    'epoch': epoch_id,
+                                    'epoch_state': epoch_state,
+                                    'state_dict': self.model.state_dict(),
+                                    'optimizer': optimizer.state_dict(),
+                                    'scheduler': scheduler.state_dict(),
+                                    'stage': self.stage,
+                                    'sampler': self.train_sampler.state_dict(),
+                                    'loss_train_list': loss_train_list,
+                                    'loss_validation_list': loss_validation_list,
+                                    'stage_stats': self.stage_stats,
+                                    'progress': {'min_loss': min_loss, 'max_auroc_mean': max_auroc_mean,
+                                                 'min_stage_loss': min_stage_loss, 'min_loss_train': min_loss_train,
+                                                 'train_time': train_time, 'time_to_target_auroc': time_to_target_auroc,
+                                                 'best_subsample_score': best_subsample_score},
+                                    'run_parameters': self.run_parameters},
+                                   path_resume)
+
+        def process_validation(epoch_id, loss_validation, loss_validation_value, auroc_mean, state_dict, loss_train,
+                               epoch_train_time, select_best=True, auroc=None, optimizer_state=None):
+            """
+            Validation result of an epoch: scheduler step, metrics log, best and last checkpoints.
+            With the asynchronous validation it is called when the result arrives (with the weights snapshot).
+            :param select_best - False for a subsample validation: the best model is selected on the full split
+            :param auroc - AUROC of every class (not returned by the asynchronous validation)
+            :param optimizer_state - asynchronous validation: optimizer state snapshotted with the weights (the live
+                                     optimizer has trained further)
+            """
+            nonlocal max_auroc_mean, min_stage_loss, min_loss, min_loss_train, time_to_target_auroc
             print("-------> EpochID: {}/{}, mean train loss: {}".format(init_epoch + epoch_id + 1,
                                                                         init_epoch + max_epochs, loss_train))
             print("-------> EpochID: {}/{}, mean validation loss: {}, AUROC mean: {}".format(init_epoch + epoch_id + 1,
                                                                                              init_epoch + max_epochs,
                                                                                              loss_validation,auroc_mean))
+            if select_best and target_auroc is not None and time_to_target_auroc is None and \
+                    auroc_mean >= target_auroc:
+                time_to_target_auroc = epoch_train_time
+                print('-------> AUROC mean target ', target_auroc, ' reached after ', epoch_id + 1,
+                      ' epochs, train time: ', time_to_target_auroc)
             loss_train_list.append(loss_train)
             loss_validation_list.append(loss_validation)
 
-            if epoch_id % 3 == 0:
-                plt_data(loss_train_list, loss_validation_list, "Loss_train_vs_validation_" + self.architecture_type,
-                         True, "")
+            self.metrics.log('epoch', epoch=init_epoch + epoch_id + 1, loss_train=loss_train,
+                             loss_validation=loss_validation,
+                             auroc_mean=auroc_mean if self.has_classifier_output() else None, auroc=auroc,
+                             lr=get_lr(optimizer), train_time=epoch_train_time, stage=self.stage,
+                             input_size=validation_settings[1], full_validation=select_best)
 
             timestampTime = time.strftime("%H%M%S")
             timestampDate = time.strftime("%d%m%Y")
             timestampEND = timestampDate + '-' + timestampTime
 
-            scheduler.step(loss_validation_tensor.item())
+            scheduler.step(loss_validation_value)
+            checkpoint_optimizer_state = optimizer.state_dict()
+            if optimizer_state is not None:
+                # the scheduler is stepped only here, in epoch order: the live scheduler state and lr are those of
+                # this epoch, the moments are those of the snapshot
+                checkpoint_optimizer_state = dict(optimizer_state, param_groups=[
+                    dict(group, lr=live_group['lr'])
+                    for group, live_group in zip(optimizer_state['param_groups'], optimizer.param_groups)])
 
-            if auroc_mean > max_auroc_mean:
-                max_auroc_mean = auroc_mean
+            if self.has_classifier_output():
+                is_best = auroc_mean > max_auroc_mean
+            else:
+                # auto-encoder stage: no AUROC, the best model has the lowest reconstruction loss
+                is_best = loss_validation < min_stage_loss
+            if select_best and is_best:
+                max_auroc_mean = max(auroc_mean, max_auroc_mean)
+                min_stage_loss = loss_validation
                 min_loss = loss_validation
                 min_loss_train = loss_train
                 torch.save({'model_type': self.architecture_type,
                             'epoch': epoch_id + 1,
-                            'state_dict': self.model.state_dict(),
+                            'state_dict': state_dict,
                             'best_loss': min_loss,
-                            'optimizer': optimizer.state_dict(),
+                            'optimizer': checkpoint_optimizer_state,
+                            'scheduler': scheduler.state_dict(),
                             'loss_train_list': loss_train_list,
                             'loss_validation_list': loss_validation_list},
                            'm-' + self.architecture_type + '-' + launch_timestamp + '.pth.tar')
+                save_metadata('m-' + self.architecture_type + '-' + launch_timestamp + '.pth.tar', epoch_id + 1,
+                              loss_validation, auroc_mean)
                 print('Epoch [' + str(epoch_id + 1) + '] [save] [' + timestampEND + '] loss= ' + str(
                     loss_validation) + ' lr=' + str(get_lr(optimizer)) + ' auroc mean=' + str(max_auroc_mean))
             else:
@@ -412,14 +1074,172 @@ class ModelTrainer:
 
             torch.save({'model_type': self.architecture_type,
                         'epoch': epoch_id + 1,
-                        'state_dict': self.model.state_dict(),
+                        'state_dict': state_dict,
                         'best_loss': min_loss,
-                        'optimizer': optimizer.state_dict(),
+                        'optimizer': checkpoint_optimizer_state,
+                        'scheduler': scheduler.state_dict(),
                         'loss_train_list': loss_train_list,
                         'loss_validation_list': loss_validation_list},
                        'm-' + self.architecture_type + '-' + launch_timestamp + '_last.pth.tar')
+            save_metadata('m-' + self.architecture_type + '-' + launch_timestamp + '_last.pth.tar', epoch_id + 1,
+                          loss_validation, auroc_mean, full_validation=select_best)
+
+        def process_async_results(results):
+            for epoch_id, (loss_validation, loss_validation_value, auroc_mean, validation_time), epoch_info in results:
+                if epoch_id < 0:
+                    # validation before the first epoch
+                    print("-------> EpochID: {}/{}, mean validation loss: {}, AUROC mean: {}".format(
+                        init_epoch, init_epoch + max_epochs, loss_validation, auroc_mean))
+                    continue
+                print('val epoch time (evaluator process): ', validation_time)
+                process_validation(epoch_id, loss_validation, loss_validation_value, auroc_mean,
+                                   epoch_info['state_dict'], epoch_info['loss_train'], epoch_info['train_time'],
+                                   optimizer_state=epoch_info['optimizer_state'])
+
+        def validate_epoch(epoch_id):
+            """
+            Validate on the subsample, and on the full split when it is due (full_validation_interval, the last epoch,
+            the first validation of a phase / stage) or when the subsample AUROC exceeds the subsample AUROC of the
+            last full validation by more than the half-width of its bootstrap confidence interval.
+            :return validation loss, loss value for the scheduler (always the subsample loss when there is a
+                    subsample: its stratification over-represents the rare positives, the losses of the two splits
+                    are not comparable), AUROC mean, True if the full split was validated
+            """
+            nonlocal best_subsample_score
+            if self.dataLoader_validation_subsample is not None:
+                s = time.time()
+                loss_validation, loss_validation_tensor, auroc_mean = self.epoch_validation(
+                    self.dataLoader_validation_subsample, confidence_intervals=True)
+                print('val (subsample) epoch time: ', time.time() - s)
+                scheduler_loss_value = loss_validation_tensor.item()
+                subsample_score = auroc_mean if self.has_classifier_output() else -loss_validation
+                full_validation_interval = self.run_parameters.full_validation_interval
+                is_full_validation_due = best_subsample_score == -float('inf') or epoch_id == max_epochs - 1 or (
+                    full_validation_interval is not None and (epoch_id + 1) % full_validation_interval == 0)
+                if not is_full_validation_due and self.has_classifier_output() and \
+                        self.validation_auroc_ci is not None:
+                    # the improvement is significant only beyond the noise of the subsample estimate
+                    ci_half_width = (self.validation_auroc_ci[2] - self.validation_auroc_ci[1]) / 2
+                    is_full_validation_due = subsample_score - best_subsample_score > ci_half_width
+                if not is_full_validation_due:
+                    return loss_validation, scheduler_loss_value, auroc_mean, False
+                best_subsample_score = max(best_subsample_score, subsample_score)
+            s = time.time()
+            loss_validation, loss_validation_tensor, auroc_mean = self.epoch_validation(dataLoader_validation)
+            print('val epoch time: ', time.time() - s)
+            if self.dataLoader_validation_subsample is not None:
+                return loss_validation, scheduler_loss_value, auroc_mean, True
+            return loss_validation, loss_validation_tensor.item(), auroc_mean, True
+
+        best_subsample_score = -float('inf')
+        loss_validation, auroc_mean = None, None
+        if resume_state is not None:
+            # the initial validation and checkpoint were done by the preempted run
+            progress = resume_state['progress']
+            min_loss, max_auroc_mean, min_stage_loss = progress['min_loss'], progress['max_auroc_mean'], \
+                progress['min_stage_loss']
+            min_loss_train, train_time = progress['min_loss_train'], progress['train_time']
+            time_to_target_auroc = progress['time_to_target_auroc']
+            best_subsample_score = progress['best_subsample_score']
+        else:
+            is_full_validation = True
+            if validator is None:
+                loss_validation, _, auroc_mean, is_full_validation = validate_epoch(-1)
+                print("-------> EpochID: {}/{}, mean validation loss: {}, AUROC mean: {}".format(
+                    init_epoch, init_epoch + max_epochs, loss_validation, auroc_mean))
+            else:
+                validator.submit(-1, *validation_settings)
+            torch.save({'model_type': self.architecture_type,
+                        'epoch': 0,
+                        'state_dict': self.model.state_dict(),
+                        'best_loss': min_loss,
+                        'optimizer': optimizer.state_dict(),
+                        'scheduler': scheduler.state_dict(),
+                        'loss_train_list': loss_train_list,
+                        'loss_validation_list': loss_validation_list,
+                        'run_parameters': self.run_parameters},
+                       'm-' + self.architecture_type + '-' + launch_timestamp + '.pth.tar')
+            save_metadata('m-' + self.architecture_type + '-' + launch_timestamp + '.pth.tar', 0, loss_validation,
+                          auroc_mean, full_validation=is_full_validation)
+        for epoch_id in range(start_epoch, max_epochs):
+            timestampTime = time.strftime("%H%M%S")
+            timestampDate = time.strftime("%d%m%Y")
+            timestampSTART = timestampDate + '-' + timestampTime
+            epoch_input_size = get_scheduled_input_size(resize_schedule, init_epoch + epoch_id, input_size)
+            epoch_stage = get_scheduled_value(training_stages, init_epoch + epoch_id, STAGE_JOINT)
+            if validator is not None and (epoch_input_size != input_size or epoch_stage != self.stage):
+                # the pending results belong to the previous phase / stage
+                process_async_results(validator.get_all_results())
+            if epoch_input_size != input_size:
+                # new resizing phase - the best AUROC is tracked only within the phase (compared at the same size)
+                input_size = epoch_input_size
+                dataLoader_train, dataLoader_validation = self.get_data_loaders(
+                    path_img_dir, path_file_train, path_file_validation, batch_size,
+                    *get_input_settings(self.architecture_type, input_size)[:3])
+                validation_settings = get_input_settings(self.architecture_type, input_size)[:2]
+                max_auroc_mean = 0
+                best_subsample_score = -float('inf')
+            if epoch_stage != self.stage:
+                # new training stage - new optimizer (of the trained parameters) and scheduler, the best model is
+                # tracked within the stage
+                print('-------> EpochID: {}, training stage: {}'.format(init_epoch + epoch_id + 1, epoch_stage))
+                self.set_stage(epoch_stage)
+                optimizer = self.build_optimizer()
+                scheduler = self.build_scheduler(optimizer)
+                max_auroc_mean = 0
+                min_stage_loss = float('inf')
+                best_subsample_score = -float('inf')
+            if checkpoint_writer is not None and epoch_state is None:
+                # resume point at the start of the epoch (after the validation of the previous epoch)
+                save_resume_checkpoint(epoch_id, get_epoch_state())
+            self.reset_peak_memory()
+            s = time.time()
+            loss_train = self.epoch_train(epoch_id, dataLoader_train, optimizer, epoch_state,
+                                          None if checkpoint_writer is None else
+                                          lambda state: save_resume_checkpoint(epoch_id, state))
+            # a resumed epoch includes the train time before the preemption
+            epoch_time = time.time() - s + (0 if epoch_state is None else epoch_state['train_time'])
+            epoch_state = None
+            print('train epoch time: ', epoch_time)
+            train_time += epoch_time
+            self.update_stage_stats(epoch_time, len(dataLoader_train.dataset))
+            if validator is None:
+                loss_validation, loss_validation_value, auroc_mean, is_full_validation = validate_epoch(epoch_id)
+                process_validation(epoch_id, loss_validation, loss_validation_value, auroc_mean,
+                                   self.model.state_dict(), loss_train, train_time, select_best=is_full_validation,
+                                   auroc=self.validation_auroc)
+            else:
+                # training continues while the snapshot is validated: at most one epoch is left pending, the
+                # result of this epoch is waited for up to async_validation_wait seconds
+                validator.submit(epoch_id, *validation_settings, optimizer=optimizer, loss_train=loss_train,
+                                 train_time=train_time)
+                process_async_results(validator.get_results(wait_for=range(-1, epoch_id), timeout=None))
+                if self.run_parameters.async_validation_wait:
+                    process_async_results(validator.get_results(wait_for=[epoch_id],
+                                                                timeout=self.run_parameters.async_validation_wait))
+            if image_cache is not None:
+                print('Image cache: ', image_cache.get_stats())
+                image_cache.reset_stats()
+
+        if validator is not None:
+            process_async_results(validator.get_all_results())
+            validator.close()
+        self.metrics.close()
+        self.metrics = None
+        if checkpoint_writer is not None:
+            checkpoint_writer.wait()
+            print('resume checkpoints: ', checkpoint_writer.stats)
+        if path_resume is not None and os.path.exists(path_resume):
+            # the run is finished, its resume checkpoint is not needed
+            os.remove(path_resume)
 
         print("finish training!")
+        if training_stages is not None:
+            self.print_stage_stats()
+        self.time_to_target_auroc = time_to_target_auroc
+        self.train_time = train_time
+        if target_auroc is not None:
+            print('time to AUROC mean target ', target_auroc, ': ', time_to_target_auroc)
         return min_loss_train,min_loss
 
     # ---- Test the trained network
@@ -459,40 +1279,30 @@ class ModelTrainer:
                                                                                  checkpoint_encoder,
                                                                                  checkpoint_combined)
         # -------------------- SETTINGS: DATA AUGMENTATION
-        if self.architecture_type == 'RES-NET-18':
-            normalization_vec = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-        else:
-            normalization_vec = None
-
-        transformSequence = data_augmentations(trans_resize_size, trans_crop_size,
-                                               normalization_vec, None, center_crop=True, flip=False)
+        _, transformSequence = self.get_transforms(trans_resize_size, trans_crop_size, None)
 
-        dataset_test = DatasetGenerator(pathImageDirectory=path_img_dir, pathDatasetFile=path_file_test,
-                                        transform=transformSequence, num_img_chs=self.num_of_input_channels)
-        data_loader_test = DataLoader(dataset=dataset_test, batch_size=batch_size, num_workers=8,
-                                      shuffle=False, pin_memory=True)
+        # the test set is read once: no image cache and no cached loader
+        dataset_test = self.build_dataset(path_img_dir, path_file_test, transformSequence, use_image_cache=False)
+        data_loader_test = get_data_loader_factory().create(dataset_test, batch_size, shuffle=False,
+                                                      persistent_workers=False, **get_pin_memory_args())
 
         self.num_sample_per_label_val = dataset_test.num_sample_per_label
         loss_test, _, auroc_mean = self.epoch_validation(data_loader_test)
 
 
-        ind_name_start = len(path_trained_model) - path_trained_model[::-1].find('\\')
-        ind_name_end = path_trained_model.find('.pth')
-
-        name = path_trained_model[ind_name_start:ind_name_end]
+        # ---- the loss curves of the checkpoint are plotted offline from its metrics log (MetricsLog.py)
+        metrics = MetricsSink(get_metrics_path(path_trained_model))
+        metrics.log('test', checkpoint=path_trained_model, model_type=self.architecture_type, loss=loss_test,
+                    auroc_mean=auroc_mean if self.has_classifier_output() else None, auroc=self.validation_auroc,
+                    weight_decay=run_parameters.weight_decay, lr=run_parameters.lr,
+                    lambda_loss=run_parameters.lambda_loss, loss_train_list=loss_train_list,
+                    loss_validation_list=loss_validation_list)
+        metrics.close()
         if self.architecture_type in COMBINED_ARCH:
-            plt_data(loss_train_list, loss_validation_list,
-                     name + '_decay_' + str(run_parameters.weight_decay) + '_lr_' + str(run_parameters.lr) + '_lambda_loss_' + str(run_parameters.lambda_loss) + '_AUROCmean_' + str(
-                         np.round(1000 * auroc_mean) / 1000),True, "")
             print(path_trained_model, ' decay: ', run_parameters.weight_decay, ' lr: ', run_parameters.lr, ' lambda loss: ', run_parameters.lambda_loss, 'AUROC mean ', auroc_mean)
         elif self.architecture_type in AE_ARCH:
-            plt_data(loss_train_list, loss_validation_list,
-                     name + '_decay_' + str(run_parameters.weight_decay) + '_lr_' + str(run_parameters.lr) + '_lambda_loss_' + str(run_parameters.lambda_loss) ,True, "")
             print(path_trained_model, ' decay: ', run_parameters.weight_decay, ' lr: ', run_parameters.lr, ' lambda loss: ', run_parameters.lambda_loss)
         elif self.architecture_type in CLASSIFIER_ARCH:
-            plt_data(loss_train_list, loss_validation_list,
-                     name + '_decay_' + str(run_parameters.weight_decay) + '_lr_' + str(run_parameters.lr) + '_AUROCmean_' + str(
-                         np.round(1000 * auroc_mean) / 1000),True, "")
             print(path_trained_model, ' decay: ', run_parameters.weight_decay, ' lr: ', run_parameters.lr, 'AUROC mean ', auroc_mean)
 
         return auroc_mean, loss_test
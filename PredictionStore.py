@@ -0,0 +1,316 @@
+"""
+Persistent prediction store and incremental scoring.
+
+The per-class probabilities of every scored image are kept in an SQLite database (PATH_PREDICTION_STORE in Config.py),
+keyed by the content hash (SHA-1) of the image file and by the model key (the content hash of the checkpoint file and
+the input size). Scoring a dataset file or a folder looks up the store first: only the new or changed images are
+decoded and run through the model. The content hash of a file is computed again only if its size or modification
+time changed (files table), so scoring an unchanged database costs a stat per image and the store lookups.
+
+Watch-folder mode scores the images that arrive in a folder, in micro-batches:
+    python PredictionStore.py --checkpoint m-RES-NET-18-<timestamp>.pth.tar --watch <folder>
+Throughput of a 1% delta (1% of the predictions are removed from the store and the dataset file is scored again):
+    python PredictionStore.py --checkpoint <checkpoint> --dataset-file <file> --benchmark-delta 0.01
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from Config import PATH_PREDICTION_STORE, NUM_CLASSES, PATH_IMG_DIR
+from HardwareTuner import get_profile_batch_size, apply_thread_settings
+
+HASH_BLOCK_SIZE = 2 ** 20
+# ---- number of keys per lookup query (SQLite limits the number of query parameters)
+SQLITE_MAX_VARIABLES = 500
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def file_hash(path):
+    """
+    :return SHA-1 of the file content (hex)
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file_descriptor:
+        for block in iter(lambda: file_descriptor.read(HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def chunks(items, size=SQLITE_MAX_VARIABLES):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class PredictionStore:
+    # ---- path_store - SQLite database file, created if it does not exist
+    def __init__(self, path_store=PATH_PREDICTION_STORE):
+        self.path_store = path_store
+        os.makedirs(os.path.dirname(path_store) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path_store)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files '
+                                '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, image_hash TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                '(image_hash TEXT, model_key TEXT, probabilities BLOB, '
+                                'PRIMARY KEY (image_hash, model_key))')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get_image_hashes(self, paths):
+        """
+        :return content hash of every file, hashed again only if its size or modification time changed
+        """
+        known = {}
+        for chunk in chunks(paths):
+            rows = self.connection.execute('SELECT path, size, mtime, image_hash FROM files WHERE path IN (' +
+                                           ','.join('?' * len(chunk)) + ')', chunk)
+            known.update((row[0], row[1:]) for row in rows)
+        image_hashes = []
+        updated = []
+        for path in paths:
+            stat = os.stat(path)
+            entry = known.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                image_hashes.append(entry[2])
+            else:
+                image_hash = file_hash(path)
+                image_hashes.append(image_hash)
+                updated.append((path, stat.st_size, stat.st_mtime, image_hash))
+        if len(updated) > 0:
+            self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', updated)
+            self.connection.commit()
+        return image_hashes
+
+    def get_predictions(self, image_hashes, model_key):
+        """
+        :return dict: image hash -> probabilities (C array), of the images that are in the store
+        """
+        predictions = {}
+        for chunk in chunks(list(set(image_hashes))):
+            rows = self.connection.execute('SELECT image_hash, probabilities FROM predictions WHERE model_key = ? '
+                                           'AND image_hash IN (' + ','.join('?' * len(chunk)) + ')',
+                                           [model_key] + chunk)
+            predictions.update((image_hash, np.frombuffer(blob, dtype=np.float32)) for image_hash, blob in rows)
+        return predictions
+
+    def put_predictions(self, image_hashes, model_key, probabilities):
+        self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                    [(image_hash, model_key, np.asarray(probability, dtype=np.float32).tobytes())
+                                     for image_hash, probability in zip(image_hashes, probabilities)])
+        self.connection.commit()
+
+    def delete_predictions(self, image_hashes, model_key):
+        for chunk in chunks(list(set(image_hashes))):
+            self.connection.execute('DELETE FROM predictions WHERE model_key = ? AND image_hash IN (' +
+                                    ','.join('?' * len(chunk)) + ')', [model_key] + chunk)
+        self.connection.commit()
+
+
+class IncrementalScorer:
+    # ---- path_checkpoint - checkpoint of any architecture with a classifier output (read from the checkpoint), it is
+    # ---- loaded only when there are images to score
+    # ---- input_size - crop size of the input image, None for the default size of the architecture
+    # ---- batch_size - None for the test batch size of the host profile (HardwareTuner.py), or 32
+    def __init__(self, device, path_checkpoint, store=None, input_size=None, batch_size=None):
+        self.device = device
+        self.path_checkpoint = path_checkpoint
+        self.store = store if store is not None else PredictionStore()
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.model_key = file_hash(path_checkpoint) + '-' + str(input_size or 'default')
+        self.checkpoint = None
+        self.last_stats = None
+
+    def get_checkpoint(self):
+        if self.checkpoint is None:
+            from CheckpointEvaluator import LoadedCheckpoint
+            self.checkpoint = LoadedCheckpoint(self.device, self.path_checkpoint, input_size=self.input_size)
+            if not self.checkpoint.trainer.has_classifier_output():
+                raise ValueError(self.checkpoint.architecture_type + ' has no classifier output')
+            if self.batch_size is None:
+                self.batch_size = get_profile_batch_size('test', self.checkpoint.architecture_type, [self.input_size],
+                                                         32)
+        return self.checkpoint
+
+    def run_model(self, path_img_dir, image_names):
+        """
+        :return N x C probabilities of the images (paths relative to path_img_dir)
+        """
+        import torch
+        from ModelTrainer import get_data_loader_factory, get_pin_memory_args
+        checkpoint = self.get_checkpoint()
+        # the dataset reads its index from a dataset file: a temporary one with the image names (no labels)
+        file_descriptor, path_file = tempfile.mkstemp(suffix='.txt', text=True)
+        try:
+            with os.fdopen(file_descriptor, 'w') as dataset_file:
+                dataset_file.write(''.join(name + '\n' for name in image_names))
+            dataset = checkpoint.trainer.build_dataset(path_img_dir, path_file, checkpoint.transform,
+                                                       use_image_cache=False)
+        finally:
+            os.remove(path_file)
+        data_loader = get_data_loader_factory().create(dataset, self.batch_size, shuffle=False,
+                                                       persistent_workers=False, **get_pin_memory_args())
+        probabilities = []
+        with torch.no_grad():
+            for input_img, _ in data_loader:
+                varOutput = checkpoint.trainer.model(checkpoint.trainer.input_to_device(input_img))
+                probabilities.append(checkpoint.trainer.get_class_probabilities(varOutput).cpu().numpy())
+        return np.concatenate(probabilities)
+
+    def score(self, path_img_dir, image_names):
+        """
+        Score the images, only the images that are not in the store (for this model) run through the model.
+        :return N x C probabilities (in the order of image_names), the counts and times are kept in self.last_stats
+        """
+        s = time.time()
+        image_hashes = self.store.get_image_hashes([os.path.join(path_img_dir, name) for name in image_names])
+        predictions = self.store.get_predictions(image_hashes, self.model_key)
+        lookup_time = time.time() - s
+        # images with the same content are scored once
+        missing = OrderedDict()
+        for name, image_hash in zip(image_names, image_hashes):
+            if image_hash not in predictions and image_hash not in missing:
+                missing[image_hash] = name
+        model_time = 0
+        if len(missing) > 0:
+            s = time.time()
+            probabilities = self.run_model(path_img_dir, list(missing.values()))
+            self.store.put_predictions(list(missing), self.model_key, probabilities)
+            predictions.update(zip(missing, probabilities))
+            model_time = time.time() - s
+        self.last_stats = {'num_images': len(image_names), 'num_scored': len(missing), 'lookup_time': lookup_time,
+                           'model_time': model_time}
+        print('scored {} images: {} from the store, {} by the model (lookup {:.2f} sec, model {:.2f} sec)'.format(
+            len(image_names), len(image_names) - len(missing), len(missing), lookup_time, model_time))
+        if len(image_names) == 0:
+            return np.zeros((0, NUM_CLASSES), dtype=np.float32)
+        return np.stack([predictions[image_hash] for image_hash in image_hashes])
+
+    def score_dataset_file(self, path_img_dir, path_file):
+        from Distillation import get_dataset_names
+        return self.score(path_img_dir, get_dataset_names(path_file))
+
+    def watch(self, path_watch_dir, micro_batch_size=64, max_wait=10, poll_interval=1, max_idle=None,
+              on_scored=None):
+        """
+        Score the images that arrive in the folder, in micro-batches: a batch is scored when micro_batch_size images
+        are ready, or max_wait seconds after the first of them arrived. An image is ready when it was not modified
+        for poll_interval seconds (its copy is complete). Stops on KeyboardInterrupt or after max_idle seconds
+        without new images (None - never).
+        :param on_scored - function called with the image names and their N x C probabilities of every batch,
+                           None - print the mean probability of every image
+        """
+        scored = {}
+        ready = OrderedDict()
+        first_ready_time = None
+        last_arrival_time = time.time()
+        print('watching ', path_watch_dir, ' (model ', self.model_key, ')')
+        try:
+            while True:
+                now = time.time()
+                for name in sorted(os.listdir(path_watch_dir)):
+                    if not name.lower().endswith(IMAGE_EXTENSIONS) or name in ready:
+                        continue
+                    stat = os.stat(os.path.join(path_watch_dir, name))
+                    signature = (stat.st_size, stat.st_mtime)
+                    if scored.get(name) == signature or now - stat.st_mtime < poll_interval:
+                        continue
+                    ready[name] = signature
+                    last_arrival_time = now
+                    if first_ready_time is None:
+                        first_ready_time = now
+                while len(ready) >= micro_batch_size or (len(ready) > 0 and now - first_ready_time >= max_wait):
+                    names = list(ready)[:micro_batch_size]
+                    probabilities = self.score(path_watch_dir, names)
+                    for name in names:
+                        scored[name] = ready.pop(name)
+                    first_ready_time = now if len(ready) > 0 else None
+                    if on_scored is not None:
+                        on_scored(names, probabilities)
+                    else:
+                        for name, probability in zip(names, probabilities):
+                            print('{} {:.4f}'.format(name, probability.mean()))
+                if max_idle is not None and len(ready) == 0 and now - last_arrival_time > max_idle:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        return scored
+
+
+def benchmark_delta(scorer, path_img_dir, path_file, delta=0.01, seed=0):
+    """
+    Throughput of scoring the dataset file when a fraction delta of its images is new: the dataset file is scored
+    (filling the store), the predictions of a random delta of the images are removed and the file is scored again.
+    :return dict: images per second of the delta pass and of the model (the throughput of a full re-scoring)
+    """
+    from Distillation import get_dataset_names
+    image_names = get_dataset_names(path_file)
+    scorer.score(path_img_dir, image_names)
+    rng = np.random.RandomState(seed)
+    delta_names = [image_names[index] for index in rng.choice(len(image_names), max(1, int(round(
+        delta * len(image_names)))), replace=False)]
+    scorer.store.delete_predictions(scorer.store.get_image_hashes(
+        [os.path.join(path_img_dir, name) for name in delta_names]), scorer.model_key)
+    s = time.time()
+    scorer.score(path_img_dir, image_names)
+    delta_time = time.time() - s
+    stats = scorer.last_stats
+    results = {'num_images': len(image_names),
+               'num_scored': stats['num_scored'],
+               'delta_time': delta_time,
+               'delta_images_per_sec': len(image_names) / max(delta_time, 1e-9),
+               'model_images_per_sec': stats['num_scored'] / max(stats['model_time'], 1e-9)}
+    print('{:.1%} delta of {} images: {:.1f} sec ({:.0f} images/sec; lookup {:.2f} sec, model {:.2f} sec), '
+          'full re-scoring at the model throughput: {:.1f} sec ({:.1f} images/sec)'.format(
+            delta, len(image_names), delta_time, results['delta_images_per_sec'], stats['lookup_time'],
+            stats['model_time'], len(image_names) / results['model_images_per_sec'],
+            results['model_images_per_sec']))
+    return results
+
+
+def add_arguments(parser):
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--store', default=PATH_PREDICTION_STORE)
+    parser.add_argument('--input-size', type=int, default=None, help='crop size, default size of the architecture')
+    parser.add_argument('--batch-size', type=int, default=None, help='default: the host profile, or 32')
+    parser.add_argument('--img-dir', default=PATH_IMG_DIR)
+    parser.add_argument('--dataset-file', help='score the images of the dataset file')
+    parser.add_argument('--watch', help='score the images that arrive in the folder')
+    parser.add_argument('--micro-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait', type=float, default=10, help='seconds before a partial micro-batch is scored')
+    parser.add_argument('--benchmark-delta', type=float, default=None,
+                        help='with --dataset-file: throughput when this fraction of the images is new')
+
+
+def run(args):
+    import torch
+    if args.watch is None and args.dataset_file is None:
+        raise ValueError('select --dataset-file or --watch')
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    apply_thread_settings()
+    scorer = IncrementalScorer(device, args.checkpoint, PredictionStore(args.store), args.input_size, args.batch_size)
+    if args.watch is not None:
+        scorer.watch(args.watch, args.micro_batch_size, args.max_wait)
+    elif args.benchmark_delta is not None:
+        benchmark_delta(scorer, args.img_dir, args.dataset_file, args.benchmark_delta)
+    else:
+        scorer.score_dataset_file(args.img_dir, args.dataset_file)
+    scorer.store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental scoring with a persistent prediction store')
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Multi-resolution (pyramid) cache of the Chest X-ray14 PNG database.
+
+Every image is stored as 8-bit grayscale PNG in several sizes:
+    <cache dir>/<level>/<image name>      e.g. database_pyramid/256/images_001/00000001_000.png
+so a training that resizes its input to 256 decodes a 256x256 image instead of the full 1024x1024 one.
+The build is incremental: only images that are new (or changed) since the last build are processed.
+
+Usage:
+    python PyramidCache.py --img-dir ./database --cache-dir ./database_pyramid --levels 1024 512 256
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+from PIL import Image
+
+
+def pyramid_image_path(path_pyramid_dir, level, image_name):
+    return os.path.join(path_pyramid_dir, str(level), image_name)
+
+
+def select_pyramid_level(levels, required_size):
+    """
+    :param required_size - minimal size (smaller edge) of the image, None for the full resolution image
+    :return the smallest level that is at least required_size, None if no level is large enough
+    """
+    if required_size is None:
+        return None
+    large_enough = [level for level in levels if level >= required_size]
+    if len(large_enough) == 0:
+        return None
+    return min(large_enough)
+
+
+def list_images(path_img_dir):
+    """
+    :return names (relative to path_img_dir) of all the PNG files in the database
+    """
+    names = []
+    for root, _, files in os.walk(path_img_dir):
+        for file_name in files:
+            if file_name.lower().endswith('.png'):
+                names.append(os.path.relpath(os.path.join(root, file_name), path_img_dir))
+    return sorted(names)
+
+
+def is_up_to_date(path_source, path_cached):
+    return os.path.exists(path_cached) and os.path.getmtime(path_cached) >= os.path.getmtime(path_source)
+
+
+def build_image_pyramid(args):
+    """
+    Write all the missing/outdated pyramid levels of one image.
+    :return number of written levels
+    """
+    path_img_dir, path_pyramid_dir, levels, image_name = args
+    path_source = os.path.join(path_img_dir, image_name)
+    missing_levels = [level for level in levels
+                      if not is_up_to_date(path_source, pyramid_image_path(path_pyramid_dir, level, image_name))]
+    if len(missing_levels) == 0:
+        return 0
+
+    write_image_pyramid(Image.open(path_source), path_pyramid_dir, missing_levels, image_name)
+    return len(missing_levels)
+
+
+def write_image_pyramid(image_data, path_pyramid_dir, levels, image_name):
+    """
+    Write the given levels of one (already opened) image.
+    """
+    # some of the database images are RGBA, the cache is always 8-bit grayscale
+    image_data = image_data.convert('L')
+    width, height = image_data.size
+    for level in levels:
+        # same as transforms.Resize(level): the smaller edge is scaled to level
+        if width <= height:
+            size = (level, int(round(level * height / width)))
+        else:
+            size = (int(round(level * width / height)), level)
+        if size == (width, height):
+            level_data = image_data
+        else:
+            level_data = image_data.resize(size, Image.BILINEAR)
+        path_cached = pyramid_image_path(path_pyramid_dir, level, image_name)
+        os.makedirs(os.path.dirname(path_cached), exist_ok=True)
+        # write to a temporary file first, so an interrupted build never leaves a truncated image
+        level_data.save(path_cached + '.tmp', format='PNG', compress_level=1)
+        os.replace(path_cached + '.tmp', path_cached)
+
+
+def build_pyramid_cache(path_img_dir, path_pyramid_dir, levels, num_workers=None):
+    """
+    Build (or update) the pyramid cache of all the PNG files in path_img_dir.
+    """
+    s = time.time()
+    image_names = list_images(path_img_dir)
+    print('found', len(image_names), 'images in', path_img_dir)
+    jobs = [(path_img_dir, path_pyramid_dir, levels, image_name) for image_name in image_names]
+    num_written = 0
+    num_updated_images = 0
+    with multiprocessing.Pool(num_workers) as pool:
+        for job_id, written in enumerate(pool.imap_unordered(build_image_pyramid, jobs, chunksize=16)):
+            num_written += written
+            num_updated_images += written > 0
+            if job_id % 1000 == 0:
+                print('----> ', job_id, '/', len(jobs), ' images checked')
+    print('pyramid cache updated: ', num_updated_images, ' images (', num_written, ' levels) in ', time.time() - s,
+          ' sec')
+    return num_updated_images
+
+
+def main():
+    from Config import PATH_IMG_DIR, PATH_PYRAMID_DIR, PYRAMID_LEVELS
+    parser = argparse.ArgumentParser(description='Build the multi-resolution cache of the PNG database')
+    parser.add_argument('--img-dir', default=PATH_IMG_DIR)
+    parser.add_argument('--cache-dir', default=PATH_PYRAMID_DIR)
+    parser.add_argument('--levels', nargs='+', type=int, default=PYRAMID_LEVELS)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cores)')
+    args = parser.parse_args()
+    build_pyramid_cache(args.img_dir, args.cache_dir, args.levels, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Training and evaluation runs, started from the command line (Main.py).
+"""
+import copy
+import shutil
+
+from ModelTrainer import *
+from CheckpointEvaluator import evaluate_checkpoints
+from CascadePredictor import CascadePredictor
+from Distillation import compare_student
+from HardExampleMining import HARD_EXAMPLE_SAMPLING, HARD_EXAMPLE_TOP_K
+from CheckpointIndex import update_metadata, best_checkpoints
+from HardwareTuner import apply_thread_settings, get_profile_batch_size, get_default_test_batch_size
+
+
+def batch_run_train(lrs=[1e-4], weight_decays=[1e-5], decay_patiences=[3], lambda_losses=[0.9], decay_factors=[0.1],
+                    batch_sizes=[32], max_epochs=[20], architecture_type=ATTENTION_AE_RESNET18):
+    if not os.path.exists(r"./ResultSummary.txt"):
+        file1 = open(r"./ResultSummary.txt", 'w')
+        file1.write(
+            'time path lr weight_decay decay_patience lambda_loss decay_factor batch_size max_epoch AUROC_mean loss_train loss_val loss_test\n')
+        file1.close()
+
+    #
+    # workbook = xlsxwriter.Workbook(launch_timestamp+'.xlsx')
+    # worksheet = workbook.add_worksheet()
+    # worksheet.write('A1', 'Path')
+    # worksheet.write('B1', 'weight_decay')
+    # worksheet.write('C1', 'decay_patience')
+    # worksheet.write('D1', 'lambda_loss')
+    # worksheet.write('E1', 'decay_factor')
+    # worksheet.write('F1', 'batch_size')
+    # worksheet.write('G1', 'max_epoch')
+    # worksheet.write('H1', 'AUROC mean')
+
+    runs_parameters = []
+    for lr in lrs:
+        for weight_decay in weight_decays:
+            for decay_patience in decay_patiences:
+                for lambda_loss in lambda_losses:
+                    for decay_factor in decay_factors:
+                        for batch_size in batch_sizes:
+                            for max_epoch in max_epochs:
+                                runs_parameters.append(
+                                    parameters(lr=lr, weight_decay=weight_decay, decay_patience=decay_patience,
+                                               lambda_loss=lambda_loss, decay_factor=decay_factor,
+                                               batch_size=batch_size, max_epoch=max_epoch))
+    i = 2
+    for run_parameters in runs_parameters:
+        print('******* Parameter check ', i - 1, '/', len(runs_parameters), '*******')
+        timestampTime = time.strftime("%H%M%S")
+        timestampDate = time.strftime("%d%m%Y")
+        launch_timestamp = timestampDate + '-' + timestampTime
+        AUROC_mean, train_loss, val_loss, test_loss, path_model = run_train(run_parameters,
+                                                                            architecture_type=architecture_type)
+        # worksheet.write('A'+str(i), path_model)
+        # worksheet.write('B'+str(i), run_parameters.weight_decay)
+        # worksheet.write('C'+str(i), run_parameters.decay_patience)
+        # worksheet.write('D'+str(i), run_parameters.lambda_loss)
+        # worksheet.write('E'+str(i), run_parameters.decay_factor)
+        # worksheet.write('F'+str(i), run_parameters.batch_size)
+        # worksheet.write('G'+str(i), run_parameters.max_epoch)
+        # worksheet.write('H'+str(i), auroc_mean)
+        file1 = open(r"./ResultSummary.txt", 'a')
+        file1.write(launch_timestamp + ' ' + path_model + ' ' + str(run_parameters.lr) + ' ' + str(
+            run_parameters.weight_decay) + ' ' +
+                    str(run_parameters.decay_patience) + ' ' + str(run_parameters.lambda_loss) + ' ' + str(
+            run_parameters.decay_factor) + ' ' + str(run_parameters.batch_size) + ' '
+                    + str(run_parameters.max_epoch) + ' ' + str(AUROC_mean) + ' ' + str(train_loss) + ' ' + str(
+            val_loss) + ' ' + str(test_loss) + '\n')
+        file1.close()
+        i += 1
+    # workbook.close()
+
+
+def run_train(run_parameters, train_stats=None, architecture_type=ATTENTION_AE_RESNET18):
+    """
+    :param train_stats - if not None, a dict that is filled with the train time and the time to the target AUROC
+    :param architecture_type - one of: RESNET18, BASIC_AE, AE_RESNET18, IMPROVED_AE, IMPROVED_AE_RESNET18,
+                               ATTENTION_AE, ATTENTION_AE_RESNET18
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # device = torch.device("cpu")
+    apply_thread_settings()
+    if device == torch.device("cuda:0"):
+        gc.collect()
+        torch.cuda.empty_cache()
+        print('Using GPU')
+    else:
+        print('Using CPU')
+
+    timestampTime = time.strftime("%H%M%S")
+    timestampDate = time.strftime("%d%m%Y")
+    launch_timestamp = timestampDate + '-' + timestampTime
+
+    # ---- Path to the directory with images
+
+    # ---- Paths to the files with training, validation and testing sets.
+    # ---- Each file should contains pairs [path to image, output vector]
+    # ---- Example: images_011/00027736_001.png 0 0 0 0 0 0 0 0 0 0 0 0 0 0
+
+    # ---- Neural network parameters: is it pre-trained on imagenet, class-balanced loss
+    is_backbone_pretrained = True
+    balanced_classifier_loss = True
+
+    # ---- Training settings: batch size, maximum number of epochs
+    batch_size = run_parameters.batch_size
+    max_epoch = run_parameters.max_epoch
+
+    # ---- Parameters related to image transforms: size of the down-scaled image, cropped image
+    # ---- (input size per architecture, see get_input_settings). With a progressive resizing schedule the
+    # ---- training starts from the schedule sizes, the sizes below are of the last phase (used for testing).
+    input_size = run_parameters.input_size
+    if run_parameters.resize_schedule is not None:
+        # the training starts from epoch 0 (no checkpoints below), its last epoch is max_epoch - 1
+        input_size = get_scheduled_input_size(run_parameters.resize_schedule, max_epoch - 1, input_size)
+    trans_resize_size, trans_crop_size, trans_rotation_angle, num_of_input_channels = \
+        get_input_settings(architecture_type, input_size)
+
+    checkpoint_encoder = None
+    checkpoint_classifier = None
+    checkpoint_combined = None
+
+    print('Training NN architecture = ', architecture_type)
+    model_trainer = ModelTrainer(device, architecture_type, num_of_input_channels, is_backbone_pretrained, NUM_CLASSES,
+                                 balanced_classifier_loss, run_parameters)
+    train_loss, val_loss = model_trainer.train(PATH_IMG_DIR, PATH_FILE_TRAIN, PATH_FILE_VALIDATION, batch_size,
+                                               max_epoch, trans_resize_size, trans_crop_size, trans_rotation_angle,
+                                               launch_timestamp,
+                                               checkpoint_classifier, checkpoint_encoder, checkpoint_combined)
+    # a resumed run (run parameter resume_checkpoint) continues the checkpoints of the preempted run
+    path_saved_model = 'm-' + architecture_type + '-' + model_trainer.launch_timestamp + '.pth.tar'
+    if train_stats is not None:
+        train_stats['train_time'] = model_trainer.train_time
+        train_stats['time_to_target_auroc'] = model_trainer.time_to_target_auroc
+    print('Testing the trained model')
+    auroc_mean, test_loss = model_trainer.test(PATH_IMG_DIR, PATH_FILE_TEST, path_saved_model,
+                                               batch_size, trans_resize_size, trans_crop_size)
+    update_metadata(path_saved_model, test_loss=float(test_loss),
+                    test_auroc_mean=float(auroc_mean) if model_trainer.has_classifier_output() else None)
+    if run_parameters.distillation_teacher is not None:
+        # AUROC gap and latency of the student vs. the teacher
+        compare_student(device, run_parameters.distillation_teacher, path_saved_model, PATH_IMG_DIR, PATH_FILE_TEST,
+                        batch_size, student_input_size=input_size)
+    return auroc_mean, train_loss, val_loss, test_loss, path_saved_model
+
+
+def run_hard_example_comparison(run_parameters, modes=(None, HARD_EXAMPLE_SAMPLING, HARD_EXAMPLE_TOP_K),
+                                architecture_type=ATTENTION_AE_RESNET18):
+    """
+    Train with the uniform shuffle and with the hard example mining modes (same run parameters otherwise), and print
+    the train time to the target AUROC (run parameter target_auroc) of every mode.
+    :return list of dicts: mode, time_to_target_auroc (None if not reached), train_time, auroc_mean (test)
+    """
+    results = []
+    for mode in modes:
+        mode_parameters = copy.copy(run_parameters)
+        mode_parameters.hard_example_mining = mode
+        train_stats = {}
+        auroc_mean, _, _, _, _ = run_train(mode_parameters, train_stats, architecture_type)
+        results.append({'mode': mode or 'uniform', 'auroc_mean': auroc_mean, **train_stats})
+    print('\nHard example mining, time to AUROC mean {}:'.format(run_parameters.target_auroc))
+    print('{:>10s} {:>12s} {:>12s} {:>10s}'.format('mode', 'to target', 'train time', 'test AUROC'))
+    for result in results:
+        time_to_target = result['time_to_target_auroc']
+        print('{:>10s} {:>12s} {:>12.1f} {:>10.4f}'.format(
+            result['mode'], 'n/a' if time_to_target is None else '{:.1f}'.format(time_to_target),
+            result['train_time'], result['auroc_mean']))
+    return results
+
+
+def run_test(path_trained_models=None, path_checkpoint_dir=None, top=5, architecture_type=AE_RESNET18, input_size=None,
+             batch_size=None):
+    """
+    :param path_trained_models - checkpoints to test, of any architecture (read from the checkpoints)
+    :param path_checkpoint_dir - or: test the top checkpoints of the directory by validation AUROC (their metadata,
+                                 CheckpointIndex.py)
+    :param architecture_type - sets the default batch size (host profile of HardwareTuner.py, if tuned)
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    apply_thread_settings()
+
+    if device == torch.device("cuda:0"):
+        gc.collect()
+        torch.cuda.empty_cache()
+        print('Using GPU')
+    else:
+        print('Using CPU')
+
+    balanced_classifier_loss = True
+    if batch_size is None:
+        batch_size = get_profile_batch_size('test', architecture_type, [input_size],
+                                            get_default_test_batch_size(architecture_type))
+
+    if path_checkpoint_dir is not None:
+        path_trained_models = [metadata['path'] for metadata in best_checkpoints(path_checkpoint_dir, 'auroc_mean',
+                                                                                 top=top)]
+    elif path_trained_models is None:
+        path_trained_model = r'C:\Users\pazi\Desktop\Uni\BioDeepLearning\1e4\m-RES-NET-18-20072020-073848.pth.tar'
+        path_trained_models = [path_trained_model]
+    # a single pass over the test split: every batch is evaluated by all the checkpoints
+    results = evaluate_checkpoints(device, path_trained_models, PATH_IMG_DIR, PATH_FILE_TEST, batch_size,
+                                   balanced_classifier_loss, input_size)
+    results = [result for result in results if result['auroc_mean'] is not None]
+    if len(results) == 0:
+        return
+    best_result = max(results, key=lambda result: result['auroc_mean'])
+    # the best checkpoint file is copied, not loaded again
+    shutil.copyfile(best_result['path'], 'm-' + best_result['architecture_type'] + '-' + str(
+        best_result['weight_decay']) + '-' + str(best_result['lr']) + '-' + str(
+        np.round(10000 * best_result['auroc_mean']) / 10000) + '.pth.tar')
+
+
+def run_cascade_test(path_cheap_model=None, path_full_model=None, miss_rate=0.01):
+    """
+    The cheap model scores every study, the uncertain studies are escalated to the expensive model.
+    :param miss_rate - fraction of the validation positives (negatives) of a class accepted as confident negatives
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if path_cheap_model is None:
+        path_cheap_model = r'C:\Users\pazi\Desktop\Uni\BioDeepLearning\1e4\m-RES-NET-18-20072020-073848.pth.tar'
+    if path_full_model is None:
+        path_full_model = r'C:\Users\pazi\Desktop\Uni\BioDeepLearning\1e4\m-ATTENTION-AE-RES-NET-18.pth.tar'
+
+    apply_thread_settings()
+    cascade = CascadePredictor(device, path_cheap_model, path_full_model, miss_rate, balanced_classifier_loss=True)
+    cheap_batch_size = get_profile_batch_size('test', cascade.cheap.architecture_type, default=1024)
+    full_batch_size = get_profile_batch_size('test', cascade.full.architecture_type, default=32)
+    cascade.calibrate(PATH_IMG_DIR, PATH_FILE_VALIDATION, batch_size=cheap_batch_size)
+    return cascade.evaluate(PATH_IMG_DIR, PATH_FILE_TEST, cheap_batch_size=cheap_batch_size,
+                            full_batch_size=full_batch_size)
@@ -0,0 +1,165 @@
+"""
+Process-shared cache of decoded images.
+
+The cache lives in shared memory tensors, so all the DataLoader workers (of the train and the validation loaders,
+in all the epochs) read and fill the same cache: an image is decoded once, in the first epoch it is accessed, and is
+copied from the cache afterwards.
+
+The memory budget is a byte budget: it is split into small pages (allocated upfront) and a cached image takes only
+the pages of its bytes (e.g. 4 pages of 64 KB for a 512x512 grayscale image, 16 for 1024x1024), the pages of an
+image do not need to be contiguous. When there are not enough free pages, the least recently used images are
+evicted until the image fits.
+
+The keys are per image name: the datasets of every resize phase (rebuilt with a new transform) use the same keys,
+so a new decoded version of an image (another pyramid level / decode size) replaces the previous one.
+"""
+import multiprocessing
+
+import numpy as np
+import torch
+
+# ---- indices in the stats tensor
+HITS = 0
+MISSES = 1
+INSERTS = 2
+EVICTIONS = 3
+CACHED_IMAGES = 4
+FREE_PAGES = 5
+TICK = 6
+NUM_STATS = 7
+
+# ---- last access tick of a free entry (never the least recently used)
+FREE_ENTRY_TICK = np.iinfo(np.int64).max
+
+
+class SharedImageCache:
+    # ---- budget_bytes - total memory of the cached images
+    # ---- max_image_bytes - the largest image that can be cached (e.g. 1024*1024 for grayscale 1024x1024)
+    # ---- page_bytes - allocation unit of the images
+    # ---- max_keys - number of image names that can be registered
+    def __init__(self, budget_bytes, max_image_bytes, page_bytes=1 << 16, max_keys=1 << 20):
+        self.page_bytes = page_bytes
+        self.max_image_bytes = max_image_bytes
+        self.num_pages = max(1, budget_bytes // page_bytes)
+        self.max_pages_per_image = -(-max_image_bytes // page_bytes)
+        self.max_keys = max_keys
+        self.data = torch.empty(self.num_pages, page_bytes, dtype=torch.uint8).share_memory_()
+        # ---- stack of the free pages, the top FREE_PAGES entries are free
+        self.free_pages = torch.arange(self.num_pages, dtype=torch.int64).share_memory_()
+        # ---- per entry (a cached image, at most one per page): cached key, variant (e.g. pyramid level), shape
+        # ---- (h, w, c), pages and last access tick
+        num_entries = self.num_pages
+        self.entry_key = torch.full((num_entries,), -1, dtype=torch.int64).share_memory_()
+        self.entry_variant = torch.zeros(num_entries, dtype=torch.int64).share_memory_()
+        self.entry_shape = torch.zeros(num_entries, 3, dtype=torch.int64).share_memory_()
+        self.entry_pages = torch.zeros(num_entries, self.max_pages_per_image, dtype=torch.int64).share_memory_()
+        self.entry_tick = torch.full((num_entries,), FREE_ENTRY_TICK, dtype=torch.int64).share_memory_()
+        # ---- per key: entry of the key, -1 if not cached
+        self.key_entry = torch.full((max_keys,), -1, dtype=torch.int64).share_memory_()
+        self.stats = torch.zeros(NUM_STATS, dtype=torch.int64).share_memory_()
+        self.stats[FREE_PAGES] = self.num_pages
+        self.lock = multiprocessing.Lock()
+        # ---- image name -> key, in the main process (the datasets are registered before the workers start)
+        self.name_keys = {}
+
+    def register(self, image_names):
+        """
+        Keys of the images of a dataset (must be called before the DataLoader workers are started). An image name
+        that was already registered (e.g. by the dataset of a previous resize phase) keeps its key.
+        :return shared int64 tensor of the keys (key of image i), None if the cache is full
+        """
+        new_names = set(name for name in image_names if name not in self.name_keys)
+        if len(self.name_keys) + len(new_names) > self.max_keys:
+            print('image cache: no more keys for a dataset of ', len(image_names), ' images, not cached')
+            return None
+        for name in image_names:
+            if name not in self.name_keys:
+                self.name_keys[name] = len(self.name_keys)
+        return torch.tensor([self.name_keys[name] for name in image_names], dtype=torch.int64).share_memory_()
+
+    def get(self, key, variant=0):
+        """
+        :return a copy of the cached image (uint8 HxW or HxWxC array), None if it is not cached
+        """
+        with self.lock:
+            entry = int(self.key_entry[key])
+            if entry < 0 or int(self.entry_variant[entry]) != variant:
+                self.stats[MISSES] += 1
+                return None
+            self.stats[TICK] += 1
+            self.entry_tick[entry] = self.stats[TICK]
+            self.stats[HITS] += 1
+            h, w, c = self.entry_shape[entry].tolist()
+            num_bytes = h * w * c
+            pages = self.entry_pages[entry, :-(-num_bytes // self.page_bytes)]
+            image = self.data.index_select(0, pages).view(-1)[:num_bytes].numpy()
+        if c == 1:
+            return image.reshape(h, w)
+        return image.reshape(h, w, c)
+
+    def free_entry(self, entry):
+        """
+        Return the pages of an entry to the free stack (the lock is held by the caller).
+        """
+        h, w, c = self.entry_shape[entry].tolist()
+        num_pages = -(-(h * w * c) // self.page_bytes)
+        num_free_pages = int(self.stats[FREE_PAGES])
+        self.free_pages[num_free_pages:num_free_pages + num_pages] = self.entry_pages[entry, :num_pages]
+        self.stats[FREE_PAGES] += num_pages
+        self.key_entry[self.entry_key[entry]] = -1
+        self.entry_key[entry] = -1
+        self.entry_tick[entry] = FREE_ENTRY_TICK
+        self.stats[CACHED_IMAGES] -= 1
+
+    def put(self, key, variant, image):
+        """
+        Cache an image (uint8 array), evicting the least recently used images if there are not enough free pages.
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.nbytes > self.max_image_bytes or image.nbytes > self.num_pages * self.page_bytes:
+            return False
+        shape = list(image.shape) + [1] * (3 - image.ndim)
+        num_pages = -(-image.nbytes // self.page_bytes)
+        with self.lock:
+            entry = int(self.key_entry[key])
+            if entry >= 0:
+                # another version of the image (e.g. of a previous resize phase)
+                self.free_entry(entry)
+            while int(self.stats[FREE_PAGES]) < num_pages:
+                self.free_entry(int(torch.argmin(self.entry_tick)))
+                self.stats[EVICTIONS] += 1
+            # at most one entry per page: there is a free entry when there is a free page
+            entry = int(torch.nonzero(self.entry_key < 0)[0])
+            num_free_pages = int(self.stats[FREE_PAGES]) - num_pages
+            pages = self.free_pages[num_free_pages:num_free_pages + num_pages].clone()
+            self.stats[FREE_PAGES] = num_free_pages
+            image_bytes = torch.from_numpy(image.reshape(-1))
+            for page_idx, page in enumerate(pages.tolist()):
+                page_data = image_bytes[page_idx * self.page_bytes:(page_idx + 1) * self.page_bytes]
+                self.data[page, :len(page_data)] = page_data
+            self.entry_pages[entry, :num_pages] = pages
+            self.entry_key[entry] = key
+            self.entry_variant[entry] = variant
+            self.entry_shape[entry] = torch.tensor(shape)
+            self.stats[TICK] += 1
+            self.entry_tick[entry] = self.stats[TICK]
+            self.key_entry[key] = entry
+            self.stats[CACHED_IMAGES] += 1
+            self.stats[INSERTS] += 1
+        return True
+
+    def get_stats(self):
+        hits, misses, inserts, evictions, cached_images, free_pages, _ = self.stats.tolist()
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0,
+                'inserts': inserts,
+                'evictions': evictions,
+                'cached_images': cached_images,
+                'used_mb': (self.num_pages - free_pages) * self.page_bytes / 2 ** 20,
+                'budget_mb': self.num_pages * self.page_bytes / 2 ** 20}
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats[HITS] = 0
+            self.stats[MISSES] = 0
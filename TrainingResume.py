@@ -0,0 +1,164 @@
+"""
+Mid-epoch resumable training for preemptible nodes (run parameters resume_checkpoint_interval, resume_checkpoint).
+
+Every resume_checkpoint_interval batches (and at the start of every epoch) the trainer writes a resume checkpoint
+(m-<architecture>-<launch timestamp>_resume.pth.tar) with the model, optimizer and ReduceLROnPlateau states, the
+position of the train sampler in the epoch (its shuffled indices and random state), the torch / numpy / python random
+states, the partial metrics of the epoch (loss sum, images, train time) and the progress of the run (loss lists, best
+loss / AUROC, train time). The state is copied on the training thread and saved by a background thread (written to a
+temporary file and renamed, an eviction during the write keeps the previous checkpoint).
+
+A run started with resume_checkpoint continues the preempted run (same launch timestamp, checkpoints and metrics log)
+from the first batch that was not trained: the sampler yields the rest of the saved epoch order, the images of the
+trained batches are not loaded again. Without DataLoader workers the resumed run is identical to the uninterrupted
+one; the workers are seeded per epoch iterator and the skipped batches shift their random streams, so their random
+crops / rotations of the remaining batches differ (the order and the model state do not). The results of an
+asynchronous validation that was pending at the eviction are lost.
+    python Main.py train --architecture RES-NET-18 --resume-checkpoint-interval 500
+    python Main.py train --architecture RES-NET-18 --resume-checkpoint m-RES-NET-18-<timestamp>_resume.pth.tar
+"""
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+RESUME_SUFFIX = '_resume.pth.tar'
+
+
+def get_resume_path(architecture_type, launch_timestamp):
+    return 'm-' + architecture_type + '-' + launch_timestamp + RESUME_SUFFIX
+
+
+def get_epoch_state(batch=0, loss_sum=0, num_images=0, num_backward_images=0, train_time=0):
+    """
+    :return partial epoch of a resume checkpoint: the next batch, the metrics of the trained batches and the random
+            states
+    """
+    return {'batch': batch, 'loss_sum': loss_sum, 'num_images': num_images,
+            'num_backward_images': num_backward_images, 'train_time': train_time, 'rng': get_rng_state()}
+
+
+def get_rng_state():
+    """
+    :return random states of torch (CPU and CUDA devices), numpy and python
+    """
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy': np.random.get_state(),
+            'python': random.getstate()}
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state['cuda']])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+
+def snapshot(value):
+    """
+    :return copy of a (nested) state on the CPU, not changed by the next training steps
+    """
+    if isinstance(value, torch.Tensor):
+        value = value.detach()
+        return value.clone() if value.device.type == 'cpu' else value.cpu()
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        return type(value)((key, snapshot(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffles the dataset every epoch, its position in the epoch can be saved and restored: a resumed epoch yields the
+    saved order from the first image that was not trained.
+    :param num_samples - size of the dataset
+    """
+    def __init__(self, num_samples, seed=0):
+        self.num_samples = num_samples
+        self.rng = np.random.RandomState(seed)
+        self.epoch_indices = np.arange(num_samples)
+        self.start = 0
+
+    def draw_indices(self):
+        """
+        :return indices of a new epoch
+        """
+        return self.rng.permutation(self.num_samples)
+
+    def get_epoch_size(self):
+        return self.num_samples
+
+    def __len__(self):
+        if self.start > 0:
+            return len(self.epoch_indices) - self.start
+        return self.get_epoch_size()
+
+    def __iter__(self):
+        start = self.start
+        if start == 0:
+            self.epoch_indices = self.draw_indices()
+        self.start = 0
+        return iter(self.epoch_indices[start:].tolist())
+
+    def state_dict(self):
+        return {'rng_state': self.rng.get_state(), 'epoch_indices': self.epoch_indices.copy()}
+
+    def load_state_dict(self, state, start=0):
+        """
+        :param start - position of the next iteration in the saved epoch indices, 0 - the next iteration draws a new
+                       epoch
+        """
+        self.rng.set_state(state['rng_state'])
+        self.epoch_indices = state['epoch_indices']
+        self.start = start
+
+
+def save_checkpoint(state, path_checkpoint):
+    # written to a temporary file and renamed: an eviction during the write keeps the previous checkpoint
+    path_tmp = path_checkpoint + '.tmp'
+    torch.save(state, path_tmp)
+    os.replace(path_tmp, path_checkpoint)
+
+
+class CheckpointWriter:
+    """
+    Saves the resume checkpoints in a background thread, one at a time (a save waits for the previous one).
+    """
+    def __init__(self):
+        self.thread = None
+        self.stats = {'saved': 0, 'copy_time': 0.0, 'wait_time': 0.0}
+
+    def write(self, state, path_checkpoint):
+        try:
+            save_checkpoint(state, path_checkpoint)
+            self.stats['saved'] += 1
+        except (OSError, RuntimeError) as error:
+            # e.g. a full disk: the training continues, the previous checkpoint is kept
+            print('resume checkpoint not saved: ', path_checkpoint, error)
+
+    def save(self, state, path_checkpoint):
+        """
+        Copy the state (on the calling thread) and save it in the background.
+        """
+        s = time.time()
+        self.wait()
+        self.stats['wait_time'] += time.time() - s
+        s = time.time()
+        state = snapshot(state)
+        self.stats['copy_time'] += time.time() - s
+        self.thread = threading.Thread(target=self.write, args=(state, path_checkpoint))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,100 @@
+"""
+Validation subsampling and AUROC confidence intervals.
+
+- stratified_subsample: a fixed, label-stratified subset of the validation split that keeps at least min_positives
+  positives of every class (e.g. Hernia, ~0.2% of the images)
+- bootstrap_auroc: percentile bootstrap confidence intervals of the per-class and the mean AUROC. All the resamples are
+  evaluated at once: a resample is a vector of counts per image, and the AUROC of every resample is computed from the
+  counts over the sorted (tied) predictions, without sorting or ranking every resample.
+"""
+import numpy as np
+
+
+def stratified_subsample(labels, fraction, min_positives=10, seed=0):
+    """
+    Iterative stratification: the classes are sampled from the rarest, each class gets fraction of its positives
+    (at least min_positives, or all of them) counting the images already selected for the rarer classes, and the
+    images without labels get fraction of their number.
+    :param labels - N x C array of 0/1 labels
+    :return sorted indices of the subsample
+    """
+    labels = np.asarray(labels) > 0
+    rng = np.random.RandomState(seed)
+    selected = np.zeros(len(labels), dtype=bool)
+    num_positives = labels.sum(0)
+    for class_idx in np.argsort(num_positives):
+        positives = np.nonzero(labels[:, class_idx])[0]
+        target = min(len(positives), max(min_positives, int(np.ceil(fraction * len(positives)))))
+        missing = target - selected[positives].sum()
+        if missing > 0:
+            candidates = positives[~selected[positives]]
+            selected[rng.choice(candidates, missing, replace=False)] = True
+    no_labels = np.nonzero(~labels.any(1))[0]
+    if len(no_labels) > 0:
+        selected[rng.choice(no_labels, int(np.ceil(fraction * len(no_labels))), replace=False)] = True
+    return np.nonzero(selected)[0]
+
+
+def bootstrap_weights(num_samples, num_resamples, seed=0):
+    """
+    :return num_resamples x num_samples counts: how many times every sample is drawn in each resample
+    """
+    rng = np.random.RandomState(seed)
+    return rng.multinomial(num_samples, np.full(num_samples, 1.0 / num_samples), size=num_resamples)
+
+
+def weighted_auroc(gt, prediction, weights):
+    """
+    AUROC of one class for every row of weights (the Mann-Whitney U statistic with weighted samples, ties count 1/2).
+    :param gt - N binary labels, prediction - N scores, weights - R x N sample counts
+    :return R AUROC values (nan where a resample has no positive or no negative)
+    """
+    order = np.argsort(prediction, kind='mergesort')
+    sorted_prediction = prediction[order]
+    positive = gt[order] > 0
+    # tied predictions form one group
+    group_starts = np.concatenate(([0], np.nonzero(np.diff(sorted_prediction))[0] + 1))
+    sorted_weights = weights[:, order]
+    positive_weights = np.add.reduceat(sorted_weights * positive, group_starts, axis=1)
+    negative_weights = np.add.reduceat(sorted_weights * ~positive, group_starts, axis=1)
+    negatives_below = np.cumsum(negative_weights, axis=1) - negative_weights
+    u_statistic = (positive_weights * (negatives_below + 0.5 * negative_weights)).sum(1)
+    num_pairs = positive_weights.sum(1) * negative_weights.sum(1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(num_pairs > 0, u_statistic / np.maximum(num_pairs, 1), np.nan)
+
+
+def bootstrap_auroc(gt, prediction, num_resamples=1000, confidence=0.95, seed=0):
+    """
+    :param gt - N x C binary labels
+    :param prediction - N x C scores, or N scores used for all the classes
+    :return per-class list of (AUROC, low, high) (None for classes with a single label value) and
+            (mean AUROC, low, high)
+    """
+    gt = np.asarray(gt)
+    prediction = np.asarray(prediction)
+    if prediction.ndim == 1:
+        prediction = np.repeat(prediction[:, None], gt.shape[1], axis=1)
+    num_samples, num_classes = gt.shape
+    full_weights = np.ones((1, num_samples), dtype=np.int64)
+    weights = bootstrap_weights(num_samples, num_resamples, seed)
+    alpha = (1 - confidence) / 2
+
+    class_auroc = []
+    resampled = np.full((num_resamples, num_classes), np.nan)
+    for class_idx in range(num_classes):
+        if len(np.unique(gt[:, class_idx])) != 2:
+            class_auroc.append(None)
+            continue
+        auroc = weighted_auroc(gt[:, class_idx], prediction[:, class_idx], full_weights)[0]
+        resampled[:, class_idx] = weighted_auroc(gt[:, class_idx], prediction[:, class_idx], weights)
+        low, high = np.nanpercentile(resampled[:, class_idx], [100 * alpha, 100 * (1 - alpha)])
+        class_auroc.append((float(auroc), float(low), float(high)))
+
+    valid = [auroc[0] for auroc in class_auroc if auroc is not None]
+    if len(valid) == 0:
+        return class_auroc, None
+    # the mean of every resample: the classes of a resample share the same drawn images
+    resampled_mean = np.nanmean(resampled[:, [auroc is not None for auroc in class_auroc]], axis=1)
+    low, high = np.nanpercentile(resampled_mean, [100 * alpha, 100 * (1 - alpha)])
+    return class_auroc, (float(np.mean(valid)), float(low), float(high))
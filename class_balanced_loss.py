@@ -47,7 +47,7 @@ def focal_loss(labels, logits, alpha, gamma):
     return focal_loss
 
 
-def CB_loss(labels, logits, samples_per_cls, no_of_classes, loss_type, beta, gamma, device):
+def CB_loss(labels, logits, samples_per_cls, no_of_classes, loss_type, beta, gamma, device, reduction='mean'):
     """Compute the Class Balanced Loss between `logits` and the ground truth `labels`.
 
     Class Balanced Loss: ((1-beta)/(1-beta^n))*Loss(labels, logits)
@@ -61,10 +61,16 @@ def CB_loss(labels, logits, samples_per_cls, no_of_classes, loss_type, beta, gam
       loss_type: string. One of "sigmoid", "focal", "softmax".
       beta: float. Hyperparameter for Class balanced loss.
       gamma: float. Hyperparameter for Focal loss.
+      reduction: string. "mean", or "none" for the loss of every example (mean over the classes, size [batch]).
+        The focal loss supports only "mean".
 
     Returns:
       cb_loss: A float tensor representing class balanced loss
     """
+    if reduction not in ("mean", "none"):
+        raise ValueError("unknown reduction " + str(reduction))
+    if loss_type == "focal" and reduction != "mean":
+        raise ValueError("the focal loss supports only the mean reduction")
     effective_num = 1.0 - np.power(beta, samples_per_cls)
     weights = (1.0 - beta) / np.array(effective_num)
     weights = weights / np.sum(weights) * no_of_classes
@@ -81,12 +87,14 @@ def CB_loss(labels, logits, samples_per_cls, no_of_classes, loss_type, beta, gam
     if loss_type == "focal":
         cb_loss = focal_loss(labels, logits, weights, gamma)
     elif loss_type == "sigmoid":
-        criteria = torch.nn.BCEWithLogitsLoss(pos_weight=weights, reduction='mean')
+        criteria = torch.nn.BCEWithLogitsLoss(pos_weight=weights, reduction=reduction)
         cb_loss = criteria(logits, labels)
     elif loss_type == "softmax":
         pred = logits.softmax(dim=1)
-        criteria = torch.nn.BCELoss(pos_weight=weights, reduction='mean')
+        criteria = torch.nn.BCELoss(pos_weight=weights, reduction=reduction)
         cb_loss = criteria(pred, labels)
+    if reduction == "none":
+        cb_loss = cb_loss.mean(1)
     return cb_loss
 
 